@@ -0,0 +1,105 @@
+import logging
+
+from ghstats import utils
+from ghstats import defaults
+
+logger = logging.getLogger(__name__)
+
+
+class RepoActivity(object):
+    _serialize_attrs = [
+        'repo_slug', 'change_rate', 'polls', 'changes', 'etag_hits',
+        'last_polled', 'last_changed',
+    ]
+    ALPHA = .3
+    def __init__(self, **kwargs):
+        self.repo_slug = kwargs.get('repo_slug')
+        self.change_rate = kwargs.get('change_rate', 1.)
+        self.polls = kwargs.get('polls', 0)
+        self.changes = kwargs.get('changes', 0)
+        self.etag_hits = kwargs.get('etag_hits', 0)
+        self.last_polled = kwargs.get('last_polled')
+        self.last_changed = kwargs.get('last_changed')
+    @staticmethod
+    def repo_changed(repo):
+        tv = repo.traffic_views
+        if tv is not None and not tv._cached and tv.total_views:
+            return True
+        tp = repo.traffic_paths
+        if tp is not None and not tp._cached and len(tp.data):
+            return True
+        tr = repo.traffic_referrals
+        if tr is not None and not tr._cached and len(tr.referrers):
+            return True
+        return False
+    def record_poll(self, repo, now):
+        objs = [repo.traffic_views, repo.traffic_paths, repo.traffic_referrals]
+        objs = [obj for obj in objs if obj is not None]
+        changed = self.repo_changed(repo)
+        self.polls += 1
+        self.etag_hits += len([obj for obj in objs if obj._cached])
+        if changed:
+            self.changes += 1
+            self.last_changed = now
+        self.change_rate = self.ALPHA * float(changed) + (1 - self.ALPHA) * self.change_rate
+        self.last_polled = now
+        return changed
+    def get_poll_interval(self, min_interval, max_staleness):
+        if self.change_rate <= 0:
+            return max_staleness
+        return min(max_staleness, min_interval / self.change_rate)
+    def is_due(self, now, min_interval, max_staleness, tolerance=0):
+        if self.last_polled is None:
+            return True
+        interval = self.get_poll_interval(min_interval, max_staleness)
+        elapsed = (now - self.last_polled).total_seconds()
+        return elapsed >= interval * (1 - tolerance)
+    def _serialize(self):
+        return {attr:getattr(self, attr) for attr in self._serialize_attrs}
+
+
+class ActivityTracker(object):
+    _collection_name = 'repo_activity'
+    MIN_INTERVAL = 3600
+    MAX_STALENESS = defaults.MAX_STALENESS
+    DUE_TOLERANCE = .1
+    def __init__(self, **kwargs):
+        self.db_store = kwargs.get('db_store')
+        self.min_interval = kwargs.get('min_interval', self.MIN_INTERVAL)
+        self.max_staleness = kwargs.get('max_staleness', self.MAX_STALENESS)
+        self.tolerance = kwargs.get('tolerance', self.DUE_TOLERANCE)
+        self.activity = {}
+    async def create_indexes(self):
+        coll = self.db_store.get_collection(self._collection_name)
+        await coll.create_index('repo_slug', unique=True)
+    async def load(self):
+        cursor = self.db_store.find_docs(self._collection_name, projection={'_id':False})
+        async for doc in cursor:
+            obj = RepoActivity(**doc)
+            self.activity[obj.repo_slug] = obj
+        return self.activity
+    def get_activity(self, repo_slug):
+        obj = self.activity.get(repo_slug)
+        if obj is None:
+            obj = self.activity[repo_slug] = RepoActivity(repo_slug=repo_slug)
+        return obj
+    def is_due(self, repo, now=None):
+        if now is None:
+            now = utils.now()
+        obj = self.get_activity(repo.repo_slug)
+        return obj.is_due(now, self.min_interval, self.max_staleness, self.tolerance)
+    def filter_due(self, repos, now=None):
+        if now is None:
+            now = utils.now()
+        repos = list(repos)
+        due = [repo for repo in repos if self.is_due(repo, now)]
+        logger.info('{} of {} repos due for polling'.format(len(due), len(repos)))
+        return due
+    async def record(self, repo, now=None):
+        if now is None:
+            now = utils.now()
+        obj = self.get_activity(repo.repo_slug)
+        obj.record_poll(repo, now)
+        coll = self.db_store.get_collection(self._collection_name)
+        await coll.replace_one({'repo_slug':obj.repo_slug}, obj._serialize(), upsert=True)
+        return obj
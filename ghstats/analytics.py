@@ -0,0 +1,242 @@
+import json
+import asyncio
+import argparse
+import datetime
+
+import numpy as np
+
+from ghstats import utils
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+from ghstats.snapshot import Snapshot, day_to_dt
+from ghstats.export import parse_date_arg
+
+DEFAULT_DAYS = 90
+
+SORT_KEYS = [
+    'total_views', 'total_uniques', 'rolling_mean', 'wow_growth', 'unique_ratio', 'spike_days',
+]
+
+RESULT_FIELDS = [
+    ('repo_slug', 'repo', '{}'),
+    ('total_views', 'views', '{:d}'),
+    ('total_uniques', 'uniques', '{:d}'),
+    ('rolling_mean', '7d avg', '{:.1f}'),
+    ('wow_growth', 'wow', '{}'),
+    ('unique_ratio', 'u/v', '{}'),
+    ('percentile', 'pct', '{:.0f}'),
+    ('spike_days', 'spikes', '{:d}'),
+    ('last_spike', 'last spike', '{}'),
+]
+
+
+def rolling_sum(m, window):
+    cs = np.cumsum(m, axis=1, dtype=np.float64)
+    result = cs.copy()
+    result[:, window:] = cs[:, window:] - cs[:, :-window]
+    return result
+
+def rolling_mean(m, window):
+    n = np.minimum(np.arange(1, m.shape[1] + 1), window)
+    return rolling_sum(m, window) / n
+
+def rolling_std(m, window):
+    n = np.minimum(np.arange(1, m.shape[1] + 1), window)
+    mean = rolling_sum(m, window) / n
+    sq_mean = rolling_sum(m.astype(np.float64) ** 2, window) / n
+    return np.sqrt(np.maximum(sq_mean - mean ** 2, 0))
+
+def safe_divide(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    out = np.full(np.broadcast(a, b).shape, np.nan)
+    np.divide(a, b, out=out, where=b != 0)
+    return out
+
+def week_over_week(m, window):
+    if m.shape[1] < window * 2:
+        return np.full(m.shape[0], np.nan)
+    current = m[:, -window:].sum(axis=1)
+    previous = m[:, -window * 2:-window].sum(axis=1)
+    return safe_divide(current - previous, previous)
+
+def percentile_rank(values):
+    if not len(values):
+        return np.zeros(0)
+    ranked = np.sort(values)
+    return np.searchsorted(ranked, values, side='right') / len(values) * 100
+
+def spike_flags(m, window, threshold, min_count):
+    prev_mean = np.zeros(m.shape, dtype=np.float64)
+    prev_std = np.zeros(m.shape, dtype=np.float64)
+    prev_mean[:, 1:] = rolling_mean(m, window)[:, :-1]
+    prev_std[:, 1:] = rolling_std(m, window)[:, :-1]
+    z = safe_divide(m - prev_mean, np.maximum(prev_std, 1))
+    flags = (z > threshold) & (m >= min_count)
+    flags[:, :min(window, m.shape[1])] = False
+    return flags
+
+
+class TrafficAnalytics(object):
+    WINDOW = 7
+    SPIKE_THRESHOLD = 3.
+    SPIKE_MIN_COUNT = 10
+    def __init__(self, repo_slugs, days, counts, uniques, **kwargs):
+        self.repo_slugs = repo_slugs
+        self.days = days
+        self.counts = counts
+        self.uniques = uniques
+        self.window = kwargs.get('window', self.WINDOW)
+        self.spike_threshold = kwargs.get('spike_threshold', self.SPIKE_THRESHOLD)
+        self.spike_min_count = kwargs.get('spike_min_count', self.SPIKE_MIN_COUNT)
+        self._metrics = None
+    @classmethod
+    def from_snapshot(cls, snapshot, start_datetime=None, end_datetime=None, **kwargs):
+        counts, days = snapshot.to_matrix('count', start_datetime, end_datetime)
+        uniques, _ = snapshot.to_matrix('uniques', start_datetime, end_datetime)
+        return cls(snapshot.repo_slugs, days, counts, uniques, **kwargs)
+    @classmethod
+    async def from_db(cls, db_store, start_datetime=None, end_datetime=None, **kwargs):
+        snapshot = await Snapshot.from_db(
+            db_store,
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            repo_slugs=kwargs.pop('repo_slugs', None),
+        )
+        return cls.from_snapshot(snapshot, start_datetime, end_datetime, **kwargs)
+    @property
+    def metrics(self):
+        m = self._metrics
+        if m is None:
+            m = self._metrics = self.compute()
+        return m
+    def compute(self):
+        counts = self.counts
+        total_views = counts.sum(axis=1)
+        total_uniques = self.uniques.sum(axis=1)
+        rolling = rolling_mean(counts, self.window)
+        spikes = spike_flags(counts, self.window, self.spike_threshold, self.spike_min_count)
+        any_spike = spikes.any(axis=1)
+        last_spike = np.where(
+            any_spike, spikes.shape[1] - 1 - np.argmax(spikes[:, ::-1], axis=1), -1,
+        )
+        return {
+            'total_views':total_views,
+            'total_uniques':total_uniques,
+            'rolling_mean':rolling[:, -1] if rolling.shape[1] else np.zeros(len(counts)),
+            'wow_growth':week_over_week(counts, self.window),
+            'unique_ratio':safe_divide(total_uniques, total_views),
+            'percentile':percentile_rank(total_views),
+            'spike_days':spikes.sum(axis=1),
+            'last_spike':last_spike,
+            'anomalous':spikes[:, -1] if spikes.shape[1] else np.zeros(len(counts), dtype=bool),
+        }
+    def get_results(self, sort_by='total_views', limit=None, repo_slugs=None):
+        m = self.metrics
+        if repo_slugs:
+            repo_slugs = set(repo_slugs)
+            index = [i for i, slug in enumerate(self.repo_slugs) if slug in repo_slugs]
+        else:
+            index = list(range(len(self.repo_slugs)))
+        keys = np.nan_to_num(m[sort_by][index], nan=-np.inf)
+        order = [index[i] for i in np.argsort(-keys, kind='stable')]
+        if limit is not None:
+            order = order[:limit]
+        results = []
+        for i in order:
+            last_spike = int(m['last_spike'][i])
+            results.append({
+                'repo_slug':self.repo_slugs[i],
+                'total_views':int(m['total_views'][i]),
+                'total_uniques':int(m['total_uniques'][i]),
+                'rolling_mean':float(m['rolling_mean'][i]),
+                'wow_growth':self._to_float(m['wow_growth'][i]),
+                'unique_ratio':self._to_float(m['unique_ratio'][i]),
+                'percentile':float(m['percentile'][i]),
+                'spike_days':int(m['spike_days'][i]),
+                'last_spike':self._day_str(last_spike) if last_spike >= 0 else None,
+                'anomalous':bool(m['anomalous'][i]),
+            })
+        return results
+    def get_summary(self):
+        return {
+            'num_repos':len(self.repo_slugs),
+            'start_datetime':self._day_str(0) if len(self.days) else None,
+            'end_datetime':self._day_str(len(self.days) - 1) if len(self.days) else None,
+            'window':self.window,
+        }
+    def _day_str(self, i):
+        return utils.dt_to_str(day_to_dt(self.days[i]))
+    @staticmethod
+    def _to_float(value):
+        if np.isnan(value):
+            return None
+        return float(value)
+
+
+def get_default_range(start_datetime=None, end_datetime=None, days=DEFAULT_DAYS):
+    if end_datetime is None:
+        end_datetime = utils.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        end_datetime += datetime.timedelta(days=1)
+    if start_datetime is None:
+        start_datetime = end_datetime - datetime.timedelta(days=days)
+    return start_datetime, end_datetime
+
+def format_result_row(row):
+    row = dict(row)
+    growth, ratio = row['wow_growth'], row['unique_ratio']
+    row['wow_growth'] = '-' if growth is None else '{:+.0%}'.format(growth)
+    row['unique_ratio'] = '-' if ratio is None else '{:.2f}'.format(ratio)
+    row['last_spike'] = row['last_spike'] or '-'
+    return row
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Rolling averages, growth, percentile ranks and spikes across all repos',
+    )
+    p.add_argument(
+        '--snapshot', dest='snapshot', default=None,
+        help='Read a directory written by ghstats-snapshot instead of MongoDB',
+    )
+    p.add_argument(
+        '--start', dest='start_datetime', type=parse_date_arg, default=None,
+        help='Earliest day (default: {} days before --end)'.format(DEFAULT_DAYS),
+    )
+    p.add_argument(
+        '--end', dest='end_datetime', type=parse_date_arg, default=None,
+        help='Day after the last one included (default: tomorrow)',
+    )
+    p.add_argument(
+        '--repo', dest='repo_slugs', action='append', default=None, metavar='OWNER/NAME',
+    )
+    p.add_argument(
+        '--sort', dest='sort_by', default='total_views', choices=SORT_KEYS,
+    )
+    p.add_argument('--limit', dest='limit', type=int, default=25)
+    p.add_argument('--window', dest='window', type=int, default=TrafficAnalytics.WINDOW)
+    p.add_argument('--json', dest='json', action='store_true', help='Print results as JSON')
+    p.add_argument('--db-config', dest='db_config', default=DB_CONF_FILENAME)
+    p.add_argument('--log-level', dest='log_level', default='WARNING')
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    start_dt, end_dt = get_default_range(args.start_datetime, args.end_datetime)
+    if args.snapshot is not None:
+        analytics = TrafficAnalytics.from_snapshot(
+            Snapshot.load(args.snapshot), start_dt, end_dt, window=args.window,
+        )
+    else:
+        db_store = DbStore.from_conf(args.db_config, section='export')
+        loop = asyncio.get_event_loop()
+        analytics = loop.run_until_complete(TrafficAnalytics.from_db(
+            db_store, start_dt, end_dt, repo_slugs=args.repo_slugs, window=args.window,
+        ))
+    results = analytics.get_results(args.sort_by, args.limit, args.repo_slugs)
+    if args.json:
+        print(json.dumps({'summary':analytics.get_summary(), 'repos':results}, indent=2))
+    else:
+        print(utils.format_table([format_result_row(r) for r in results], RESULT_FIELDS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import time
+import mmap
+import pickle
+import hashlib
+import tempfile
+
+from ghstats import metrics
+
+
+class SharedCache(object):
+    DEFAULT_TTL = 60
+    MAX_ENTRIES = 1000
+    PRUNE_EVERY = 100
+    FILE_EXT = '.cache'
+    def __init__(self, **kwargs):
+        cache_dir = kwargs.get('cache_dir')
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='ghstats-cache-')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.ttl = kwargs.get('ttl', self.DEFAULT_TTL)
+        self.max_entries = kwargs.get('max_entries', self.MAX_ENTRIES)
+        self.prune_every = kwargs.get('prune_every', self.PRUNE_EVERY)
+        self.last_prune = time.time()
+        self.sets_since_prune = 0
+    def get_filename(self, key):
+        h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}{}'.format(h, self.FILE_EXT))
+    def get(self, key, default=None):
+        value = self._get(key, default)
+        result = 'miss' if value is default else 'hit'
+        metrics.CACHE_REQUESTS.inc(cache=key.split(':', 1)[0], result=result)
+        return value
+    def _get(self, key, default=None):
+        filename = self.get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_mtime + self.ttl < time.time() or not st.st_size:
+                    return default
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return pickle.loads(m)
+        except FileNotFoundError:
+            return default
+    def set(self, key, value):
+        filename = self.get_filename(key)
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+        self.sets_since_prune += 1
+        if self.sets_since_prune >= self.prune_every or self.last_prune + self.ttl < time.time():
+            self.prune()
+    def delete(self, key):
+        try:
+            os.unlink(self.get_filename(key))
+        except FileNotFoundError:
+            pass
+    def iter_entries(self):
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.FILE_EXT):
+                continue
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                yield filename, os.stat(filename).st_mtime
+            except FileNotFoundError:
+                pass
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except FileNotFoundError:
+            return False
+        return True
+    def prune(self):
+        self.last_prune = time.time()
+        self.sets_since_prune = 0
+        expire_ts = self.last_prune - self.ttl
+        entries = []
+        num_removed = 0
+        for filename, mtime in self.iter_entries():
+            if mtime < expire_ts:
+                num_removed += self._unlink(filename)
+            else:
+                entries.append((mtime, filename))
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for mtime, filename in entries[:len(entries) - self.max_entries]:
+                num_removed += self._unlink(filename)
+        return num_removed
+    def clear(self):
+        for filename, mtime in self.iter_entries():
+            self._unlink(filename)
@@ -2,9 +2,14 @@ from ghstats import traffic
 from ghstats import utils
 from ghstats.app.colorutils import iter_colors
 
-async def get_repo_traffic_paths(app, context, repo_slug):
-    db_store = app['db_store']
-    coll = db_store.get_collection(traffic.TrafficPathEntry._collection_name)
+def add_pagination_stages(pipeline, skip=0, limit=None):
+    if skip:
+        pipeline.append({'$skip':skip})
+    if limit is not None:
+        pipeline.append({'$limit':limit})
+    return pipeline
+
+def build_repo_traffic_paths_pipeline(context, repo_slug, skip=0, limit=None):
     filt = traffic.build_datetime_filter('datetime', **context)
     filt['repo_slug'] = repo_slug
     pipeline = [
@@ -16,14 +21,17 @@ async def get_repo_traffic_paths(app, context, repo_slug):
             'path':{'$first':'$path'},
             'title':{'$first':'$title'},
         }},
-        {'$sort':{'count':-1}},
+        {'$sort':{'count':-1, '_id':1}},
     ]
+    return add_pagination_stages(pipeline, skip, limit)
+
+async def get_repo_traffic_paths(app, context, repo_slug, skip=0, limit=None):
+    coll = app['db_store'].get_collection(traffic.TrafficPathEntry._collection_name)
+    pipeline = build_repo_traffic_paths_pipeline(context, repo_slug, skip, limit)
     async for doc in coll.aggregate(pipeline):
         yield doc
 
-async def get_repo_referrals(app, context, repo_slug):
-    db_store = app['db_store']
-    coll = db_store.get_collection(traffic.TrafficReferrer._collection_name)
+def build_repo_referrals_pipeline(context, repo_slug, skip=0, limit=None):
     filt = traffic.build_datetime_filter('start_datetime', **context)
     filt['repo_slug'] = repo_slug
     pipeline = [
@@ -34,19 +42,18 @@ async def get_repo_referrals(app, context, repo_slug):
             'count':{'$sum':'$count'},
             'uniques':{'$sum':'$uniques'},
         }},
-        {'$sort':{'count':-1}},
+        {'$sort':{'count':-1, '_id':1}},
     ]
+    return add_pagination_stages(pipeline, skip, limit)
+
+async def get_repo_referrals(app, context, repo_slug, skip=0, limit=None):
+    coll = app['db_store'].get_collection(traffic.TrafficReferrer._collection_name)
+    pipeline = build_repo_referrals_pipeline(context, repo_slug, skip, limit)
     async for doc in coll.aggregate(pipeline):
         yield doc
 
-async def get_repos_by_rank(app, context, metric='count', limit=10):
-    repos = context['repos']
-    repo_slugs = context.get('repo_slugs')
-    db_store = app['db_store']
-    coll = db_store.get_collection(traffic.TrafficTimelineEntry._collection_name)
-    if not repo_slugs:
-        repo_slugs = [repo.repo_slug for repo in repos.values()]
-    pipeline = [
+def build_repos_by_rank_pipeline(repo_slugs, metric='count', limit=10):
+    return [
         {'$match':{'repo_slug':{'$in':repo_slugs}}},
         {'$group':{
             '_id':'$repo_slug',
@@ -55,19 +62,20 @@ async def get_repos_by_rank(app, context, metric='count', limit=10):
         {'$sort':{'total':-1}},
         {'$limit':limit},
     ]
-    async for doc in coll.aggregate(pipeline):
+
+async def get_repos_by_rank(app, context, metric='count', limit=10):
+    repos = context['repos']
+    repo_slugs = context.get('repo_slugs')
+    coll = app['db_store'].get_collection(traffic.TrafficTimelineEntry._collection_name)
+    if not repo_slugs:
+        repo_slugs = [repo.repo_slug for repo in repos.values()]
+    async for doc in coll.aggregate(build_repos_by_rank_pipeline(repo_slugs, metric, limit)):
         yield doc
 
-async def get_timeline_for_repo(app, context, repo, metric):
-    db_store = app['db_store']
-    if isinstance(repo, traffic.Repo):
-        repo_slug = repo.repo_slug
-    else:
-        repo_slug = repo
-    coll = db_store.get_collection(traffic.TrafficTimelineEntry._collection_name)
+def build_timeline_pipeline(context, repo_slug, metric):
     filt = traffic.build_datetime_filter('timestamp', **context)
     filt['repo_slug'] = repo_slug
-    pipeline = [
+    return [
         {'$match':filt},
         {'$group':{
             '_id':'$timestamp',
@@ -75,15 +83,24 @@ async def get_timeline_for_repo(app, context, repo, metric):
         }},
         {'$sort':{'_id':1}},
     ]
-    async for doc in coll.aggregate(pipeline):
-        doc['timestamp'] = utils.make_aware(doc['_id'])
+
+async def get_timeline_for_repo(app, context, repo, metric):
+    if isinstance(repo, traffic.Repo):
+        repo_slug = repo.repo_slug
+    else:
+        repo_slug = repo
+    coll = app['db_store'].get_collection(traffic.TrafficTimelineEntry._collection_name)
+    async for doc in coll.aggregate(build_timeline_pipeline(context, repo_slug, metric)):
+        doc['timestamp'] = doc['_id']
         yield doc
 
 
-async def build_chart_datasets(app, context, metric, limit, hidden_repos):
-    all_dts = {}
+async def iter_chart_datasets(app, context, metric, limit, hidden_repos, chart_info=None):
+    if chart_info is None:
+        chart_info = {}
+    all_dts = chart_info.setdefault('all_dts', {})
+    dataset_ids = chart_info.setdefault('dataset_ids', [])
     color_iter = context.get('color_iter', iter_colors())
-    dataset_ids = []
 
     async def build_chart_repo_dataset(repo_doc):
         repo_slug = repo_doc['_id']
@@ -114,15 +131,27 @@ async def build_chart_datasets(app, context, metric, limit, hidden_repos):
         tdata['data'] = [d async for d in build_rows()]
         return tdata
 
-    repo_iter = get_repos_by_rank(app, context, metric, limit)
-    datasets = [await build_chart_repo_dataset(repo_doc) async for repo_doc in repo_iter]
-    start_dt = min(all_dts.keys())
+    async for repo_doc in get_repos_by_rank(app, context, metric, limit):
+        yield await build_chart_repo_dataset(repo_doc)
+
+def get_chart_start_datetime(chart_info):
+    all_dts = chart_info.get('all_dts')
+    if not all_dts:
+        return None
+    return all_dts[min(all_dts.keys())]
+
+async def build_chart_datasets(app, context, metric, limit, hidden_repos):
+    chart_info = {}
+    dataset_iter = iter_chart_datasets(
+        app, context, metric, limit, hidden_repos, chart_info,
+    )
+    datasets = [dataset async for dataset in dataset_iter]
     data = {
         'chart_data':{
             'datasets':datasets,
         },
-        'dataset_ids':dataset_ids,
-        'start_datetime':all_dts[start_dt],
+        'dataset_ids':chart_info['dataset_ids'],
+        'start_datetime':get_chart_start_datetime(chart_info),
     }
     return data
 
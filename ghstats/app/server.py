@@ -0,0 +1,527 @@
+import os
+import time
+import urllib
+import logging
+import datetime
+import numbers
+import asyncio
+from aiohttp import web
+import aiohttp_jinja2
+import jinja2
+import pymongo
+
+from ghstats import traffic
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+from ghstats import utils
+from ghstats import metrics
+from ghstats import serialize
+from ghstats import profiling
+from ghstats.app.colorutils import iter_colors
+from ghstats.app import templatetags
+from ghstats.app import chartdata
+from ghstats.app.cache import SharedCache
+
+logger = logging.getLogger(__name__)
+
+BASE_PATH = os.path.abspath(os.path.dirname(__file__))
+STATIC_ROOT = os.path.join(BASE_PATH, 'static')
+
+DETAIL_PAGE_SIZE = 25
+DETAIL_TABLES = {
+    'paths':chartdata.get_repo_traffic_paths,
+    'referrers':chartdata.get_repo_referrals,
+}
+
+EVENT_POLL_INTERVAL = 10
+EVENT_KEEPALIVE_INTERVAL = 30
+EVENT_QUEUE_SIZE = 16
+METRICS_SNAPSHOT_INTERVAL = 5
+
+UNTIMED_ROUTES = ['/events/', '/metrics', '/profile']
+
+UPDATE_EVENT_PROJECTION = {
+    '_id':False,
+    'log_timestamp':True,
+    'repo_slugs':True,
+    'collection_updates':True,
+    'total_updates':True,
+}
+
+
+def parse_query_dt(o):
+    if isinstance(o, datetime.datetime):
+        return o
+    if isinstance(o, str):
+        if o.isalnum():
+            o = float(o)
+        else:
+            if o.count(':') == 1:
+                dt_fmt = '%Y-%m-%dT%H:%MZ'
+            else:
+                dt_fmt = utils.DT_FMT
+            return utils.parse_dt(o, dt_fmt)
+    if isinstance(o, numbers.Number):
+        return utils.timestamp_to_dt(o)
+    raise ValueError('Could not parse datetime from {}'.format(repr(o)))
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start_ts = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        route = 'unmatched' if route is None else route.canonical
+        if route not in UNTIMED_ROUTES:
+            duration = time.perf_counter() - start_ts
+            metrics.WEB_REQUEST_DURATION.observe(duration, route=route, status=status)
+            profiling.add('route {}'.format(route), duration)
+
+async def create_dbstore(app):
+    if app.get('db_store') is None:
+        app['db_store'] = DbStore.from_conf(app['db_config'], section='web')
+
+async def start_profiler(app):
+    app['profiler'] = profiling.start(**app['profile_options'])
+
+async def stop_profiler(app):
+    profiler = profiling.stop()
+    if profiler is None:
+        return
+    logger.info(profiling.format_summary(profiler.get_summary()))
+    filename = profiler.save_output()
+    if filename is not None:
+        logger.info('profile written to {}'.format(filename))
+
+async def start_update_log_watcher(app):
+    app['event_queues'] = set()
+    app['update_log_watcher'] = asyncio.ensure_future(watch_update_log(app))
+
+async def stop_update_log_watcher(app):
+    task = app['update_log_watcher']
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+async def write_metrics_snapshots(app):
+    while True:
+        metrics.write_snapshot(app['metrics_dir'])
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+async def start_metrics_snapshots(app):
+    os.makedirs(app['metrics_dir'], exist_ok=True)
+    app['metrics_writer'] = asyncio.ensure_future(write_metrics_snapshots(app))
+
+async def stop_metrics_snapshots(app):
+    task = app['metrics_writer']
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    metrics.write_snapshot(app['metrics_dir'])
+
+def build_update_event(doc):
+    return {
+        'log_timestamp':utils.dt_to_str(doc['log_timestamp']),
+        'repo_slugs':doc.get('repo_slugs', []),
+        'collection_updates':doc.get('collection_updates', {}),
+        'total_updates':doc.get('total_updates', 0),
+    }
+
+async def watch_update_log(app):
+    coll_name = traffic.ApiObject._log_collection_name
+    coll = app['db_store'].get_collection(coll_name)
+    last_timestamp = None
+    while True:
+        try:
+            if last_timestamp is None:
+                doc = await coll.find_one(
+                    {'completed':True}, sort=[('log_timestamp', pymongo.DESCENDING)],
+                    projection={'_id':False, 'log_timestamp':True},
+                )
+                last_timestamp = utils.EPOCH if doc is None else doc['log_timestamp']
+            filt = {'completed':True, 'log_timestamp':{'$gt':last_timestamp}}
+            sort = [('log_timestamp', pymongo.ASCENDING)]
+            cursor = app['db_store'].find_docs(
+                coll, filt, projection=UPDATE_EVENT_PROJECTION, sort=sort,
+            )
+            async for doc in cursor:
+                last_timestamp = doc['log_timestamp']
+                if not doc.get('total_updates'):
+                    continue
+                if app['cache'] is not None:
+                    app['cache'].clear()
+                event = build_update_event(doc)
+                for queue in app['event_queues']:
+                    if not queue.full():
+                        queue.put_nowait(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Error reading {}'.format(coll_name))
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+
+async def get_repo_docs(app):
+    cache = app['cache']
+    if cache is not None:
+        docs = cache.get('repos')
+        if docs is not None:
+            return docs
+    cursor = app['db_store'].find_docs(
+        traffic.Repo._collection_name, projection=traffic.Repo.get_db_projection(),
+    )
+    docs = [doc async for doc in cursor]
+    if cache is not None:
+        cache.set('repos', docs)
+    return docs
+
+async def get_repos(app, context):
+    if 'repos' in context:
+        return context['repos']
+    d = {}
+    for doc in await get_repo_docs(app):
+        kw = {'db_store':app['db_store']}
+        kw.update(doc)
+        repo = await traffic.Repo.from_db(load_traffic=False, **kw)
+        repo.detail_url = app.router['repo_detail'].url_for(
+            repo_slug=urllib.parse.quote_plus(repo.repo_slug),
+        )
+        d[repo.repo_slug] = repo
+    context['repos'] = d
+    return d
+
+async def update_traffic_data(app, context):
+    repos = await get_repos(app, context)
+    tasks = []
+    for repo in repos.values():
+        task = asyncio.ensure_future(repo.traffic_views_from_db_flat(**context))
+        tasks.append(task)
+        task = asyncio.ensure_future(repo.traffic_paths_from_db_flat(**context))
+        tasks.append(task)
+    await asyncio.wait(tasks)
+    for repo in repos.values():
+        assert repo.traffic_views is not None
+
+def update_context_dt_range(request, context=None):
+    if context is None:
+        context = {}
+    for key in ['start_datetime', 'end_datetime']:
+        dt = request.query.get(key)
+        if isinstance(dt, str) and not len(dt):
+            dt = None
+        if dt is None:
+            if key in context:
+                del context[key]
+        else:
+            if isinstance(dt, str) and not dt.endswith('Z'):
+                dt = '{}Z'.format(dt)
+            dt = parse_query_dt(dt)
+            context[key] = dt
+            context['{}_str'.format(key)] = utils.dt_to_str(dt)
+    if not context.get('end_datetime'):
+        now = utils.now()
+        context['end_datetime'] = now
+        context['end_datetime_str'] = utils.dt_to_str(now)
+    return context
+
+async def prepare_view_context(request):
+    context = update_context_dt_range(request)
+    repos = await get_repos(request.app, context)
+    context.update({
+        'request':request,
+        'repos':repos,
+        'repo_slugs':[],
+        'DT_FMT':utils.DT_FMT,
+        'data_metric':'count',
+        'limit':10,
+        'hidden_repos':[],
+    })
+    return context
+
+@aiohttp_jinja2.template('home.html')
+async def home(request):
+    context = await prepare_view_context(request)
+    context.update({
+        'chart_id':'timeline-chart',
+        'chart_data_url':'/traffic-data/',
+    })
+    return context
+
+def get_query_page(request):
+    page = request.query.get('page', 0)
+    if isinstance(page, str):
+        assert page.isdigit()
+        page = int(page)
+    return page
+
+async def get_detail_table_page(app, context, repo_slug, table, page, page_size=DETAIL_PAGE_SIZE):
+    doc_iter = DETAIL_TABLES[table](
+        app, context, repo_slug, skip=page*page_size, limit=page_size+1,
+    )
+    rows = [doc async for doc in doc_iter]
+    return {
+        'table':table,
+        'page':page,
+        'rows':rows[:page_size],
+        'has_more':len(rows) > page_size,
+    }
+
+def get_detail_table_url(request, repo_slug):
+    url = request.app.router['repo_detail_table'].url_for(
+        repo_slug=urllib.parse.quote_plus(repo_slug),
+    )
+    query = {}
+    for key in ['start_datetime', 'end_datetime']:
+        if request.query.get(key):
+            query[key] = request.query[key]
+    return url.with_query(query)
+
+@aiohttp_jinja2.template('repo_detail.html')
+async def repo_detail(request):
+    repo_slug = request.match_info['repo_slug']
+    repo_slug = urllib.parse.unquote_plus(repo_slug)
+    context = await prepare_view_context(request)
+    context.update({
+        'repo_slug':repo_slug,
+        'repo_slugs':[repo_slug],
+        'chart_id':'timeline-chart',
+        'chart_data_url':'/combined-data/',
+        'table_data_url':get_detail_table_url(request, repo_slug),
+    })
+    repo = context['repos'][repo_slug]
+    context['repo'] = repo
+    page = get_query_page(request)
+    tp, tr = await asyncio.gather(
+        get_detail_table_page(request.app, context, repo_slug, 'paths', page),
+        get_detail_table_page(request.app, context, repo_slug, 'referrers', page),
+    )
+    context['traffic_paths'] = tp['rows']
+    context['traffic_paths_page'] = tp
+    context['traffic_referrers'] = tr['rows']
+    context['traffic_referrers_page'] = tr
+    return context
+
+async def get_repo_detail_table_json(request):
+    repo_slug = request.match_info['repo_slug']
+    repo_slug = urllib.parse.unquote_plus(repo_slug)
+    table = request.query.get('table')
+    assert table in DETAIL_TABLES
+    context = update_context_dt_range(request)
+    page = get_query_page(request)
+    data = await get_detail_table_page(request.app, context, repo_slug, table, page)
+    return web.json_response(data, dumps=serialize.dumps)
+
+async def get_analytics_json(request):
+    try:
+        from ghstats import analytics
+    except ImportError:
+        raise web.HTTPNotImplemented(text='Analytics require numpy')
+    cache = request.app['cache']
+    cache_key = 'analytics:{}'.format(request.path_qs)
+    if cache is not None:
+        body = cache.get(cache_key)
+        if body is not None:
+            return web.Response(body=body, content_type='application/json')
+    context = update_context_dt_range(request)
+    end_dt = context['end_datetime'] if request.query.get('end_datetime') else None
+    start_dt, end_dt = analytics.get_default_range(context.get('start_datetime'), end_dt)
+    repo_slugs = request.query.get('repo_slugs', '')
+    repo_slugs = repo_slugs.split(',') if len(repo_slugs) else None
+    sort_by = request.query.get('sort', 'total_views')
+    assert sort_by in analytics.SORT_KEYS
+    limit = request.query.get('limit')
+    if limit is not None:
+        assert limit.isdigit()
+        limit = int(limit)
+    obj = await analytics.TrafficAnalytics.from_db(
+        request.app['db_store'], start_dt, end_dt, repo_slugs=repo_slugs,
+    )
+    data = {
+        'summary':obj.get_summary(),
+        'repos':obj.get_results(sort_by, limit, repo_slugs),
+    }
+    body = serialize.dumps_bytes(data)
+    if cache is not None:
+        cache.set(cache_key, body)
+    return web.Response(body=body, content_type='application/json')
+
+async def prepare_chart_data_view_context(request):
+    context = update_context_dt_range(request)
+    await get_repos(request.app, context)
+    repo_slugs = request.query.get('repo_slugs', '')
+    if not len(repo_slugs):
+        repo_slugs = []
+    else:
+        repo_slugs = repo_slugs.split(',')
+    context['repo_slugs'] = repo_slugs
+    hidden_repos = request.query.get('hidden_repos', '')
+    if not len(hidden_repos):
+        hidden_repos = []
+    else:
+        hidden_repos = hidden_repos.split(',')
+    context['hidden_repos'] = hidden_repos
+    metric = request.query.get('data_metric', 'count')
+    assert metric in ['count', 'uniques']
+    context['data_metric'] = metric
+    limit = request.query.get('limit', 10)
+    if isinstance(limit, str):
+        assert limit.isalnum()
+        limit = int(limit)
+    context['limit'] = limit
+    return context
+
+async def stream_chart_data_json(request, context, data_metrics):
+    dumps = serialize.dumps
+    cache = request.app['cache']
+    cache_key = 'chart:{}'.format(request.path_qs)
+    if cache is not None:
+        body = cache.get(cache_key)
+        if body is not None:
+            return web.Response(body=body, content_type='application/json')
+        chunks = []
+    start_ts = time.perf_counter()
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    await resp.prepare(request)
+
+    async def write(data):
+        await resp.write(data)
+        if cache is not None:
+            chunks.append(data)
+
+    await write(b'{"chart_data":{"datasets":[')
+    chart_info = {}
+    num_written = 0
+    for metric in data_metrics:
+        context['data_metric'] = metric
+        dataset_iter = chartdata.iter_chart_datasets(
+            request.app, context, metric, context['limit'],
+            context['hidden_repos'], chart_info,
+        )
+        async for dataset in dataset_iter:
+            if num_written:
+                await write(b',')
+            with profiling.phase('serialize', cpu=True):
+                data = serialize.dumps_bytes(dataset)
+            await write(data)
+            num_written += 1
+    await write(b']},')
+    tail = '"dataset_ids":{},"start_datetime":{}}}'.format(
+        dumps(chart_info.get('dataset_ids', [])),
+        dumps(chartdata.get_chart_start_datetime(chart_info)),
+    )
+    await write(tail.encode('utf-8'))
+    await resp.write_eof()
+    metrics.CHART_BUILD_DURATION.observe(
+        time.perf_counter() - start_ts, chart=request.path.strip('/'),
+    )
+    if cache is not None:
+        cache.set(cache_key, b''.join(chunks))
+    return resp
+
+async def get_traffic_chart_data_json(request):
+    context = await prepare_chart_data_view_context(request)
+    return await stream_chart_data_json(request, context, [context['data_metric']])
+
+async def get_combined_chart_data_json(request):
+    context = await prepare_chart_data_view_context(request)
+    context['color_iter'] = iter_colors()
+    return await stream_chart_data_json(request, context, ['count', 'uniques'])
+
+async def update_events(request):
+    resp = web.StreamResponse(headers={
+        'Content-Type':'text/event-stream',
+        'Cache-Control':'no-cache',
+    })
+    await resp.prepare(request)
+    queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    event_queues = request.app['event_queues']
+    event_queues.add(queue)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                await resp.write(b': keepalive\n\n')
+                continue
+            data = serialize.dumps(event)
+            await resp.write('event: db_update\ndata: {}\n\n'.format(data).encode('utf-8'))
+    finally:
+        event_queues.discard(queue)
+    return resp
+
+async def get_profile_json(request):
+    summary = request.app['profiler'].get_summary()
+    return web.Response(body=serialize.dumps_bytes(summary), content_type='application/json')
+
+async def get_metrics(request):
+    metrics_dir = request.app['metrics_dir']
+    if metrics_dir is not None:
+        text = metrics.render_dir(metrics_dir)
+    else:
+        text = metrics.REGISTRY.render()
+    return web.Response(
+        text=text,
+        headers={'Content-Type':metrics.CONTENT_TYPE},
+    )
+
+def create_app(*args, **kwargs):
+    app = web.Application(middlewares=[metrics_middleware])
+    cache_dir = kwargs.get('cache_dir') or os.environ.get('GHSTATS_CACHE_DIR')
+    if cache_dir:
+        cache_ttl = kwargs.get('cache_ttl')
+        if cache_ttl is None:
+            cache_ttl = float(os.environ.get('GHSTATS_CACHE_TTL', SharedCache.DEFAULT_TTL))
+        max_entries = kwargs.get('cache_max_entries')
+        if max_entries is None:
+            max_entries = int(os.environ.get('GHSTATS_CACHE_MAX_ENTRIES', SharedCache.MAX_ENTRIES))
+        app['cache'] = SharedCache(cache_dir=cache_dir, ttl=cache_ttl, max_entries=max_entries)
+    else:
+        app['cache'] = None
+    app['db_store'] = kwargs.get('db_store')
+    app['db_config'] = kwargs.get(
+        'db_config', os.environ.get('GHSTATS_DB_CONFIG', DB_CONF_FILENAME),
+    )
+    app.add_routes([
+        web.get('/', home),
+        web.get(r'/repos/detail/{repo_slug}', repo_detail, name='repo_detail'),
+        web.get(
+            r'/repos/detail/{repo_slug}/table-data/', get_repo_detail_table_json,
+            name='repo_detail_table',
+        ),
+        web.get('/traffic-data/', get_traffic_chart_data_json),
+        web.get('/combined-data/', get_combined_chart_data_json),
+        web.get('/events/', update_events),
+        web.get('/analytics/', get_analytics_json),
+        web.get('/metrics', get_metrics),
+        web.static('/static', STATIC_ROOT, name='static'),
+    ])
+    app['metrics_dir'] = kwargs.get('metrics_dir') or os.environ.get('GHSTATS_METRICS_DIR')
+    if app['metrics_dir'] is not None:
+        app.on_startup.append(start_metrics_snapshots)
+        app.on_cleanup.append(stop_metrics_snapshots)
+    app['profile_options'] = kwargs.get('profile_options', profiling.get_env_options())
+    if app['profile_options'] is not None:
+        app.router.add_get('/profile', get_profile_json)
+        app.on_startup.append(start_profiler)
+        app.on_cleanup.append(stop_profiler)
+    app.on_startup.append(create_dbstore)
+    app.on_startup.append(start_update_log_watcher)
+    app.on_cleanup.append(stop_update_log_watcher)
+    j_env = aiohttp_jinja2.setup(
+        app,
+        loader=jinja2.FileSystemLoader(os.path.join(BASE_PATH, 'templates'))
+    )
+    templatetags.setup(j_env)
+    return app
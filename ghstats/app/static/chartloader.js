@@ -187,6 +187,72 @@ $(function(){
         }).submit();
     }
 
+    function findDatasetIndex(datasetIds, repoSlug, occurrence){
+        var index = -1,
+            count = 0;
+        $.each(datasetIds, function(i, datasetId){
+            if (datasetId != repoSlug){
+                return;
+            }
+            if (count == occurrence){
+                index = i;
+                return false;
+            }
+            count += 1;
+        });
+        return index;
+    }
+
+    function refreshChartRepos($chart, repoSlugs){
+        var ci = $chart.data('chart'),
+            data = $chart.data('chart_data'),
+            $form = $chart.data('form'),
+            affected = [],
+            params, url;
+        if (typeof(ci) == 'undefined' || ci === null){
+            return;
+        }
+        $.each(repoSlugs, function(i, repoSlug){
+            if (data.dataset_ids.indexOf(repoSlug) == -1){
+                return;
+            }
+            if (affected.indexOf(repoSlug) == -1){
+                affected.push(repoSlug);
+            }
+        });
+        if (!affected.length){
+            return;
+        }
+        params = $.grep($form.serializeArray(), function(param){
+            return param.name != 'repo_slugs';
+        });
+        params.push({'name':'repo_slugs', 'value':affected.join(',')});
+        url = [$form.attr('action'), $.param(params)].join('?');
+        $.getJSON(url, function(newData){
+            var occurrences = {};
+            $.each(newData.dataset_ids, function(i, repoSlug){
+                var occurrence = occurrences[repoSlug] || 0,
+                    index = findDatasetIndex(data.dataset_ids, repoSlug, occurrence);
+                occurrences[repoSlug] = occurrence + 1;
+                if (index == -1){
+                    return;
+                }
+                ci.data.datasets[index].data = newData.chart_data.datasets[i].data;
+            });
+            ci.update();
+        });
+    }
+
+    if (typeof(window.EventSource) != 'undefined'){
+        var eventSource = new EventSource('/events/');
+        eventSource.addEventListener('db_update', function(e){
+            var evt = JSON.parse(e.data);
+            $(".chart").each(function(){
+                refreshChartRepos($(this), evt.repo_slugs);
+            });
+        });
+    }
+
     $(".chart").each(function(){
         var $chart = $(this),
             $chartContainer = $chart.parents(".chart-container"),
@@ -0,0 +1,406 @@
+import os
+import re
+import sys
+import time
+import zlib
+import asyncio
+import argparse
+import datetime
+import logging
+import urllib.parse
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from ghstats import utils
+from ghstats import serialize
+from ghstats import traffic
+from ghstats.schema import ensure_indexes
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+REPOS_PATH_RE = re.compile(r'/user/repos$')
+TRAFFIC_PATH_RE = re.compile(
+    r'/repos/(?P<owner>[^/]+)/(?P<name>[^/]+)/traffic/(?P<kind>views|popular/paths|popular/referrers)$'
+)
+TRAFFIC_KINDS = {
+    'views':'views',
+    'popular/paths':'paths',
+    'popular/referrers':'referrers',
+}
+
+
+def is_archive(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def iter_log_chunks(filename):
+    lines = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.strip():
+                lines.append(line)
+                continue
+            if len(lines):
+                yield '\n'.join(lines)
+                lines = []
+    if len(lines):
+        yield '\n'.join(lines)
+
+def iter_log_records(filename):
+    for chunk in iter_log_chunks(filename):
+        d = serialize.loads(chunk)
+        yield {
+            'time':None,
+            'verb':d['verb'],
+            'url':d['url'],
+            'status':200,
+            'body':d['response'],
+        }
+
+def iter_archive_records(filename):
+    from ghstats.transport import RequestArchive
+    for record in RequestArchive.iter_records(filename):
+        record['time'] = utils.parse_dt(record['time'])
+        yield record
+
+def get_url_path(url):
+    return urllib.parse.urlsplit(url).path
+
+def get_run_time(records, default=None):
+    timestamps = []
+    for record in records:
+        m = TRAFFIC_PATH_RE.search(get_url_path(record['url']))
+        if m is None or m.group('kind') != 'views':
+            continue
+        body = utils.iter_parse_datetimes(record['body'], traffic.RepoTrafficViews._response_dt_keys)
+        if isinstance(body, dict):
+            timestamps.extend([d['timestamp'] for d in body.get('views', [])])
+    if not len(timestamps):
+        return default
+    return max(timestamps)
+
+def iter_timed_records(records, default_time):
+    run = []
+    run_time = default_time
+    for record in records:
+        if record['time'] is not None:
+            yield record
+            continue
+        if REPOS_PATH_RE.search(get_url_path(record['url'])) and len(run):
+            run_time = get_run_time(run, run_time)
+            for _record in run:
+                _record['time'] = run_time
+                yield _record
+            run = []
+        run.append(record)
+    if len(run):
+        run_time = get_run_time(run, run_time)
+        for _record in run:
+            _record['time'] = run_time
+            yield _record
+
+def iter_records(filename):
+    if is_archive(filename):
+        return iter_archive_records(filename)
+    mtime = utils.timestamp_to_dt(os.path.getmtime(filename))
+    return iter_timed_records(iter_log_records(filename), mtime)
+
+
+class RecordMapper(object):
+    def __init__(self):
+        self.referrals = {}
+    def map_record(self, record):
+        path = get_url_path(record['url'])
+        if record['verb'] != 'get':
+            return None
+        if REPOS_PATH_RE.search(path):
+            return self.map_repos(record)
+        m = TRAFFIC_PATH_RE.search(path)
+        if m is None:
+            return None
+        repo_slug = '/'.join([m.group('owner'), m.group('name')])
+        kind = TRAFFIC_KINDS[m.group('kind')]
+        return getattr(self, 'map_{}'.format(kind))(record, repo_slug)
+    def map_repos(self, record):
+        if record['status'] != 200:
+            return []
+        ops = []
+        for repo_data in record['body']:
+            owner, name = repo_data['owner']['login'], repo_data['name']
+            repo_slug = '/'.join([owner, name])
+            ops.append((traffic.Repo._collection_name, repo_slug, pymongo.UpdateOne(
+                {'repo_slug':repo_slug},
+                {'$set':{'owner':owner, 'name':name}},
+                upsert=True,
+            )))
+        return ops
+    def map_views(self, record, repo_slug):
+        if record['status'] != 200:
+            return []
+        body = utils.iter_parse_datetimes(
+            record['body'], traffic.RepoTrafficViews._response_dt_keys,
+        )
+        dt = record['time']
+        ops = [(traffic.RepoTrafficViews._collection_name, repo_slug, pymongo.UpdateOne(
+            {'repo_slug':repo_slug, 'datetime':dt},
+            {'$set':{'total_views':body['count'], 'total_uniques':body['uniques']}},
+            upsert=True,
+        ))]
+        for d in body['views']:
+            ops.append((traffic.TrafficTimelineEntry._collection_name, repo_slug, pymongo.UpdateOne(
+                {'repo_slug':repo_slug, 'datetime':dt, 'timestamp':d['timestamp']},
+                {'$set':{'count':d['count'], 'uniques':d['uniques']}},
+                upsert=True,
+            )))
+        return ops
+    def map_paths(self, record, repo_slug):
+        if record['status'] != 200:
+            return []
+        ops = []
+        for d in record['body']:
+            ops.append((traffic.TrafficPathEntry._collection_name, repo_slug, pymongo.UpdateOne(
+                {'repo_slug':repo_slug, 'datetime':record['time'], 'path':d['path']},
+                {'$set':{'count':d['count'], 'uniques':d['uniques'], 'title':d.get('title')}},
+                upsert=True,
+            )))
+        return ops
+    def map_referrers(self, record, repo_slug):
+        dt = record['time']
+        period = self.referrals.get(repo_slug)
+        if record['status'] == 304:
+            if period is not None:
+                period['end_datetime'] = dt
+            return []
+        if record['status'] != 200:
+            return []
+        ops = []
+        if period is not None:
+            period['end_datetime'] = dt
+            period['is_complete'] = True
+            ops.append(self.build_referrals_op(repo_slug, period))
+        self.referrals[repo_slug] = {
+            'start_datetime':dt,
+            'end_datetime':dt + datetime.timedelta(seconds=1),
+            'is_complete':False,
+        }
+        for d in record['body']:
+            ops.append((traffic.TrafficReferrer._collection_name, repo_slug, pymongo.UpdateOne(
+                {'repo_slug':repo_slug, 'start_datetime':dt, 'referrer':d['referrer']},
+                {'$set':{'count':d['count'], 'uniques':d['uniques']}},
+                upsert=True,
+            )))
+        return ops
+    def build_referrals_op(self, repo_slug, period):
+        return (traffic.RepoTrafficReferrals._collection_name, repo_slug, pymongo.UpdateOne(
+            {'repo_slug':repo_slug, 'start_datetime':period['start_datetime']},
+            {'$set':{
+                'end_datetime':period['end_datetime'],
+                'is_complete':period['is_complete'],
+            }},
+            upsert=True,
+        ))
+    def finish(self):
+        ops = [
+            self.build_referrals_op(repo_slug, period)
+            for repo_slug, period in self.referrals.items()
+        ]
+        self.referrals = {}
+        return ops
+
+
+class BackfillImporter(object):
+    NUM_WORKERS = 8
+    BATCH_SIZE = 1000
+    QUEUE_SIZE = 2
+    def __init__(self, db_store, **kwargs):
+        self.db_store = db_store
+        self.num_workers = kwargs.get('num_workers', self.NUM_WORKERS)
+        self.batch_size = kwargs.get('batch_size', self.BATCH_SIZE)
+        self.queue_size = kwargs.get('queue_size', self.QUEUE_SIZE)
+        self.dry_run = kwargs.get('dry_run', False)
+        self.log_timestamp = kwargs.get('log_timestamp')
+        if self.log_timestamp is None:
+            self.log_timestamp = utils.now()
+        self.mapper = RecordMapper()
+        self.buffers = {}
+        self.queues = []
+        self.error = None
+        self.stats = {
+            'records':0, 'skipped':0, 'ops':{},
+            'upserted':0, 'modified':0, 'errors':0,
+        }
+    def get_worker_index(self, repo_slug):
+        return zlib.crc32(repo_slug.encode('utf-8')) % self.num_workers
+    async def put_batch(self, index, coll_name, batch):
+        await self.queues[index].put((coll_name, batch))
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+    async def add_ops(self, ops):
+        for coll_name, repo_slug, op in ops:
+            index = self.get_worker_index(repo_slug)
+            key = (index, coll_name)
+            batch = self.buffers.get(key)
+            if batch is None:
+                batch = self.buffers[key] = {'ops':[], 'repo_slugs':set()}
+            batch['ops'].append(op)
+            batch['repo_slugs'].add(repo_slug)
+            if len(batch['ops']) >= self.batch_size:
+                del self.buffers[key]
+                await self.put_batch(index, coll_name, batch)
+    async def flush_buffers(self):
+        buffers = self.buffers
+        self.buffers = {}
+        for (index, coll_name), batch in buffers.items():
+            await self.put_batch(index, coll_name, batch)
+    async def worker(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                await self.write_batch(*item)
+            except Exception as exc:
+                logger.exception('Error writing batch to {}'.format(item[0]))
+                self.error = exc
+    async def write_batch(self, coll_name, batch):
+        ops = batch['ops']
+        op_counts = self.stats['ops']
+        op_counts[coll_name] = op_counts.get(coll_name, 0) + len(ops)
+        if self.dry_run:
+            return
+        coll = self.db_store.get_collection(coll_name)
+        try:
+            result = await coll.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as exc:
+            details = exc.details
+            for key in ['writeErrors', 'writeConcernErrors']:
+                errors = details.get(key) or []
+                if not len(errors):
+                    continue
+                self.stats['errors'] += len(errors)
+                logger.warning('{} {} in {}, first: {}'.format(
+                    len(errors), key, coll_name, errors[0].get('errmsg'),
+                ))
+        upserted = details.get('nUpserted', 0)
+        modified = details.get('nModified', 0)
+        self.stats['upserted'] += upserted
+        self.stats['modified'] += modified
+        update_count = upserted + modified
+        await self.log_db_update(coll_name, update_count, batch['repo_slugs'])
+    async def log_db_update(self, coll_name, update_count, repo_slugs):
+        if not update_count:
+            return
+        coll = self.db_store.get_collection(traffic.ApiObject._log_collection_name)
+        update = {
+            '$inc':{
+                'total_updates':update_count,
+                'collection_updates.{}'.format(coll_name):update_count,
+            },
+            '$addToSet':{'repo_slugs':{'$each':sorted(repo_slugs)}},
+        }
+        await coll.update_one({'log_timestamp':self.log_timestamp}, update, upsert=True)
+    async def import_file(self, filename):
+        start_ts = time.perf_counter()
+        num_records = 0
+        for record in iter_records(filename):
+            num_records += 1
+            ops = self.mapper.map_record(record)
+            if ops is None:
+                self.stats['skipped'] += 1
+                continue
+            await self.add_ops(ops)
+        self.stats['records'] += num_records
+        elapsed = time.perf_counter() - start_ts
+        logger.info('{}: {} records in {:.1f}s'.format(filename, num_records, elapsed))
+        return num_records
+    async def run(self, filenames):
+        if not self.dry_run:
+            await ensure_indexes(self.db_store)
+        start_ts = time.perf_counter()
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.num_workers)]
+        workers = [asyncio.ensure_future(self.worker(queue)) for queue in self.queues]
+        try:
+            for filename in filenames:
+                await self.import_file(filename)
+            await self.add_ops(self.mapper.finish())
+            await self.flush_buffers()
+        finally:
+            for queue in self.queues:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        if self.error is not None:
+            raise self.error
+        if not self.dry_run:
+            coll = self.db_store.get_collection(traffic.ApiObject._log_collection_name)
+            await coll.update_one(
+                {'log_timestamp':self.log_timestamp},
+                {'$set':{'completed':True}},
+            )
+        self.stats['elapsed'] = time.perf_counter() - start_ts
+        return self.stats
+
+
+def log_stats(stats):
+    elapsed = stats['elapsed']
+    logger.info('{} records ({} skipped) in {:.1f}s, {:.0f} records/s'.format(
+        stats['records'], stats['skipped'], elapsed, stats['records'] / max(elapsed, 1e-9),
+    ))
+    for coll_name, count in sorted(stats['ops'].items()):
+        logger.info('{}: {} upserts'.format(coll_name, count))
+    logger.info('{} inserted, {} modified, {} errors'.format(
+        stats['upserted'], stats['modified'], stats['errors'],
+    ))
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Load recorded API responses into MongoDB with unordered bulk upserts',
+    )
+    p.add_argument(
+        'filenames', nargs='+', metavar='FILE',
+        help='request_data.log files or archives written by ghstats-collect --record. '
+             'Log entries carry no timestamp, so each collection run in a log is dated '
+             'by the newest day in its view timelines',
+    )
+    p.add_argument(
+        '--workers', dest='num_workers', type=int, default=BackfillImporter.NUM_WORKERS,
+        help='Concurrent bulk writers; each repo is always written by the same one '
+             '(default: %(default)s)',
+    )
+    p.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=BackfillImporter.BATCH_SIZE,
+        help='Operations per bulk write (default: %(default)s)',
+    )
+    p.add_argument(
+        '--dry-run', dest='dry_run', action='store_true',
+        help='Parse and map the records without writing anything',
+    )
+    p.add_argument('--db-config', dest='db_config', default=DB_CONF_FILENAME)
+    p.add_argument('--log-level', dest='log_level', default='INFO')
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    db_store = DbStore.from_conf(args.db_config)
+    importer = BackfillImporter(
+        db_store,
+        num_workers=args.num_workers,
+        batch_size=args.batch_size,
+        dry_run=args.dry_run,
+    )
+    loop = asyncio.get_event_loop()
+    stats = loop.run_until_complete(importer.run(args.filenames))
+    log_stats(stats)
+    if stats['errors']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
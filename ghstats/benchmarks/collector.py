@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import subprocess
+
+import yaml
+
+from ghstats import utils
+from ghstats.requests import RequestHandler
+from ghstats.transport import AiohttpTransport
+from ghstats.fakeapi import FakeApi
+from ghstats.benchmarks.memstore import CountingDbStore
+from ghstats.benchmarks.utils import get_peak_rss_mb, parse_mongo_address, start_app
+
+logger = logging.getLogger(__name__)
+
+SIZES = [10, 100, 1000, 10000]
+
+BUDGET_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.yaml')
+
+RESULT_FIELDS = [
+    ('num_repos', 'repos', '{:d}'),
+    ('wall_time', 'wall (s)', '{:.2f}'),
+    ('http_requests', 'http', '{:d}'),
+    ('db_round_trips', 'db', '{:d}'),
+    ('peak_rss_mb', 'rss (MB)', '{:.1f}'),
+    ('requests_per_sec', 'req/s', '{:.1f}'),
+]
+
+
+class CountingTransport(AiohttpTransport):
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = AiohttpTransport()
+        self.transport = transport
+        self.count = 0
+        self.status_counts = {}
+    async def send(self, session, verb, url, **req_kwargs):
+        self.count += 1
+        status_code, headers, resp_data = await self.transport.send(
+            session, verb, url, **req_kwargs
+        )
+        key = str(status_code)
+        self.status_counts[key] = self.status_counts.get(key, 0) + 1
+        return status_code, headers, resp_data
+    async def close(self):
+        await self.transport.close()
+
+
+async def run_collection(num_repos, **kwargs):
+    from ghstats.main import get_data
+    fake_api = FakeApi(
+        num_repos=num_repos,
+        latency=kwargs.get('latency', 0),
+        active_ratio=kwargs.get('active_ratio', .2),
+        seed=kwargs.get('seed', 0),
+        rate_limit=sys.maxsize,
+    )
+    runner, api_endpoint = await start_app(fake_api.create_app())
+    transport = CountingTransport()
+    rh = RequestHandler(api_endpoint=api_endpoint, transport=transport)
+    db_store = CountingDbStore(
+        in_memory=kwargs.get('in_memory', True),
+        hostname=kwargs.get('hostname', CountingDbStore.HOSTNAME),
+        hostport=kwargs.get('hostport', CountingDbStore.HOSTPORT),
+    )
+    await db_store.drop()
+    db_store.counter.reset()
+    try:
+        start_ts = time.perf_counter()
+        async with rh:
+            all_repos = await get_data(request_handler=rh, db_store=db_store)
+        wall_time = time.perf_counter() - start_ts
+    finally:
+        await runner.cleanup()
+        await db_store.drop()
+    return {
+        'num_repos':num_repos,
+        'collected_repos':len(all_repos.repos),
+        'wall_time':wall_time,
+        'http_requests':transport.count,
+        'http_status':transport.status_counts,
+        'db_round_trips':db_store.counter.total,
+        'db_ops':db_store.counter.counts,
+        'peak_rss_mb':get_peak_rss_mb(),
+        'requests_per_sec':transport.count / wall_time,
+    }
+
+def run_child(args):
+    utils.setup_logging(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(run_collection(
+        args.size,
+        latency=args.latency,
+        active_ratio=args.active_ratio,
+        seed=args.seed,
+        in_memory=args.mongo is None,
+        **parse_mongo_address(args.mongo)
+    ))
+    sys.stdout.write(json.dumps(result))
+    sys.stdout.write('\n')
+
+def run_size(num_repos, args):
+    cmd = [
+        sys.executable, '-m', 'ghstats.benchmarks.collector', '--child',
+        '--size', str(num_repos),
+        '--latency', str(args.latency),
+        '--active-ratio', str(args.active_ratio),
+        '--seed', str(args.seed),
+    ]
+    if args.mongo is not None:
+        cmd.extend(['--mongo', args.mongo])
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    lines = p.stdout.decode('utf-8').strip().splitlines()
+    return json.loads(lines[-1])
+
+def load_budgets(filename):
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        data = yaml.safe_load(f)
+    if not data:
+        return {}
+    return {int(k):v for k, v in data.get('collector', {}).items()}
+
+def check_budgets(result, budgets):
+    budget = budgets.get(result['num_repos'])
+    if not budget:
+        return []
+    errors = []
+    for key, limit in budget.items():
+        if key.startswith('min_'):
+            value = result[key[4:]]
+            if value < limit:
+                errors.append('{} {:.2f} is below the budget of {}'.format(key[4:], value, limit))
+        else:
+            value = result[key]
+            if value > limit:
+                errors.append('{} {:.2f} exceeds the budget of {}'.format(key, value, limit))
+    return errors
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Benchmark a full collection run against a local API stand-in',
+    )
+    p.add_argument(
+        '--sizes', dest='sizes', type=int, nargs='+', default=SIZES,
+        help='Numbers of synthetic repos to collect (default: %(default)s)',
+    )
+    p.add_argument(
+        '--budgets', dest='budgets', default=BUDGET_FILENAME,
+        help='YAML file of per-size budgets (default: %(default)s)',
+    )
+    p.add_argument(
+        '--no-budgets', dest='budgets', action='store_const', const=None,
+        help='Report results without checking budgets',
+    )
+    p.add_argument(
+        '--mongo', dest='mongo', default=None, metavar='HOST[:PORT]',
+        help='Store into a MongoDB server instead of the in-memory store. The '
+             '"{}" database is dropped before and after each run'.format(CountingDbStore.DB_NAME),
+    )
+    p.add_argument(
+        '--latency', dest='latency', type=float, default=0,
+        help='Seconds of simulated latency per API request (default: %(default)s)',
+    )
+    p.add_argument('--active-ratio', dest='active_ratio', type=float, default=.2)
+    p.add_argument('--seed', dest='seed', type=int, default=0)
+    p.add_argument(
+        '--output', dest='output', default=None,
+        help='Write the full results, including per-collection DB ops, to this JSON file',
+    )
+    p.add_argument('--child', dest='child', action='store_true', help=argparse.SUPPRESS)
+    p.add_argument('--size', dest='size', type=int, help=argparse.SUPPRESS)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        return run_child(args)
+    utils.setup_logging()
+    budgets = load_budgets(args.budgets)
+    results = []
+    errors = []
+    for num_repos in args.sizes:
+        logger.info('Collecting {} synthetic repos...'.format(num_repos))
+        result = run_size(num_repos, args)
+        results.append(result)
+        for error in check_budgets(result, budgets):
+            errors.append('{} repos: {}'.format(num_repos, error))
+    print(utils.format_table(results, RESULT_FIELDS))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if len(errors):
+        print('')
+        print('Budgets exceeded:')
+        for error in errors:
+            print('    {}'.format(error))
+        sys.exit(1)
+    return results
+
+if __name__ == '__main__':
+    main()
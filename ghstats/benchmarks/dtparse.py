@@ -0,0 +1,128 @@
+import copy
+import json
+import time
+import argparse
+import datetime
+
+from ghstats import utils
+from ghstats.traffic import AllRepos, RepoTrafficViews
+from ghstats.fakeapi import FakeRepo
+
+URL_KEYS = [
+    'archive_url', 'assignees_url', 'blobs_url', 'branches_url', 'collaborators_url',
+    'comments_url', 'commits_url', 'compare_url', 'contents_url', 'contributors_url',
+    'deployments_url', 'downloads_url', 'events_url', 'forks_url', 'git_commits_url',
+    'git_refs_url', 'git_tags_url', 'hooks_url', 'issue_comment_url', 'issue_events_url',
+    'issues_url', 'keys_url', 'labels_url', 'languages_url', 'merges_url', 'milestones_url',
+    'notifications_url', 'pulls_url', 'releases_url', 'stargazers_url', 'statuses_url',
+    'subscribers_url', 'subscription_url', 'tags_url', 'teams_url', 'trees_url',
+]
+
+RESULT_FIELDS = [
+    ('payload', 'payload', '{}'),
+    ('parser', 'parser', '{}'),
+    ('usec', 'usec/call', '{:.1f}'),
+    ('speedup', 'speedup', '{:.1f}x'),
+]
+
+
+def legacy_iter_parse_datetimes(o):
+    if isinstance(o, dict):
+        o_iter = o.items()
+    elif isinstance(o, list):
+        o_iter = enumerate(o)
+    else:
+        return o
+    for key, val in o_iter:
+        if type(val) in (list, dict):
+            o[key] = legacy_iter_parse_datetimes(val)
+            continue
+        if not utils.is_dt_str(val):
+            continue
+        dt = datetime.datetime.strptime(val, utils.DT_FMT)
+        o[key] = utils.UTC.localize(dt)
+    return o
+
+def build_repo_page(num_repos, today):
+    created = today - datetime.timedelta(days=365)
+    page = []
+    for i in range(num_repos):
+        repo = FakeRepo(i, 'fakeuser', 0, True)
+        data = repo.get_repo_data(created + datetime.timedelta(minutes=i))
+        base_url = 'https://api.github.com/repos/{}'.format(repo.repo_slug)
+        for key in URL_KEYS:
+            data[key] = '{}/{}'.format(base_url, key[:-4])
+        data['owner'].update({
+            'avatar_url':'https://avatars.githubusercontent.com/u/1?v=4',
+            'gravatar_id':'',
+            'html_url':'https://github.com/fakeuser',
+            'site_admin':False,
+        })
+        data['license'] = {'key':'mit', 'name':'MIT License', 'spdx_id':'MIT'}
+        data['permissions'] = {'admin':True, 'push':True, 'pull':True}
+        data['topics'] = ['python', 'asyncio', 'github-api']
+        page.append(data)
+    return page
+
+def build_payloads(today):
+    views = FakeRepo(0, 'fakeuser', 0, True).get_views(today)
+    return [
+        ('user/repos', build_repo_page(100, today), AllRepos._response_dt_keys),
+        ('traffic/views', views, RepoTrafficViews._response_dt_keys),
+    ]
+
+def time_parser(fn, payload, number):
+    copies = [copy.deepcopy(payload) for _ in range(number)]
+    start_ts = time.perf_counter()
+    for data in copies:
+        fn(data)
+    return (time.perf_counter() - start_ts) / number * 1e6
+
+def run(number):
+    today = utils.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    results = []
+    for name, payload, dt_keys in build_payloads(today):
+        expected = legacy_iter_parse_datetimes(copy.deepcopy(payload))
+        parsers = [
+            ('legacy', legacy_iter_parse_datetimes),
+            ('fast', utils.iter_parse_datetimes),
+            ('fast+schema', lambda o: utils.iter_parse_datetimes(o, dt_keys)),
+        ]
+        baseline = None
+        for parser_name, fn in parsers:
+            if fn(copy.deepcopy(payload)) != expected:
+                raise Exception('{} parser output differs for {}'.format(parser_name, name))
+            utils.parse_iso_dt.cache_clear()
+            usec = time_parser(fn, payload, number)
+            if baseline is None:
+                baseline = usec
+            results.append({
+                'payload':name,
+                'parser':parser_name,
+                'usec':usec,
+                'speedup':baseline / usec,
+            })
+    return results
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Compare the legacy and fixed-format datetime parsers on API payloads',
+    )
+    p.add_argument(
+        '-n', '--number', dest='number', type=int, default=200,
+        help='Parses per payload and parser (default: %(default)s)',
+    )
+    p.add_argument('--output', dest='output', default=None)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args.number)
+    print(utils.format_table(results, RESULT_FIELDS))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import math
+import random
+import asyncio
+import argparse
+import datetime
+import logging
+
+from ghstats import utils
+from ghstats import traffic
+from ghstats import schema
+from ghstats.dbstore import DbStore
+from ghstats.benchmarks.utils import parse_mongo_address
+
+logger = logging.getLogger(__name__)
+
+PATH_NAMES = [
+    '', 'blob/master/README.md', 'issues', 'pulls', 'releases', 'wiki',
+    'tree/master/docs', 'blob/master/setup.py', 'commits/master', 'network/members',
+    'blob/master/LICENSE.txt', 'graphs/traffic', 'tags', 'stargazers',
+]
+
+REFERRER_NAMES = [
+    'github.com', 'google.com', 'pypi.org', 'news.ycombinator.com', 'reddit.com',
+    'stackoverflow.com', 'duckduckgo.com', 'bing.com', 'twitter.com', 'readthedocs.io',
+]
+
+
+class SyntheticRepo(object):
+    def __init__(self, index, owner, rand, num_days):
+        self.index = index
+        self.owner = owner
+        self.name = 'repo-{:04d}'.format(index)
+        self.rand = rand
+        self.num_days = num_days
+        self.popularity = rand.lognormvariate(2, 1.2)
+        self.unique_ratio = rand.uniform(.25, .6)
+        self.trend = rand.uniform(-.5, 1.5) / max(num_days, 1)
+        self.paths = rand.sample(PATH_NAMES, rand.randint(3, len(PATH_NAMES)))
+        self.referrers = rand.sample(REFERRER_NAMES, rand.randint(2, len(REFERRER_NAMES)))
+        self.daily = [self.build_day(i) for i in range(num_days)]
+    @property
+    def repo_slug(self):
+        return '{}/{}'.format(self.owner, self.name)
+    def build_day(self, i):
+        r = self.rand
+        level = self.popularity * max(.05, 1 + self.trend * i)
+        if i % 7 in (5, 6):
+            level *= .6
+        if r.random() < .01:
+            level *= r.uniform(5, 30)
+        count = int(r.expovariate(1 / level)) if level > 0 else 0
+        uniques = int(round(count * self.unique_ratio * r.uniform(.8, 1.2)))
+        return count, min(uniques, count)
+    def get_weights(self, names):
+        weights = [1 / (i + 1) ** 1.2 for i in range(len(names))]
+        total = sum(weights)
+        return [w / total for w in weights]
+    def get_repo_doc(self):
+        return {'owner':self.owner, 'name':self.name, 'repo_slug':self.repo_slug}
+
+
+class HistoryGenerator(object):
+    OWNER = 'synthetic'
+    NUM_REPOS = 500
+    NUM_DAYS = 3 * 365
+    WINDOW = 14
+    BATCH_SIZE = 1000
+    def __init__(self, **kwargs):
+        self.num_repos = kwargs.get('num_repos', self.NUM_REPOS)
+        self.num_days = kwargs.get('num_days', self.NUM_DAYS)
+        self.window = kwargs.get('window', self.WINDOW)
+        self.owner = kwargs.get('owner', self.OWNER)
+        self.seed = kwargs.get('seed', 0)
+        self.batch_size = kwargs.get('batch_size', self.BATCH_SIZE)
+        self.end_date = kwargs.get('end_date')
+        if self.end_date is None:
+            self.end_date = utils.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start_date = self.end_date - datetime.timedelta(days=self.num_days - 1)
+        self.counts = {}
+    def get_day(self, i):
+        return self.start_date + datetime.timedelta(days=i)
+    def iter_repos(self):
+        for i in range(self.num_repos):
+            rand = random.Random('{}:{}'.format(self.seed, i))
+            yield SyntheticRepo(i, self.owner, rand, self.num_days)
+    def iter_snapshot_docs(self, repo, i):
+        snapshot_dt = self.get_day(i) + datetime.timedelta(
+            hours=6, seconds=repo.rand.randint(0, 3600),
+        )
+        first = max(0, i - self.window + 1)
+        total_views = 0
+        total_uniques = 0
+        for j in range(first, i + 1):
+            count, uniques = repo.daily[j]
+            total_views += count
+            total_uniques += uniques
+            yield traffic.TrafficTimelineEntry._collection_name, {
+                'repo_slug':repo.repo_slug,
+                'count':count,
+                'uniques':uniques,
+                'timestamp':self.get_day(j),
+                'datetime':snapshot_dt,
+            }
+        yield traffic.RepoTrafficViews._collection_name, {
+            'repo_slug':repo.repo_slug,
+            'total_views':total_views,
+            'total_uniques':total_uniques,
+            'datetime':snapshot_dt,
+        }
+        weights = repo.get_weights(repo.paths)
+        for name, weight in zip(repo.paths, weights):
+            count = int(total_views * weight)
+            if not count:
+                continue
+            yield traffic.TrafficPathEntry._collection_name, {
+                'repo_slug':repo.repo_slug,
+                'datetime':snapshot_dt,
+                'path':'/{}/{}'.format(repo.repo_slug, name).rstrip('/'),
+                'title':name or repo.name,
+                'count':count,
+                'uniques':max(1, int(count * repo.unique_ratio)),
+            }
+        start_dt = self.get_day(i)
+        end_dt = start_dt + datetime.timedelta(days=1)
+        yield traffic.RepoTrafficReferrals._collection_name, {
+            'repo_slug':repo.repo_slug,
+            'start_datetime':start_dt,
+            'end_datetime':end_dt,
+            'is_complete':i < self.num_days - 1,
+        }
+        count, uniques = repo.daily[i]
+        weights = repo.get_weights(repo.referrers)
+        for name, weight in zip(repo.referrers, weights):
+            ref_count = int(math.ceil(count * weight * .5))
+            if not ref_count:
+                continue
+            yield traffic.TrafficReferrer._collection_name, {
+                'repo_slug':repo.repo_slug,
+                'start_datetime':start_dt,
+                'referrer':name,
+                'count':ref_count,
+                'uniques':max(1, int(ref_count * repo.unique_ratio)),
+            }
+    def iter_docs(self):
+        for repo in self.iter_repos():
+            yield traffic.Repo._collection_name, repo.get_repo_doc()
+            for i in range(self.num_days):
+                yield from self.iter_snapshot_docs(repo, i)
+    async def flush(self, db_store, coll_name, docs):
+        if not len(docs):
+            return
+        coll = db_store.get_collection(coll_name)
+        await coll.insert_many(docs, ordered=False)
+        self.counts[coll_name] = self.counts.get(coll_name, 0) + len(docs)
+    async def write(self, db_store, create_indexes=True):
+        buffers = {}
+        num_written = 0
+        for coll_name, doc in self.iter_docs():
+            buf = buffers.setdefault(coll_name, [])
+            buf.append(doc)
+            if len(buf) >= self.batch_size:
+                await self.flush(db_store, coll_name, buf)
+                buffers[coll_name] = []
+                num_written += len(buf)
+                if num_written % (self.batch_size * 100) == 0:
+                    logger.info('{} documents written'.format(num_written))
+        for coll_name, buf in buffers.items():
+            await self.flush(db_store, coll_name, buf)
+        if create_indexes:
+            await schema.ensure_indexes(db_store, force=True)
+        for coll_name, count in sorted(self.counts.items()):
+            logger.info('{}: {} documents'.format(coll_name, count))
+        return self.counts
+
+
+async def drop_collections(db_store):
+    coll_names = [
+        traffic.Repo._collection_name,
+        traffic.RepoTrafficViews._collection_name,
+        traffic.TrafficTimelineEntry._collection_name,
+        traffic.TrafficPathEntry._collection_name,
+        traffic.RepoTrafficReferrals._collection_name,
+        traffic.TrafficReferrer._collection_name,
+    ]
+    for coll_name in coll_names:
+        await db_store.db.drop_collection(coll_name)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Write synthetic traffic history for load testing the web app',
+    )
+    p.add_argument('--repos', dest='num_repos', type=int, default=HistoryGenerator.NUM_REPOS)
+    p.add_argument(
+        '--days', dest='num_days', type=int, default=HistoryGenerator.NUM_DAYS,
+        help='Days of daily snapshots to generate (default: %(default)s)',
+    )
+    p.add_argument(
+        '--window', dest='window', type=int, default=HistoryGenerator.WINDOW,
+        help='Days of timeline included in each snapshot (default: %(default)s)',
+    )
+    p.add_argument('--seed', dest='seed', type=int, default=0)
+    p.add_argument(
+        '--mongo', dest='mongo', default=None, metavar='HOST[:PORT]',
+    )
+    p.add_argument(
+        '--db-name', dest='db_name', default='ghstats_loadtest',
+        help='Database to write into. Its traffic collections are dropped first '
+             '(default: %(default)s)',
+    )
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging()
+    db_store = DbStore(db_name=args.db_name, **parse_mongo_address(args.mongo))
+    generator = HistoryGenerator(
+        num_repos=args.num_repos,
+        num_days=args.num_days,
+        window=args.window,
+        seed=args.seed,
+    )
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(drop_collections(db_store))
+    return loop.run_until_complete(generator.write(db_store))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import json
+import time
+import argparse
+import datetime
+
+import jsonfactory
+
+from ghstats import utils
+from ghstats import serialize
+from ghstats import traffic
+from ghstats.app.colorutils import iter_colors
+
+RESULT_FIELDS = [
+    ('payload', 'payload', '{}'),
+    ('op', 'op', '{}'),
+    ('encoder', 'encoder', '{}'),
+    ('usec', 'usec/call', '{:.1f}'),
+    ('speedup', 'speedup', '{:.1f}x'),
+]
+
+
+def build_repo(index, today, num_snapshots):
+    repo = traffic.Repo(owner='fakeuser', name='repo-{:05d}'.format(index))
+    repo.traffic_views = {}
+    repo.traffic_paths = {}
+    for i in range(num_snapshots):
+        dt = today - datetime.timedelta(days=i)
+        views = traffic.RepoTrafficViews(repo=repo, datetime=dt)
+        views.total_views = views.total_uniques = 0
+        for j in range(14):
+            entry = traffic.TrafficTimelineEntry(
+                traffic_view=views,
+                count=index + j,
+                uniques=j,
+                timestamp=dt - datetime.timedelta(days=13 - j),
+            )
+            views.timeline.append(entry)
+            views.total_views += entry.count
+            views.total_uniques += entry.uniques
+        repo.traffic_views[dt] = views
+        paths = traffic.RepoTrafficPaths(repo=repo, datetime=dt)
+        for j in range(5):
+            paths.data.append(traffic.TrafficPathEntry(
+                traffic_path=paths,
+                path='/{}/blob/master/file{}.py'.format(repo.repo_slug, j),
+                title='file{}.py'.format(j),
+                count=10 * j,
+                uniques=j,
+            ))
+        repo.traffic_paths[dt] = paths
+    return repo
+
+def build_all_repos(today, num_repos, num_snapshots):
+    all_repos = traffic.AllRepos()
+    for i in range(num_repos):
+        repo = build_repo(i, today, num_snapshots)
+        all_repos.repos[repo.api_path] = repo
+    return all_repos
+
+def build_chart_datasets(today, num_repos, num_days):
+    colors = iter_colors()
+    datasets = []
+    for i in range(num_repos):
+        color = next(colors)
+        datasets.append({
+            'label':'fakeuser/repo-{:05d} Total'.format(i),
+            'fill':False,
+            'backgroundColor':color,
+            'borderColor':color,
+            'lineTension':0,
+            'spanGaps':True,
+            'hidden':False,
+            'data':[
+                {'t':today - datetime.timedelta(days=j), 'y':i + j}
+                for j in range(num_days)
+            ],
+        })
+    return datasets
+
+def time_call(fn, obj, number):
+    start_ts = time.perf_counter()
+    for _ in range(number):
+        fn(obj)
+    return (time.perf_counter() - start_ts) / number * 1e6
+
+def run(number, num_repos):
+    today = utils.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    payloads = [
+        ('AllRepos', build_all_repos(today, num_repos, 7)),
+        ('chart datasets', build_chart_datasets(today, num_repos, 365)),
+    ]
+    dumps_encoder = 'orjson' if serialize.orjson is not None else 'json'
+    results = []
+    for name, obj in payloads:
+        fast_s = serialize.dumps(obj)
+        legacy_s = jsonfactory.dumps(obj)
+        if serialize.loads(fast_s) != jsonfactory.loads(legacy_s):
+            raise Exception('Serialized output differs for {}'.format(name))
+        if serialize.loads(legacy_s) != jsonfactory.loads(fast_s):
+            raise Exception('Round trip differs for {}'.format(name))
+        ops = [
+            ('dumps', jsonfactory.dumps, serialize.dumps, obj, dumps_encoder),
+            ('loads', jsonfactory.loads, serialize.loads, legacy_s, 'json'),
+        ]
+        for op, legacy_fn, fast_fn, arg, encoder in ops:
+            baseline = time_call(legacy_fn, arg, number)
+            usec = time_call(fast_fn, arg, number)
+            results.extend([
+                {'payload':name, 'op':op, 'encoder':'jsonfactory', 'usec':baseline, 'speedup':1.},
+                {'payload':name, 'op':op, 'encoder':encoder, 'usec':usec, 'speedup':baseline / usec},
+            ])
+    return results
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Compare jsonfactory and ghstats.serialize on ApiObject graphs and chart data',
+    )
+    p.add_argument(
+        '-n', '--number', dest='number', type=int, default=20,
+        help='Calls per payload and encoder (default: %(default)s)',
+    )
+    p.add_argument('--repos', dest='num_repos', type=int, default=50)
+    p.add_argument('--output', dest='output', default=None)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args.number, args.num_repos)
+    print(utils.format_table(results, RESULT_FIELDS))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,642 @@
+import copy
+import datetime
+
+import pymongo
+from pymongo.results import (
+    InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult,
+)
+from bson import ObjectId
+
+from ghstats import utils
+from ghstats.dbstore import DbStore
+
+MISSING = object()
+
+CURSOR_METHODS = ['find', 'aggregate', 'list_indexes']
+
+
+def to_bson(value):
+    if isinstance(value, dict):
+        return {k:to_bson(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_bson(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=utils.UTC)
+        else:
+            value = value.astimezone(utils.UTC)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+def get_field(doc, key):
+    value = doc
+    for part in key.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+def get_parent(doc, key, create=True):
+    parts = key.split('.')
+    for part in parts[:-1]:
+        if create:
+            doc = doc.setdefault(part, {})
+        else:
+            doc = doc.get(part, {})
+    return doc, parts[-1]
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _compare(op):
+    def cmp(value, arg):
+        if value is MISSING or value is None:
+            return False
+        try:
+            return op(value, arg)
+        except TypeError:
+            return False
+    return cmp
+
+def _in(value, arg):
+    if isinstance(value, list):
+        return any([v in arg for v in value])
+    if value is MISSING:
+        value = None
+    return value in arg
+
+OPERATORS = {
+    '$eq':lambda value, arg:match_value(value, arg),
+    '$ne':lambda value, arg:not match_value(value, arg),
+    '$gt':_compare(lambda a, b:a > b),
+    '$gte':_compare(lambda a, b:a >= b),
+    '$lt':_compare(lambda a, b:a < b),
+    '$lte':_compare(lambda a, b:a <= b),
+    '$in':_in,
+    '$nin':lambda value, arg:not _in(value, arg),
+    '$exists':lambda value, arg:(value is not MISSING) == bool(arg),
+}
+
+def is_operator_dict(cond):
+    return isinstance(cond, dict) and len(cond) and all([k.startswith('$') for k in cond])
+
+def match_value(value, cond):
+    if is_operator_dict(cond):
+        for op, arg in cond.items():
+            if not OPERATORS[op](value, arg):
+                return False
+        return True
+    if value is MISSING:
+        return cond is None
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return value == cond
+
+def match_filter(doc, filt):
+    for key, cond in filt.items():
+        if key == '$and':
+            if not all([match_filter(doc, f) for f in cond]):
+                return False
+        elif key == '$or':
+            if not any([match_filter(doc, f) for f in cond]):
+                return False
+        elif key == '$nor':
+            if any([match_filter(doc, f) for f in cond]):
+                return False
+        elif not match_value(get_field(doc, key), cond):
+            return False
+    return True
+
+def apply_projection(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {k:True for k in projection}
+    include = [k for k, v in projection.items() if v and k != '_id']
+    if len(include):
+        result = {}
+        if projection.get('_id', True) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for key in include:
+            value = get_field(doc, key)
+            if value is MISSING:
+                continue
+            parent, name = get_parent(result, key)
+            parent[name] = copy.deepcopy(value)
+        return result
+    result = copy.deepcopy(doc)
+    for key, value in projection.items():
+        if not value:
+            parent, name = get_parent(result, key, create=False)
+            parent.pop(name, None)
+    return result
+
+def sort_docs(docs, sort):
+    if not sort:
+        return docs
+    if isinstance(sort, str):
+        sort = [(sort, pymongo.ASCENDING)]
+    for key, direction in reversed(list(sort)):
+        def sort_key(doc):
+            value = get_field(doc, key)
+            if value is MISSING or value is None:
+                return (0, 0)
+            return (1, value)
+        docs.sort(key=sort_key, reverse=direction == pymongo.DESCENDING)
+    return docs
+
+def build_upsert_doc(filt):
+    doc = {}
+    for key, cond in filt.items():
+        if key.startswith('$') or is_operator_dict(cond):
+            continue
+        parent, name = get_parent(doc, key)
+        parent[name] = copy.deepcopy(cond)
+    return doc
+
+def apply_update(doc, update, is_insert=False):
+    if not any([k.startswith('$') for k in update]):
+        _id = doc.get('_id')
+        changed = {k:v for k, v in doc.items() if k != '_id'} != update
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return changed
+    changed = False
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not is_insert:
+            continue
+        for key, value in fields.items():
+            parent, name = get_parent(doc, key)
+            current = parent.get(name, MISSING)
+            if op in ['$set', '$setOnInsert']:
+                if current == value:
+                    continue
+                parent[name] = copy.deepcopy(value)
+            elif op == '$unset':
+                if current is MISSING:
+                    continue
+                del parent[name]
+            elif op == '$inc':
+                if current is MISSING:
+                    current = 0
+                elif not value:
+                    continue
+                parent[name] = current + value
+            elif op == '$max':
+                if current is not MISSING and value <= current:
+                    continue
+                parent[name] = value
+            elif op == '$min':
+                if current is not MISSING and value >= current:
+                    continue
+                parent[name] = value
+            elif op in ['$addToSet', '$push']:
+                lst = parent.setdefault(name, [])
+                if isinstance(value, dict) and '$each' in value:
+                    values = value['$each']
+                else:
+                    values = [value]
+                values = [v for v in values if op == '$push' or v not in lst]
+                if not len(values):
+                    continue
+                lst.extend(copy.deepcopy(values))
+            else:
+                raise NotImplementedError('Update operator {} is not supported'.format(op))
+            changed = True
+    return changed
+
+
+def eval_expression(doc, expr):
+    if isinstance(expr, str) and expr.startswith('$'):
+        value = get_field(doc, expr[1:])
+        return None if value is MISSING else value
+    if isinstance(expr, dict):
+        return {k:eval_expression(doc, v) for k, v in expr.items()}
+    return expr
+
+def _accumulate_sum(values):
+    return sum([v for v in values if isinstance(v, (int, float))])
+
+def _accumulate_avg(values):
+    values = [v for v in values if isinstance(v, (int, float))]
+    if not len(values):
+        return None
+    return sum(values) / len(values)
+
+def _accumulate_max(values):
+    values = [v for v in values if v is not None]
+    return max(values) if len(values) else None
+
+def _accumulate_min(values):
+    values = [v for v in values if v is not None]
+    return min(values) if len(values) else None
+
+def _accumulate_add_to_set(values):
+    result = []
+    for v in values:
+        if v not in result:
+            result.append(v)
+    return result
+
+ACCUMULATORS = {
+    '$sum':_accumulate_sum,
+    '$avg':_accumulate_avg,
+    '$max':_accumulate_max,
+    '$min':_accumulate_min,
+    '$first':lambda values:values[0] if len(values) else None,
+    '$last':lambda values:values[-1] if len(values) else None,
+    '$push':list,
+    '$addToSet':_accumulate_add_to_set,
+}
+
+def group_docs(docs, spec):
+    groups = {}
+    for doc in docs:
+        key = eval_expression(doc, spec['_id'])
+        hkey = repr(key)
+        group = groups.get(hkey)
+        if group is None:
+            group = groups[hkey] = {'_id':key, 'docs':[]}
+        group['docs'].append(doc)
+    results = []
+    for group in groups.values():
+        result = {'_id':group['_id']}
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            (op, expr), = acc.items()
+            values = [eval_expression(doc, expr) for doc in group['docs']]
+            result[field] = ACCUMULATORS[op](values)
+        results.append(result)
+    return results
+
+def run_pipeline(docs, pipeline):
+    docs = list(docs)
+    for stage in pipeline:
+        (op, arg), = stage.items()
+        if op == '$match':
+            arg = to_bson(arg)
+            docs = [doc for doc in docs if match_filter(doc, arg)]
+        elif op == '$group':
+            docs = group_docs(docs, arg)
+        elif op == '$sort':
+            docs = sort_docs(docs, list(arg.items()))
+        elif op == '$skip':
+            docs = docs[arg:]
+        elif op == '$limit':
+            docs = docs[:arg]
+        elif op == '$project':
+            docs = [apply_projection(doc, arg) for doc in docs]
+        elif op == '$count':
+            docs = [{arg:len(docs)}]
+        else:
+            raise NotImplementedError('Aggregation stage {} is not supported'.format(op))
+    return docs
+
+
+class MemoryCursor(object):
+    def __init__(self, docs, projection=None):
+        self.docs = docs
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._iter = None
+    def sort(self, key, direction=pymongo.ASCENDING):
+        if isinstance(key, str):
+            key = [(key, direction)]
+        self._sort = key
+        return self
+    def skip(self, skip):
+        self._skip = skip
+        return self
+    def limit(self, limit):
+        self._limit = limit
+        return self
+    def batch_size(self, batch_size):
+        return self
+    def _get_docs(self):
+        docs = sort_docs(list(self.docs), self._sort)[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [apply_projection(doc, self.projection) for doc in docs]
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        if self._iter is None:
+            self._iter = iter(self._get_docs())
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+    async def to_list(self, length=None):
+        docs = self._get_docs()
+        if length:
+            docs = docs[:length]
+        return docs
+
+
+class MemoryCollection(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.indexes = {}
+        self.index_names = ['_id_']
+    @staticmethod
+    def _get_index_value(doc, key):
+        value = get_field(doc, key)
+        if not is_hashable(value):
+            return MISSING
+        return value
+    def _index_add(self, doc):
+        for key, index in self.indexes.items():
+            value = self._get_index_value(doc, key)
+            index.setdefault(value, {})[doc['_id']] = doc
+    def _index_remove(self, doc):
+        for key, index in self.indexes.items():
+            bucket = index.get(self._get_index_value(doc, key))
+            if bucket is not None:
+                bucket.pop(doc['_id'], None)
+    def _build_index(self, key):
+        index = self.indexes[key] = {}
+        for doc in self.docs.values():
+            value = self._get_index_value(doc, key)
+            index.setdefault(value, {})[doc['_id']] = doc
+    def _iter_candidates(self, filt):
+        keys = [
+            k for k, v in filt.items()
+            if not k.startswith('$') and not isinstance(v, (dict, list)) and is_hashable(v)
+        ]
+        if not len(keys):
+            return list(self.docs.values())
+        if '_id' in keys:
+            doc = self.docs.get(filt['_id'])
+            return [] if doc is None else [doc]
+        buckets = None
+        for key in keys:
+            if key not in self.indexes:
+                self._build_index(key)
+            index = self.indexes[key]
+            _buckets = [index.get(filt[key], {}), index.get(MISSING, {})]
+            if buckets is None or sum(map(len, _buckets)) < sum(map(len, buckets)):
+                buckets = _buckets
+        return [doc for bucket in buckets for doc in bucket.values()]
+    def _find(self, filt=None, sort=None):
+        filt = to_bson(filt or {})
+        docs = [doc for doc in self._iter_candidates(filt) if match_filter(doc, filt)]
+        return sort_docs(docs, sort)
+    def _insert(self, doc):
+        doc = to_bson(doc)
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        if doc['_id'] in self.docs:
+            raise pymongo.errors.DuplicateKeyError('E11000 duplicate key error')
+        self.docs[doc['_id']] = doc
+        self._index_add(doc)
+        return doc
+    def _update(self, filt, update, upsert=False, multi=False, sort=None, keep_before=False):
+        update = to_bson(update)
+        docs = self._find(filt, sort)
+        if not multi:
+            docs = docs[:1]
+        result = {'n':0, 'nModified':0, 'upserted':None, 'docs':[]}
+        if not len(docs):
+            if not upsert:
+                return result
+            doc = build_upsert_doc(to_bson(filt))
+            apply_update(doc, update, is_insert=True)
+            doc = self._insert(doc)
+            result['n'] = 1
+            result['upserted'] = doc['_id']
+            result['docs'].append((None, doc))
+            return result
+        for doc in docs:
+            before = copy.deepcopy(doc) if keep_before else None
+            self._index_remove(doc)
+            if apply_update(doc, update):
+                result['nModified'] += 1
+            self._index_add(doc)
+            result['n'] += 1
+            result['docs'].append((before, doc))
+        return result
+    def _update_result(self, result):
+        raw = {
+            'n':result['n'],
+            'nModified':result['nModified'],
+            'updatedExisting':result['upserted'] is None and result['n'] > 0,
+        }
+        if result['upserted'] is not None:
+            raw['upserted'] = result['upserted']
+        return UpdateResult(raw, True)
+    def _delete(self, filt, multi=False):
+        docs = self._find(filt)
+        if not multi:
+            docs = docs[:1]
+        for doc in docs:
+            self._index_remove(doc)
+            del self.docs[doc['_id']]
+        return len(docs)
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, **kwargs):
+        cursor = MemoryCursor(self._find(filter), projection)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+    async def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        docs = self._find(filter, sort)
+        if not len(docs):
+            return None
+        return apply_projection(docs[0], projection)
+    async def insert_one(self, document, **kwargs):
+        doc = self._insert(document)
+        document.setdefault('_id', doc['_id'])
+        return InsertOneResult(doc['_id'], True)
+    async def insert_many(self, documents, ordered=True, **kwargs):
+        ids = []
+        for document in documents:
+            doc = self._insert(document)
+            document.setdefault('_id', doc['_id'])
+            ids.append(doc['_id'])
+        return InsertManyResult(ids, True)
+    async def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self._update_result(self._update(filter, replacement, upsert=upsert))
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(self._update(filter, update, upsert=upsert))
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(self._update(filter, update, upsert=upsert, multi=True))
+    async def find_one_and_update(self, filter, update, projection=None, sort=None,
+                                  upsert=False, return_document=False, **kwargs):
+        result = self._update(
+            filter, update, upsert=upsert, sort=sort, keep_before=not return_document,
+        )
+        if not len(result['docs']):
+            return None
+        before, after = result['docs'][0]
+        doc = after if return_document else before
+        if doc is None:
+            return None
+        return apply_projection(doc, projection)
+    async def delete_one(self, filter, **kwargs):
+        return DeleteResult({'n':self._delete(filter)}, True)
+    async def delete_many(self, filter, **kwargs):
+        return DeleteResult({'n':self._delete(filter, multi=True)}, True)
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        raw = {
+            'nInserted':0, 'nUpserted':0, 'nMatched':0, 'nModified':0,
+            'nRemoved':0, 'upserted':[], 'writeErrors':[], 'writeConcernErrors':[],
+        }
+        for i, op in enumerate(requests):
+            if isinstance(op, pymongo.InsertOne):
+                self._insert(op._doc)
+                raw['nInserted'] += 1
+                continue
+            if isinstance(op, (pymongo.DeleteOne, pymongo.DeleteMany)):
+                raw['nRemoved'] += self._delete(op._filter, isinstance(op, pymongo.DeleteMany))
+                continue
+            multi = isinstance(op, pymongo.UpdateMany)
+            result = self._update(op._filter, op._doc, upsert=op._upsert, multi=multi)
+            if result['upserted'] is not None:
+                raw['nUpserted'] += 1
+                raw['upserted'].append({'index':i, '_id':result['upserted']})
+            else:
+                raw['nMatched'] += result['n']
+                raw['nModified'] += result['nModified']
+        return BulkWriteResult(raw, True)
+    async def count_documents(self, filter, **kwargs):
+        return len(self._find(filter))
+    async def estimated_document_count(self, **kwargs):
+        return len(self.docs)
+    async def distinct(self, key, filter=None, **kwargs):
+        values = []
+        for doc in self._find(filter):
+            value = get_field(doc, key)
+            if value is MISSING:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            for v in value:
+                if v not in values:
+                    values.append(v)
+        return values
+    def aggregate(self, pipeline, **kwargs):
+        docs = self.docs.values()
+        if len(pipeline) and '$match' in pipeline[0]:
+            docs = self._find(pipeline[0]['$match'])
+            pipeline = pipeline[1:]
+        return MemoryCursor(run_pipeline(docs, pipeline))
+    def _add_index_name(self, name):
+        if name not in self.index_names:
+            self.index_names.append(name)
+        return name
+    async def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        name = kwargs.get('name', '_'.join(['{}_{}'.format(k, d) for k, d in keys]))
+        return self._add_index_name(name)
+    async def create_indexes(self, indexes, **kwargs):
+        return [self._add_index_name(index.document['name']) for index in indexes]
+    def list_indexes(self, **kwargs):
+        return MemoryCursor([{'name':name} for name in self.index_names])
+    async def drop_index(self, index_or_name, **kwargs):
+        self.index_names.remove(index_or_name)
+    async def drop(self):
+        self.docs = {}
+        self.indexes = {}
+        self.index_names = ['_id_']
+
+
+class MemoryDatabase(object):
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+    def __getitem__(self, name):
+        return self.get_collection(name)
+    def get_collection(self, name):
+        coll = self.collections.get(name)
+        if coll is None:
+            coll = self.collections[name] = MemoryCollection(name)
+        return coll
+    async def drop_collection(self, name):
+        self.collections.pop(name, None)
+    async def list_collection_names(self, **kwargs):
+        return list(self.collections.keys())
+
+
+class MemoryClient(object):
+    def __init__(self):
+        self.databases = {}
+    def __getitem__(self, name):
+        db = self.databases.get(name)
+        if db is None:
+            db = self.databases[name] = MemoryDatabase(name)
+        return db
+    async def drop_database(self, name):
+        self.databases.pop(name, None)
+    def close(self):
+        pass
+
+
+class OpCounter(object):
+    def __init__(self):
+        self.counts = {}
+    def add(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+    @property
+    def total(self):
+        return sum(self.counts.values())
+    def reset(self):
+        self.counts = {}
+
+
+class CountingCollection(object):
+    def __init__(self, collection, counter):
+        self.collection = collection
+        self.counter = counter
+    def __getattr__(self, attr):
+        value = getattr(self.collection, attr)
+        if not callable(value):
+            return value
+        name = '{}.{}'.format(self.collection.name, attr)
+        if attr in CURSOR_METHODS:
+            def call_cursor(*args, **kwargs):
+                self.counter.add(name)
+                return value(*args, **kwargs)
+            return call_cursor
+        async def call(*args, **kwargs):
+            self.counter.add(name)
+            return await value(*args, **kwargs)
+        return call
+
+
+class CountingDbStore(DbStore):
+    DB_NAME = 'ghstats_benchmark'
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_memory = kwargs.get('in_memory', False)
+        self.counter = kwargs.get('counter')
+        if self.counter is None:
+            self.counter = OpCounter()
+    @property
+    def client(self):
+        if not self.in_memory:
+            return super().client
+        c = self._client
+        if c is None:
+            c = self._client = MemoryClient()
+        return c
+    def get_collection(self, name):
+        coll = super().get_collection(name)
+        if isinstance(coll, CountingCollection):
+            return coll
+        return CountingCollection(coll, self.counter)
+    async def drop(self):
+        await self.client.drop_database(self.db_name)
+        self._db = None
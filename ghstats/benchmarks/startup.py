@@ -0,0 +1,128 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from ghstats.utils import format_table
+
+TARGETS = [
+    ('collect --help', ['-m', 'ghstats.main', '--help'], ['aiohttp', 'motor', 'pymongo', 'jinja2']),
+    (
+        'web --help', ['-m', 'ghstats.app.main', '--help'],
+        ['aiohttp', 'aiohttp_jinja2', 'jinja2', 'motor', 'pymongo'],
+    ),
+    ('export --help', ['-m', 'ghstats.export', '--help'], ['aiohttp', 'jinja2']),
+    ('snapshot --help', ['-m', 'ghstats.snapshot', '--help'], ['aiohttp', 'jinja2']),
+    ('import ghstats.main', ['-c', 'import ghstats.main'], ['aiohttp', 'pymongo', 'jinja2']),
+    ('import ghstats.metrics', ['-c', 'import ghstats.metrics'], ['pymongo', 'aiohttp']),
+    (
+        'merge imports',
+        ['-c', 'import ghstats.main, ghstats.dbstore, ghstats.leases'],
+        ['aiohttp', 'jinja2'],
+    ),
+]
+
+RESULT_FIELDS = [
+    ('target', 'target', '{}'),
+    ('wall_ms', 'wall ms', '{:.1f}'),
+    ('import_ms', 'import ms', '{:.1f}'),
+    ('num_modules', 'modules', '{:d}'),
+    ('heaviest', 'heaviest imports', '{}'),
+]
+
+
+def parse_importtime(text):
+    modules = {}
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = (int(parts[1]), depth)
+    return modules
+
+def get_top_packages(modules, count=3):
+    totals = {}
+    for name, (cumulative, depth) in modules.items():
+        pkg = name.split('.')[0]
+        if pkg == 'ghstats' or '.' in name:
+            continue
+        totals[pkg] = max(totals.get(pkg, 0), cumulative)
+    items = sorted(totals.items(), key=lambda item: -item[1])[:count]
+    return ', '.join(['{} {:.0f}'.format(pkg, usec / 1000) for pkg, usec in items])
+
+def run_target(argv):
+    cmd = [sys.executable, '-X', 'importtime'] + argv
+    start_ts = time.perf_counter()
+    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall_time = time.perf_counter() - start_ts
+    stderr = p.stderr.decode('utf-8')
+    if p.returncode != 0:
+        raise Exception('{} failed:\n{}'.format(' '.join(argv), stderr))
+    return wall_time, parse_importtime(stderr)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run(number, targets=None):
+    results = []
+    errors = []
+    for name, argv, forbidden in TARGETS:
+        if targets and name not in targets:
+            continue
+        run_target(argv)
+        wall_times = []
+        import_times = []
+        for _ in range(number):
+            wall_time, modules = run_target(argv)
+            wall_times.append(wall_time)
+            import_times.append(sum([usec for usec, depth in modules.values() if depth == 0]))
+        loaded = set([m.split('.')[0] for m in modules.keys()])
+        for pkg in forbidden:
+            if pkg in loaded:
+                errors.append('{} imports {}'.format(name, pkg))
+        results.append({
+            'target':name,
+            'wall_ms':median(wall_times) * 1000,
+            'import_ms':median(import_times) / 1000,
+            'num_modules':len(modules),
+            'heaviest':get_top_packages(modules),
+            'modules':sorted(modules.keys()),
+        })
+    return results, errors
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Measure cold-start import time of the ghstats entry points with -X importtime',
+    )
+    p.add_argument(
+        '-n', '--number', dest='number', type=int, default=5,
+        help='Runs per target after one warm-up run; the median is reported (default: %(default)s)',
+    )
+    p.add_argument(
+        'targets', nargs='*', metavar='TARGET',
+        help='Only run these targets, from: {}'.format(', '.join([t[0] for t in TARGETS])),
+    )
+    p.add_argument('--output', dest='output', default=None)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results, errors = run(args.number, args.targets)
+    print(format_table(results, RESULT_FIELDS))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if len(errors):
+        for error in errors:
+            print('FAIL: {}'.format(error))
+        sys.exit(1)
+    return results
+
+if __name__ == '__main__':
+    main()
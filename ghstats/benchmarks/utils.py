@@ -0,0 +1,35 @@
+import sys
+import resource
+
+from aiohttp import web
+
+
+def get_peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 / 1024
+    return rss / 1024
+
+def percentile(values, pct):
+    if not len(values):
+        return None
+    values = sorted(values)
+    index = int(round(pct / 100. * (len(values) - 1)))
+    return values[index]
+
+def parse_mongo_address(address):
+    if address is None:
+        return {}
+    hostname, _, hostport = address.partition(':')
+    d = {'hostname':hostname}
+    if hostport:
+        d['hostport'] = int(hostport)
+    return d
+
+async def start_app(app, host='127.0.0.1'):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, 'http://{}:{}'.format(host, port)
@@ -0,0 +1,249 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import logging
+import urllib.parse
+
+import aiohttp
+
+from ghstats import utils
+from ghstats.dbstore import DbStore
+from ghstats.benchmarks.history import HistoryGenerator
+from ghstats.benchmarks.memstore import CountingDbStore
+from ghstats.benchmarks.utils import percentile, parse_mongo_address, start_app
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_WEIGHTS = [
+    ('home', 1),
+    ('repo_detail', 2),
+    ('traffic_data', 4),
+    ('combined_data', 3),
+]
+
+DATE_RANGES = [7, 30, 90, 365, None]
+
+RESULT_FIELDS = [
+    ('endpoint', 'endpoint', '{}'),
+    ('requests', 'n', '{:d}'),
+    ('errors', 'errors', '{:d}'),
+    ('p50', 'p50 (ms)', '{:.1f}'),
+    ('p95', 'p95 (ms)', '{:.1f}'),
+    ('p99', 'p99 (ms)', '{:.1f}'),
+    ('mean_bytes', 'mean size', '{:.0f}'),
+    ('max_bytes', 'max size', '{:d}'),
+]
+
+
+class QueryMix(object):
+    def __init__(self, repo_slugs, **kwargs):
+        self.repo_slugs = repo_slugs
+        self.rand = random.Random(kwargs.get('seed', 0))
+        self.now = kwargs.get('now')
+        if self.now is None:
+            self.now = utils.now()
+        weights = kwargs.get('weights', ENDPOINT_WEIGHTS)
+        self.endpoints = [name for name, _ in weights]
+        self.weights = [weight for _, weight in weights]
+    def get_date_query(self):
+        days = self.rand.choice(DATE_RANGES)
+        if days is None:
+            return {}
+        start_dt = self.now - datetime.timedelta(days=days)
+        return {'start_datetime':utils.dt_to_str(start_dt)}
+    def get_repo_slug(self):
+        return self.rand.choice(self.repo_slugs)
+    def build_home(self):
+        return '/', {}
+    def build_repo_detail(self):
+        slug = urllib.parse.quote_plus(self.get_repo_slug())
+        return '/repos/detail/{}'.format(slug), self.get_date_query()
+    def build_traffic_data(self):
+        query = self.get_date_query()
+        query['data_metric'] = self.rand.choice(['count', 'uniques'])
+        query['limit'] = self.rand.choice([5, 10, 25])
+        return '/traffic-data/', query
+    def build_combined_data(self):
+        query = self.get_date_query()
+        query['repo_slugs'] = self.get_repo_slug()
+        return '/combined-data/', query
+    def next_request(self):
+        endpoint = self.rand.choices(self.endpoints, self.weights)[0]
+        path, query = getattr(self, 'build_{}'.format(endpoint))()
+        return endpoint, path, query
+
+
+class LoadDriver(object):
+    CONCURRENCY = 8
+    NUM_REQUESTS = 200
+    def __init__(self, base_url, query_mix, **kwargs):
+        self.base_url = base_url.rstrip('/')
+        self.query_mix = query_mix
+        self.concurrency = kwargs.get('concurrency', self.CONCURRENCY)
+        self.num_requests = kwargs.get('num_requests', self.NUM_REQUESTS)
+        self.duration = kwargs.get('duration')
+        self.samples = {}
+    def add_sample(self, endpoint, latency, size, error):
+        s = self.samples.setdefault(endpoint, {'latency':[], 'size':[], 'errors':0})
+        if error:
+            s['errors'] += 1
+        else:
+            s['latency'].append(latency)
+            s['size'].append(size)
+    async def send(self, session, endpoint, path, query):
+        start_ts = time.perf_counter()
+        error = False
+        size = 0
+        try:
+            async with session.get(self.base_url + path, params=query) as resp:
+                body = await resp.read()
+                size = len(body)
+                if resp.status != 200:
+                    error = True
+                    logger.warning('{} {}: status {}'.format(endpoint, path, resp.status))
+        except aiohttp.ClientError as exc:
+            error = True
+            logger.warning('{} {}: {!r}'.format(endpoint, path, exc))
+        latency = (time.perf_counter() - start_ts) * 1000
+        self.add_sample(endpoint, latency, size, error)
+    async def run(self):
+        self.samples = {}
+        num_sent = 0
+        start_ts = time.perf_counter()
+
+        def is_done():
+            if self.duration is not None:
+                return time.perf_counter() - start_ts >= self.duration
+            return num_sent >= self.num_requests
+
+        async def worker(session):
+            nonlocal num_sent
+            while not is_done():
+                num_sent += 1
+                await self.send(session, *self.query_mix.next_request())
+
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            await asyncio.gather(*[worker(session) for _ in range(self.concurrency)])
+        self.elapsed = time.perf_counter() - start_ts
+        return self.get_results()
+    def get_results(self):
+        results = []
+        for endpoint in self.query_mix.endpoints:
+            s = self.samples.get(endpoint)
+            if s is None:
+                continue
+            sizes = s['size']
+            results.append({
+                'endpoint':endpoint,
+                'requests':len(s['latency']) + s['errors'],
+                'errors':s['errors'],
+                'p50':percentile(s['latency'], 50) or 0,
+                'p95':percentile(s['latency'], 95) or 0,
+                'p99':percentile(s['latency'], 99) or 0,
+                'mean_bytes':sum(sizes) / len(sizes) if len(sizes) else 0,
+                'max_bytes':max(sizes) if len(sizes) else 0,
+            })
+        return results
+
+
+async def get_repo_slugs(db_store):
+    coll = db_store.get_collection('repos')
+    return [doc['repo_slug'] async for doc in coll.find({}, projection={'repo_slug':True})]
+
+async def run_load(args):
+    from ghstats.app.main import create_app
+    runner = None
+    if args.url is not None:
+        base_url = args.url
+        db_store = DbStore(db_name=args.db_name, **parse_mongo_address(args.mongo))
+    else:
+        if args.memory:
+            db_store = CountingDbStore(in_memory=True)
+            generator = HistoryGenerator(
+                num_repos=args.num_repos, num_days=args.num_days, seed=args.seed,
+            )
+            await generator.write(db_store)
+        else:
+            db_store = DbStore(db_name=args.db_name, **parse_mongo_address(args.mongo))
+        app = create_app(db_store=db_store)
+        runner, base_url = await start_app(app)
+    try:
+        repo_slugs = await get_repo_slugs(db_store)
+        if not len(repo_slugs):
+            raise Exception('No repos found, run ghstats.benchmarks.history first')
+        query_mix = QueryMix(repo_slugs, seed=args.seed)
+        driver = LoadDriver(
+            base_url, query_mix,
+            concurrency=args.concurrency,
+            num_requests=args.num_requests,
+            duration=args.duration,
+        )
+        results = await driver.run()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+    total = sum([r['requests'] for r in results])
+    logger.info('{} requests in {:.2f}s ({:.1f} req/s)'.format(
+        total, driver.elapsed, total / driver.elapsed,
+    ))
+    return results
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Send concurrent mixed queries to the web app and report latency per endpoint',
+    )
+    p.add_argument(
+        '--url', dest='url', default=None,
+        help='Base URL of a running ghstats-web server. By default the app is '
+             'served in-process',
+    )
+    p.add_argument('--mongo', dest='mongo', default=None, metavar='HOST[:PORT]')
+    p.add_argument(
+        '--db-name', dest='db_name', default='ghstats_loadtest',
+        help='Database written by ghstats.benchmarks.history (default: %(default)s)',
+    )
+    p.add_argument(
+        '--memory', dest='memory', action='store_true',
+        help='Generate a small history into the in-memory store instead of using MongoDB',
+    )
+    p.add_argument(
+        '--repos', dest='num_repos', type=int, default=20,
+        help='Repos generated with --memory (default: %(default)s)',
+    )
+    p.add_argument(
+        '--days', dest='num_days', type=int, default=90,
+        help='Days of history generated with --memory (default: %(default)s)',
+    )
+    p.add_argument('--concurrency', dest='concurrency', type=int, default=LoadDriver.CONCURRENCY)
+    p.add_argument(
+        '--requests', dest='num_requests', type=int, default=LoadDriver.NUM_REQUESTS,
+    )
+    p.add_argument(
+        '--duration', dest='duration', type=float, default=None,
+        help='Run for this many seconds instead of a fixed number of requests',
+    )
+    p.add_argument('--seed', dest='seed', type=int, default=0)
+    p.add_argument('--output', dest='output', default=None)
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging()
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_load(args))
+    print(utils.format_table(results, RESULT_FIELDS))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if any([r['errors'] for r in results]):
+        sys.exit(1)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import logging
+
+import pymongo
+
+from ghstats import utils
+
+logger = logging.getLogger(__name__)
+
+
+class RunCheckpoint(object):
+    _collection_name = 'collection_progress'
+    _log_collection_name = 'db_update_log'
+    def __init__(self, **kwargs):
+        self.db_store = kwargs.get('db_store')
+        self.log_timestamp = kwargs.get('log_timestamp')
+        if self.log_timestamp is None:
+            self.log_timestamp = utils.now()
+        self.completed = set()
+    @classmethod
+    async def create_indexes(cls, db_store):
+        coll = db_store.get_collection(cls._collection_name)
+        await coll.create_index([
+            ('log_timestamp', pymongo.ASCENDING),
+            ('repo_slug', pymongo.ASCENDING),
+        ], unique=True)
+    @classmethod
+    async def find_incomplete_run(cls, db_store):
+        coll = db_store.get_collection(cls._collection_name)
+        doc = await coll.find_one(
+            {}, sort=[('log_timestamp', pymongo.DESCENDING)],
+            projection={'_id':False, 'log_timestamp':True},
+        )
+        if doc is None:
+            return None
+        log_timestamp = doc['log_timestamp']
+        log_coll = db_store.get_collection(cls._log_collection_name)
+        log_doc = await log_coll.find_one(
+            {'log_timestamp':log_timestamp}, projection={'_id':False, 'completed':True},
+        )
+        if log_doc is not None and log_doc.get('completed'):
+            return None
+        return log_timestamp
+    @classmethod
+    async def create(cls, db_store, resume=False):
+        log_timestamp = None
+        if resume:
+            log_timestamp = await cls.find_incomplete_run(db_store)
+            if log_timestamp is None:
+                logger.info('No incomplete run found, starting a new one')
+            else:
+                logger.info('Resuming run {}'.format(log_timestamp))
+        obj = cls(db_store=db_store, log_timestamp=log_timestamp)
+        if resume:
+            await obj.load()
+        return obj
+    async def load(self):
+        filt = {'log_timestamp':self.log_timestamp, 'completed':True}
+        cursor = self.db_store.find_docs(
+            self._collection_name, filt, projection={'_id':False, 'repo_slug':True},
+        )
+        async for doc in cursor:
+            self.completed.add(doc['repo_slug'])
+        return self.completed
+    def is_complete(self, repo_slug):
+        return repo_slug in self.completed
+    async def _update_repo(self, repo_slug, doc):
+        coll = self.db_store.get_collection(self._collection_name)
+        filt = {'log_timestamp':self.log_timestamp, 'repo_slug':repo_slug}
+        doc['updated'] = utils.now()
+        await coll.update_one(filt, {'$set':doc}, upsert=True)
+    async def set_repo_complete(self, repo_slug):
+        await self._update_repo(repo_slug, {'completed':True, 'error':None})
+        self.completed.add(repo_slug)
+    async def set_repo_failed(self, repo_slug, exc):
+        await self._update_repo(repo_slug, {'completed':False, 'error':repr(exc)})
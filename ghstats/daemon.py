@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+from ghstats import utils
+from ghstats import defaults
+from ghstats import profiling
+from ghstats.traffic import AllRepos
+from ghstats.schema import ensure_indexes
+
+logger = logging.getLogger(__name__)
+
+
+class CollectorDaemon(object):
+    POLL_INTERVAL = defaults.POLL_INTERVAL
+    REPO_LIST_INTERVAL = defaults.REPO_LIST_INTERVAL
+    def __init__(self, **kwargs):
+        self.request_handler = kwargs.get('request_handler')
+        self.db_store = kwargs.get('db_store')
+        self.poll_interval = kwargs.get('poll_interval', self.POLL_INTERVAL)
+        self.repo_list_interval = kwargs.get('repo_list_interval', self.REPO_LIST_INTERVAL)
+        self.activity = kwargs.get('activity')
+        self.all_repos = AllRepos(
+            request_handler=self.request_handler,
+            db_store=self.db_store,
+            activity=self.activity,
+        )
+        self.repos_updated = None
+        self.log_timestamp = None
+        self.running = False
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+    async def run(self):
+        self.running = True
+        async with self.request_handler:
+            await ensure_indexes(self.db_store)
+            if self.activity is not None:
+                await self.activity.load()
+            while self.running:
+                await self.run_cycle()
+    def stop(self):
+        self.running = False
+    async def refresh_repos(self, force=False):
+        now = self.loop.time()
+        if not force and self.repos_updated is not None:
+            if now - self.repos_updated < self.repo_list_interval:
+                return False
+        await self.all_repos.get_repos()
+        self.repos_updated = now
+        logger.info('Repo list refreshed: {} repos'.format(len(self.all_repos.repos)))
+        return True
+    def get_cycle_repos(self):
+        return self.all_repos.get_due_repos()
+    async def run_cycle(self):
+        start_time = self.loop.time()
+        try:
+            await self.refresh_repos()
+        except Exception:
+            logger.exception('Error refreshing repo list')
+        repos = self.get_cycle_repos()
+        log_timestamp = self.log_timestamp = utils.now()
+        await self.all_repos.log_db_update(log_timestamp, 'repos', 0)
+        step = self.poll_interval / max(len(repos), 1)
+        tasks = []
+        for i, repo in enumerate(repos):
+            if not self.running:
+                break
+            delay = start_time + i * step - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            coro = self.all_repos.collect_repo(repo, log_timestamp)
+            tasks.append(asyncio.ensure_future(coro))
+        if len(tasks):
+            await asyncio.wait(tasks)
+        await self.all_repos.finish_db_update(log_timestamp)
+        await profiling.save_current(self.db_store, log_timestamp)
+        delay = start_time + self.poll_interval - self.loop.time()
+        if delay > 0 and self.running:
+            await asyncio.sleep(delay)
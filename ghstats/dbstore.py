@@ -1,22 +1,101 @@
-import motor.motor_asyncio
+import os
+import threading
+
+from pymongo import monitoring
+
+from ghstats import utils
+from ghstats import defaults
+from ghstats import metrics
+from ghstats import profiling
+
+CONF_FILENAME = defaults.DB_CONF_FILENAME
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+    def get_key(self, event):
+        return (event.connection_id, event.request_id)
+    def started(self, event):
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        else:
+            collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ''
+        with self.lock:
+            self.pending[self.get_key(event)] = collection
+    def _pop_collection(self, event):
+        with self.lock:
+            return self.pending.pop(self.get_key(event), '')
+    def succeeded(self, event):
+        collection = self._pop_collection(event)
+        metrics.MONGO_OP_DURATION.observe(
+            event.duration_micros / 1e6, collection=collection, op=event.command_name,
+        )
+        profiling.add('mongo_{}'.format(event.command_name), event.duration_micros / 1e6)
+    def failed(self, event):
+        collection = self._pop_collection(event)
+        metrics.MONGO_OP_DURATION.observe(
+            event.duration_micros / 1e6, collection=collection, op=event.command_name,
+        )
+        profiling.add('mongo_{}'.format(event.command_name), event.duration_micros / 1e6)
+        metrics.MONGO_OP_FAILURES.inc(collection=collection, op=event.command_name)
 
 
 class DbStore(object):
     HOSTNAME = '127.0.0.1'
     HOSTPORT = 27017
     DB_NAME = 'ghstats'
+    BATCH_SIZE = 1000
+    CLIENT_OPTIONS = {
+        'max_pool_size':'maxPoolSize',
+        'min_pool_size':'minPoolSize',
+        'max_idle_time_ms':'maxIdleTimeMS',
+        'compressors':'compressors',
+        'zlib_compression_level':'zlibCompressionLevel',
+        'read_preference':'readPreference',
+    }
     def __init__(self, **kwargs):
         self.hostname = kwargs.get('hostname', self.HOSTNAME)
         self.hostport = kwargs.get('hostport', self.HOSTPORT)
         self.db_name = kwargs.get('db_name', self.DB_NAME)
+        self.batch_size = kwargs.get('batch_size', self.BATCH_SIZE)
+        self.client_options = {}
+        for key, option in self.CLIENT_OPTIONS.items():
+            value = kwargs.get(key)
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = ','.join(value)
+            self.client_options[option] = value
         self._client = None
         self._db = None
+    @classmethod
+    def from_conf(cls, filename=CONF_FILENAME, section=None, **kwargs):
+        import yaml
+        data = {}
+        if filename is not None:
+            filename = os.path.expanduser(filename)
+            if os.path.exists(filename):
+                with open(filename, 'r') as f:
+                    data = yaml.safe_load(f) or {}
+        sections = {k:data.pop(k) for k in ['collector', 'web', 'export'] if k in data}
+        if section is not None:
+            data.update(sections.get(section) or {})
+        data.update(kwargs)
+        return cls(**data)
     @property
     def client(self):
         c = self._client
         if c is None:
+            import motor.motor_asyncio
             c = self._client = motor.motor_asyncio.AsyncIOMotorClient(
                 self.hostname, self.hostport,
+                tz_aware=True, tzinfo=utils.UTC,
+                event_listeners=[MongoCommandListener()],
+                **self.client_options
             )
         return c
     @property
@@ -30,6 +109,10 @@ class DbStore(object):
         if not isinstance(name, str):
             return name
         return self.db[name]
+    def find_docs(self, collection_name, filt=None, projection=None, **kwargs):
+        coll = self.get_collection(collection_name)
+        kwargs.setdefault('batch_size', self.batch_size)
+        return coll.find(filt, projection=projection, **kwargs)
     async def get_doc(self, collection_name, filt, *args, **kwargs):
         coll = self.get_collection(collection_name)
         return await coll.find_one(filt, *args, **kwargs)
@@ -38,14 +121,14 @@ class DbStore(object):
         return await coll.insert_one(doc)
     async def add_doc_if_missing(self, collection_name, filt, doc):
         coll = self.get_collection(collection_name)
-        existing = await coll.count(filt)
-        if existing:
+        existing = await coll.find_one(filt, projection={'_id':True})
+        if existing is not None:
             return False
         await coll.insert_one(doc)
         return True
     async def update_doc(self, collection_name, filt, doc):
         coll = self.get_collection(collection_name)
-        old_doc = await self.get_doc(collection_name, filt)
+        old_doc = await self.get_doc(collection_name, filt, projection={'_id':True})
         if old_doc is None:
             result = await self.add_doc(collection_name, doc)
             return True, result.inserted_id
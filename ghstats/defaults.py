@@ -0,0 +1,12 @@
+DB_CONF_FILENAME = '~/.ghstats-db.yaml'
+
+POLL_INTERVAL = 3600
+REPO_LIST_INTERVAL = 6 * 3600
+MAX_STALENESS = 2 * 86400
+
+LEASE_TIMEOUT = 600
+LEASE_BATCH_SIZE = 10
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+MAX_RETRIES = 3
@@ -0,0 +1,278 @@
+import os
+import sys
+import csv
+import json
+import asyncio
+import argparse
+import logging
+
+import pymongo
+
+from ghstats import utils
+from ghstats import traffic
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+
+EXPORT_TABLES = {
+    'timeline':{
+        'collection':traffic.TrafficTimelineEntry._collection_name,
+        'dt_field':'timestamp',
+        'sort':[('repo_slug', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+        'columns':[
+            ('repo_slug', 'string'),
+            ('timestamp', 'datetime'),
+            ('datetime', 'datetime'),
+            ('count', 'int'),
+            ('uniques', 'int'),
+        ],
+    },
+    'paths':{
+        'collection':traffic.TrafficPathEntry._collection_name,
+        'dt_field':'datetime',
+        'sort':[('repo_slug', pymongo.ASCENDING), ('datetime', pymongo.ASCENDING)],
+        'columns':[
+            ('repo_slug', 'string'),
+            ('datetime', 'datetime'),
+            ('path', 'string'),
+            ('title', 'string'),
+            ('count', 'int'),
+            ('uniques', 'int'),
+        ],
+    },
+    'referrers':{
+        'collection':traffic.TrafficReferrer._collection_name,
+        'dt_field':'start_datetime',
+        'sort':[('repo_slug', pymongo.ASCENDING), ('start_datetime', pymongo.ASCENDING)],
+        'columns':[
+            ('repo_slug', 'string'),
+            ('start_datetime', 'datetime'),
+            ('referrer', 'string'),
+            ('count', 'int'),
+            ('uniques', 'int'),
+        ],
+    },
+}
+
+
+def parse_date_arg(s):
+    if s is None:
+        return None
+    if len(s) == 10:
+        return utils.parse_dt(s, '%Y-%m-%d')
+    if not s.endswith('Z'):
+        s = '{}Z'.format(s)
+    return utils.parse_dt(s)
+
+def build_filter(table, **kwargs):
+    dt_field = EXPORT_TABLES[table]['dt_field']
+    filt = {}
+    dt_filt = {}
+    if kwargs.get('start_datetime') is not None:
+        dt_filt['$gte'] = kwargs['start_datetime']
+    if kwargs.get('end_datetime') is not None:
+        dt_filt['$lt'] = kwargs['end_datetime']
+    if len(dt_filt):
+        filt[dt_field] = dt_filt
+    repo_slugs = kwargs.get('repo_slugs')
+    if repo_slugs:
+        filt['repo_slug'] = {'$in':list(repo_slugs)}
+    return filt
+
+async def iter_table_docs(db_store, table, **kwargs):
+    info = EXPORT_TABLES[table]
+    projection = {name:True for name, _ in info['columns']}
+    projection['_id'] = False
+    cursor = db_store.find_docs(
+        info['collection'],
+        build_filter(table, **kwargs),
+        projection=projection,
+        sort=info['sort'],
+        batch_size=kwargs.get('batch_size', BATCH_SIZE),
+    )
+    async for doc in cursor:
+        yield doc
+
+
+class ExportWriter(object):
+    file_ext = None
+    def __init__(self, table, fp):
+        self.table = table
+        self.fp = fp
+        self.columns = EXPORT_TABLES[table]['columns']
+        self.column_names = [name for name, _ in self.columns]
+        self.dt_columns = [name for name, kind in self.columns if kind == 'datetime']
+        self.num_rows = 0
+    def format_row(self, doc):
+        for key in self.dt_columns:
+            dt = doc.get(key)
+            if dt is not None:
+                doc[key] = utils.dt_to_str(dt)
+        return doc
+    def write_header(self):
+        pass
+    def write_doc(self, doc):
+        raise NotImplementedError('Must be defined by subclasses')
+    def close(self):
+        pass
+
+
+class NdjsonWriter(ExportWriter):
+    file_ext = 'ndjson'
+    def write_doc(self, doc):
+        self.fp.write(json.dumps(self.format_row(doc), separators=(',', ':')))
+        self.fp.write('\n')
+        self.num_rows += 1
+
+
+class CsvWriter(ExportWriter):
+    file_ext = 'csv'
+    def __init__(self, table, fp):
+        super().__init__(table, fp)
+        self.writer = csv.writer(fp)
+    def write_header(self):
+        self.writer.writerow(self.column_names)
+    def write_doc(self, doc):
+        doc = self.format_row(doc)
+        self.writer.writerow([doc.get(name) for name in self.column_names])
+        self.num_rows += 1
+
+
+class ParquetWriter(ExportWriter):
+    file_ext = 'parquet'
+    ROW_GROUP_SIZE = 65536
+    def __init__(self, table, fp):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('Parquet export requires pyarrow')
+        super().__init__(table, fp)
+        self.pa = pyarrow
+        types = {
+            'string':pyarrow.string(),
+            'int':pyarrow.int64(),
+            'datetime':pyarrow.timestamp('ms', tz='UTC'),
+        }
+        self.schema = pyarrow.schema([
+            (name, types[kind]) for name, kind in self.columns
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(fp, self.schema)
+        self.buffer = {name:[] for name in self.column_names}
+        self.num_buffered = 0
+    def write_doc(self, doc):
+        for name in self.column_names:
+            self.buffer[name].append(doc.get(name))
+        self.num_buffered += 1
+        self.num_rows += 1
+        if self.num_buffered >= self.ROW_GROUP_SIZE:
+            self.flush()
+    def flush(self):
+        if not self.num_buffered:
+            return
+        batch = self.pa.Table.from_pydict(self.buffer, schema=self.schema)
+        self.writer.write_table(batch)
+        self.buffer = {name:[] for name in self.column_names}
+        self.num_buffered = 0
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+WRITERS = {
+    'ndjson':NdjsonWriter,
+    'csv':CsvWriter,
+    'parquet':ParquetWriter,
+}
+
+async def export_table(db_store, table, writer, **kwargs):
+    writer.write_header()
+    async for doc in iter_table_docs(db_store, table, **kwargs):
+        writer.write_doc(doc)
+    writer.close()
+    return writer.num_rows
+
+def open_output(filename, fmt):
+    if fmt == 'parquet':
+        return open(filename, 'wb')
+    return open(filename, 'w', newline='' if fmt == 'csv' else None)
+
+async def export(db_store, tables, fmt, output_dir=None, **kwargs):
+    writer_cls = WRITERS[fmt]
+    counts = {}
+    for table in tables:
+        if output_dir is None:
+            writer = writer_cls(table, sys.stdout)
+            counts[table] = await export_table(db_store, table, writer, **kwargs)
+            continue
+        filename = os.path.join(output_dir, '{}.{}'.format(table, writer_cls.file_ext))
+        with open_output(filename, fmt) as fp:
+            writer = writer_cls(table, fp)
+            counts[table] = await export_table(db_store, table, writer, **kwargs)
+        logger.info('{}: {} rows written to {}'.format(table, counts[table], filename))
+    return counts
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description='Stream traffic collections to NDJSON, CSV or Parquet')
+    p.add_argument(
+        'tables', nargs='*', metavar='TABLE',
+        help='Tables to export, from {} (default: all)'.format(', '.join(sorted(EXPORT_TABLES.keys()))),
+    )
+    p.add_argument('--format', dest='format', choices=sorted(WRITERS.keys()), default='ndjson')
+    p.add_argument(
+        '--output-dir', dest='output_dir', default=None,
+        help='Write one file per table into this directory. Without it a single '
+             'NDJSON or CSV table is written to stdout',
+    )
+    p.add_argument(
+        '--start', dest='start_datetime', type=parse_date_arg, default=None,
+        help='Earliest date (inclusive), as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS',
+    )
+    p.add_argument(
+        '--end', dest='end_datetime', type=parse_date_arg, default=None,
+        help='Latest date (exclusive), as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS',
+    )
+    p.add_argument(
+        '--repo', dest='repo_slugs', action='append', default=None, metavar='OWNER/NAME',
+        help='Only export this repo. May be given more than once',
+    )
+    p.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=BATCH_SIZE,
+        help='Documents fetched per cursor batch (default: %(default)s)',
+    )
+    p.add_argument(
+        '--db-config', dest='db_config', default=DB_CONF_FILENAME,
+        help='YAML file of MongoDB connection settings. Values under an "export" '
+             'section override the top level (default: %(default)s)',
+    )
+    p.add_argument('--log-level', dest='log_level', default='INFO')
+    args = p.parse_args(argv)
+    if not args.tables:
+        args.tables = sorted(EXPORT_TABLES.keys())
+    for table in args.tables:
+        if table not in EXPORT_TABLES:
+            p.error('Unknown table "{}"'.format(table))
+    if args.output_dir is None and (args.format == 'parquet' or len(args.tables) > 1):
+        p.error('--output-dir is required for parquet or more than one table')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    db_store = DbStore.from_conf(args.db_config, section='export')
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(export(
+        db_store, args.tables, args.format,
+        output_dir=args.output_dir,
+        start_datetime=args.start_datetime,
+        end_datetime=args.end_datetime,
+        repo_slugs=args.repo_slugs,
+        batch_size=args.batch_size,
+    ))
+
+if __name__ == '__main__':
+    main()
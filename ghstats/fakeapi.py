@@ -0,0 +1,252 @@
+import time
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+import datetime
+import logging
+
+from aiohttp import web
+from multidict import CIMultiDict
+
+from ghstats import utils
+from ghstats.transport import ReplayIndex
+
+logger = logging.getLogger(__name__)
+
+DT_FMT = utils.DT_FMT
+
+
+class FakeRepo(object):
+    def __init__(self, index, owner, seed, active):
+        self.index = index
+        self.owner = owner
+        self.name = 'repo-{:05d}'.format(index)
+        self.seed = seed
+        self.active = active
+    @property
+    def repo_slug(self):
+        return '{}/{}'.format(self.owner, self.name)
+    def get_random(self, *args):
+        key = ':'.join([str(a) for a in (self.seed, self.index) + args])
+        return random.Random(key)
+    def get_repo_data(self, created):
+        dt_str = created.strftime(DT_FMT)
+        return {
+            'id':self.index + 1,
+            'name':self.name,
+            'full_name':self.repo_slug,
+            'owner':{'login':self.owner, 'id':1, 'type':'User'},
+            'private':False,
+            'fork':False,
+            'description':'Synthetic repo {}'.format(self.index),
+            'created_at':dt_str,
+            'updated_at':dt_str,
+            'pushed_at':dt_str,
+            'stargazers_count':self.index % 50,
+            'watchers_count':self.index % 50,
+            'forks_count':self.index % 7,
+            'default_branch':'master',
+        }
+    def get_views(self, today, days=14):
+        views = []
+        total_count = 0
+        total_uniques = 0
+        for i in range(days, 0, -1):
+            day = today - datetime.timedelta(days=i - 1)
+            r = self.get_random('views', day.toordinal())
+            if self.active:
+                count = r.randint(0, 200)
+                uniques = r.randint(0, max(count // 2, 1)) if count else 0
+            else:
+                count = uniques = 0
+            total_count += count
+            total_uniques += uniques
+            views.append({
+                'timestamp':day.strftime(DT_FMT),
+                'count':count,
+                'uniques':uniques,
+            })
+        return {'count':total_count, 'uniques':total_uniques, 'views':views}
+    def get_paths(self, today):
+        if not self.active:
+            return []
+        r = self.get_random('paths', today.toordinal())
+        paths = []
+        for i in range(r.randint(1, 10)):
+            count = r.randint(1, 100)
+            paths.append({
+                'path':'/{}/blob/master/file{}.py'.format(self.repo_slug, i),
+                'title':'file{}.py'.format(i),
+                'count':count,
+                'uniques':r.randint(1, count),
+            })
+        paths.sort(key=lambda d:d['count'], reverse=True)
+        return paths
+    def get_referrers(self, today):
+        if not self.active:
+            return []
+        r = self.get_random('referrers', today.toordinal())
+        names = ['github.com', 'google.com', 'news.ycombinator.com', 'reddit.com', 'pypi.org']
+        referrers = []
+        for name in names[:r.randint(1, len(names))]:
+            count = r.randint(1, 100)
+            referrers.append({
+                'referrer':name,
+                'count':count,
+                'uniques':r.randint(1, count),
+            })
+        return referrers
+
+
+class FakeApi(object):
+    OWNER = 'fakeuser'
+    PER_PAGE = 100
+    RATE_LIMIT = 5000
+    RATE_LIMIT_WINDOW = 3600
+    def __init__(self, **kwargs):
+        self.num_repos = kwargs.get('num_repos', 10)
+        self.owner = kwargs.get('owner', self.OWNER)
+        self.latency = kwargs.get('latency', 0)
+        self.latency_jitter = kwargs.get('latency_jitter', 0)
+        self.rate_limit = kwargs.get('rate_limit', self.RATE_LIMIT)
+        self.per_page = kwargs.get('per_page', self.PER_PAGE)
+        self.active_ratio = kwargs.get('active_ratio', .2)
+        self.seed = kwargs.get('seed', 0)
+        self.today = kwargs.get('today')
+        if self.today is None:
+            self.today = utils.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.created = self.today - datetime.timedelta(days=365)
+        replay_filename = kwargs.get('replay_filename')
+        if replay_filename is not None:
+            self.replay_index = ReplayIndex(replay_filename)
+        else:
+            self.replay_index = None
+        r = random.Random(self.seed)
+        self.repos = {}
+        for i in range(self.num_repos):
+            repo = FakeRepo(i, self.owner, self.seed, r.random() < self.active_ratio)
+            self.repos[repo.name] = repo
+        self.repo_list = list(self.repos.values())
+        self.stats = {'requests':0, 'not_modified':0, 'rate_limited':0}
+        self.reset_rate_limit()
+    def reset_rate_limit(self):
+        self.rate_remaining = self.rate_limit
+        self.rate_reset = int(time.time()) + self.RATE_LIMIT_WINDOW
+    def get_rate_headers(self):
+        if time.time() >= self.rate_reset:
+            self.reset_rate_limit()
+        return {
+            'X-RateLimit-Limit':str(self.rate_limit),
+            'X-RateLimit-Remaining':str(max(self.rate_remaining, 0)),
+            'X-RateLimit-Reset':str(self.rate_reset),
+        }
+    async def simulate_latency(self):
+        latency = self.latency
+        if self.latency_jitter:
+            latency += random.uniform(0, self.latency_jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+    def build_response(self, request, data, extra_headers=None):
+        body = json.dumps(data, separators=(',', ':'))
+        headers = CIMultiDict()
+        headers['ETag'] = '"{}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest())
+        if extra_headers is not None:
+            headers.update(extra_headers)
+        headers.update(self.get_rate_headers())
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+        if self.rate_remaining <= 0:
+            self.stats['rate_limited'] += 1
+            return web.json_response(
+                {'message':'API rate limit exceeded'}, status=403,
+                headers=self.get_rate_headers(),
+            )
+        self.rate_remaining -= 1
+        headers['X-RateLimit-Remaining'] = str(self.rate_remaining)
+        return web.Response(body=body, content_type='application/json', headers=headers)
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.stats['requests'] += 1
+        await self.simulate_latency()
+        return await handler(request)
+    def get_repo(self, request):
+        name = request.match_info['name']
+        repo = self.repos.get(name)
+        if repo is None or request.match_info['owner'] != self.owner:
+            raise web.HTTPNotFound()
+        return repo
+    async def user_repos(self, request):
+        page = int(request.query.get('page', 1))
+        start = (page - 1) * self.per_page
+        repos = self.repo_list[start:start + self.per_page]
+        data = [repo.get_repo_data(self.created) for repo in repos]
+        extra_headers = None
+        if start + self.per_page < len(self.repo_list):
+            next_url = request.url.with_query({'page':page + 1})
+            extra_headers = {'Link':'<{}>; rel="next"'.format(next_url)}
+        return self.build_response(request, data, extra_headers)
+    async def traffic_views(self, request):
+        repo = self.get_repo(request)
+        return self.build_response(request, repo.get_views(self.today))
+    async def traffic_paths(self, request):
+        repo = self.get_repo(request)
+        return self.build_response(request, repo.get_paths(self.today))
+    async def traffic_referrers(self, request):
+        repo = self.get_repo(request)
+        return self.build_response(request, repo.get_referrers(self.today))
+    async def replay(self, request):
+        index = self.replay_index
+        origin = '{}://{}'.format(request.scheme, request.host)
+        url = str(request.rel_url)
+        r = None
+        for recorded_origin in index.origins:
+            r = index.get(request.method.lower(), recorded_origin + url)
+            if r is not None:
+                break
+        if r is None:
+            raise web.HTTPNotFound()
+        status_code, headers, data = r
+        headers = {k:v.replace(recorded_origin, origin) for k, v in headers.items()}
+        headers.pop('Content-Type', None)
+        if status_code == 200:
+            return self.build_response(request, data, headers)
+        return web.Response(status=status_code, text=str(data), headers=headers)
+    def create_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app['fake_api'] = self
+        if self.replay_index is not None:
+            app.router.add_route('*', '/{tail:.*}', self.replay)
+            return app
+        app.add_routes([
+            web.get('/user/repos', self.user_repos),
+            web.get('/repos/{owner}/{name}/traffic/views', self.traffic_views),
+            web.get('/repos/{owner}/{name}/traffic/popular/paths', self.traffic_paths),
+            web.get('/repos/{owner}/{name}/traffic/popular/referrers', self.traffic_referrers),
+        ])
+        return app
+
+
+def main():
+    p = argparse.ArgumentParser(description='Local stand-in for the GitHub traffic API')
+    p.add_argument('--host', dest='host', default='127.0.0.1')
+    p.add_argument('--port', dest='port', type=int, default=8081)
+    p.add_argument('--repos', dest='num_repos', type=int, default=10)
+    p.add_argument('--latency', dest='latency', type=float, default=0)
+    p.add_argument('--latency-jitter', dest='latency_jitter', type=float, default=0)
+    p.add_argument('--rate-limit', dest='rate_limit', type=int, default=FakeApi.RATE_LIMIT)
+    p.add_argument('--active-ratio', dest='active_ratio', type=float, default=.2)
+    p.add_argument('--seed', dest='seed', type=int, default=0)
+    p.add_argument(
+        '--replay', dest='replay_filename', default=None,
+        help='Serve responses from a recorded archive instead of synthetic repos',
+    )
+    args = p.parse_args()
+    utils.setup_logging()
+    fake_api = FakeApi(**vars(args))
+    web.run_app(fake_api.create_app(), host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import os
+import time
+import socket
+import asyncio
+import datetime
+import logging
+
+import pymongo
+
+from ghstats import utils
+from ghstats import defaults
+from ghstats.traffic import AllRepos, Repo
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkLeases(object):
+    _collection_name = 'work_leases'
+    LEASE_TIMEOUT = defaults.LEASE_TIMEOUT
+    BATCH_SIZE = defaults.LEASE_BATCH_SIZE
+    MAX_ATTEMPTS = 3
+    def __init__(self, **kwargs):
+        self.db_store = kwargs.get('db_store')
+        self.log_timestamp = kwargs.get('log_timestamp')
+        self.worker_id = kwargs.get('worker_id')
+        if self.worker_id is None:
+            self.worker_id = get_default_worker_id()
+        self.lease_timeout = kwargs.get('lease_timeout', self.LEASE_TIMEOUT)
+        self.batch_size = kwargs.get('batch_size', self.BATCH_SIZE)
+        self.max_attempts = kwargs.get('max_attempts', self.MAX_ATTEMPTS)
+    @property
+    def collection(self):
+        return self.db_store.get_collection(self._collection_name)
+    @classmethod
+    async def create_indexes(cls, db_store):
+        coll = db_store.get_collection(cls._collection_name)
+        await coll.create_indexes([
+            pymongo.IndexModel([
+                ('log_timestamp', pymongo.ASCENDING),
+                ('repo_slug', pymongo.ASCENDING),
+            ], unique=True),
+            pymongo.IndexModel([
+                ('log_timestamp', pymongo.ASCENDING),
+                ('state', pymongo.ASCENDING),
+                ('lease_expires', pymongo.ASCENDING),
+            ]),
+        ])
+    @classmethod
+    async def find_open_run(cls, db_store):
+        coll = db_store.get_collection(cls._collection_name)
+        doc = await coll.find_one(
+            {'state':{'$in':['pending', 'leased']}},
+            sort=[('log_timestamp', pymongo.DESCENDING)],
+            projection={'_id':False, 'log_timestamp':True},
+        )
+        if doc is None:
+            return None
+        return doc['log_timestamp']
+    @classmethod
+    async def find_last_run(cls, db_store):
+        coll = db_store.get_collection(cls._collection_name)
+        doc = await coll.find_one(
+            {}, sort=[('log_timestamp', pymongo.DESCENDING)],
+            projection={'_id':False, 'log_timestamp':True},
+        )
+        if doc is None:
+            return None
+        return doc['log_timestamp']
+    async def publish(self, repo_slugs):
+        ops = []
+        for repo_slug in repo_slugs:
+            filt = {'log_timestamp':self.log_timestamp, 'repo_slug':repo_slug}
+            doc = {
+                'state':'pending',
+                'worker_id':None,
+                'lease_expires':None,
+                'attempts':0,
+            }
+            ops.append(pymongo.UpdateOne(filt, {'$setOnInsert':doc}, upsert=True))
+        if len(ops):
+            await self.collection.bulk_write(ops, ordered=False)
+        return len(ops)
+    @classmethod
+    def get_claim_filter(cls, log_timestamp, now, max_attempts=None):
+        if max_attempts is None:
+            max_attempts = cls.MAX_ATTEMPTS
+        return {
+            'log_timestamp':log_timestamp,
+            '$or':[
+                {'state':'pending'},
+                {
+                    'state':'leased',
+                    'lease_expires':{'$lt':now},
+                    'attempts':{'$lt':max_attempts},
+                },
+            ],
+        }
+    @classmethod
+    def get_expired_filter(cls, log_timestamp, now, max_attempts=None):
+        if max_attempts is None:
+            max_attempts = cls.MAX_ATTEMPTS
+        return {
+            'log_timestamp':log_timestamp,
+            'state':'leased',
+            'lease_expires':{'$lt':now},
+            'attempts':{'$gte':max_attempts},
+        }
+    async def claim_one(self):
+        now = utils.now()
+        filt = self.get_claim_filter(self.log_timestamp, now, self.max_attempts)
+        update = {
+            '$set':{
+                'state':'leased',
+                'worker_id':self.worker_id,
+                'lease_expires':now + datetime.timedelta(seconds=self.lease_timeout),
+            },
+            '$inc':{'attempts':1},
+        }
+        return await self.collection.find_one_and_update(
+            filt, update, return_document=pymongo.ReturnDocument.AFTER,
+        )
+    async def claim(self):
+        await self.fail_expired()
+        docs = []
+        while len(docs) < self.batch_size:
+            doc = await self.claim_one()
+            if doc is None:
+                break
+            docs.append(doc)
+        return docs
+    async def release(self, doc, success):
+        if success:
+            state = 'done'
+        elif doc.get('attempts', 0) >= self.max_attempts:
+            state = 'failed'
+        else:
+            state = 'pending'
+        await self.collection.update_one(
+            {'_id':doc['_id'], 'worker_id':self.worker_id},
+            {'$set':{
+                'state':state,
+                'lease_expires':None,
+                'finished':utils.now(),
+            }},
+        )
+        return state
+    async def renew(self, docs):
+        result = await self.collection.update_many(
+            {
+                '_id':{'$in':[doc['_id'] for doc in docs]},
+                'worker_id':self.worker_id,
+                'state':'leased',
+            },
+            {'$set':{
+                'lease_expires':utils.now() + datetime.timedelta(seconds=self.lease_timeout),
+            }},
+        )
+        return result.modified_count
+    async def heartbeat(self, docs):
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            await self.renew(docs)
+    async def fail_expired(self):
+        filt = self.get_expired_filter(self.log_timestamp, utils.now(), self.max_attempts)
+        result = await self.collection.update_many(
+            filt, {'$set':{'state':'failed', 'lease_expires':None, 'finished':utils.now()}},
+        )
+        return result.modified_count
+    async def fail_remaining(self):
+        filt = {
+            'log_timestamp':self.log_timestamp,
+            'state':{'$in':['pending', 'leased']},
+        }
+        result = await self.collection.update_many(
+            filt, {'$set':{'state':'failed', 'lease_expires':None, 'finished':utils.now()}},
+        )
+        return result.modified_count
+    async def is_finished(self):
+        filt = {
+            'log_timestamp':self.log_timestamp,
+            'state':{'$in':['pending', 'leased']},
+        }
+        doc = await self.collection.find_one(filt, projection={'_id':True})
+        return doc is None
+    async def wait_finished(self, poll_interval=10, timeout=None):
+        start_ts = time.monotonic()
+        while True:
+            await self.fail_expired()
+            if await self.is_finished():
+                return True
+            if timeout is not None and time.monotonic() - start_ts >= timeout:
+                return False
+            await asyncio.sleep(poll_interval)
+    async def get_worker_counts(self):
+        pipeline = [
+            {'$match':{'log_timestamp':self.log_timestamp}},
+            {'$group':{
+                '_id':{'worker_id':'$worker_id', 'state':'$state'},
+                'count':{'$sum':1},
+            }},
+        ]
+        workers = {}
+        async for doc in self.collection.aggregate(pipeline):
+            worker_id = doc['_id'].get('worker_id')
+            if worker_id not in workers:
+                workers[worker_id] = {'worker_id':worker_id}
+            workers[worker_id][doc['_id']['state']] = doc['count']
+        return list(workers.values())
+
+
+class LeaseWorker(object):
+    POLL_INTERVAL = 10
+    def __init__(self, **kwargs):
+        self.request_handler = kwargs.get('request_handler')
+        self.db_store = kwargs.get('db_store')
+        self.leases = kwargs.get('leases')
+        self.poll_interval = kwargs.get('poll_interval', self.POLL_INTERVAL)
+        self.num_failed = 0
+        self.all_repos = AllRepos(
+            request_handler=self.request_handler,
+            db_store=self.db_store,
+        )
+    async def run(self):
+        num_collected = 0
+        async with self.request_handler:
+            while True:
+                docs = await self.leases.claim()
+                if not len(docs):
+                    if await self.leases.is_finished():
+                        break
+                    await asyncio.sleep(min(self.poll_interval, self.leases.lease_timeout))
+                    continue
+                heartbeat = asyncio.ensure_future(self.leases.heartbeat(docs))
+                try:
+                    tasks = [self.collect(doc) for doc in docs]
+                    await asyncio.gather(*tasks)
+                finally:
+                    heartbeat.cancel()
+                num_collected += len(docs)
+        logger.info('Worker {} finished after {} leases'.format(
+            self.leases.worker_id, num_collected,
+        ))
+        return num_collected
+    async def collect(self, doc):
+        owner, name = doc['repo_slug'].split('/', 1)
+        repo = Repo(
+            owner=owner,
+            name=name,
+            request_handler=self.request_handler,
+            db_store=self.db_store,
+        )
+        success = await self.all_repos.collect_repo(repo, self.leases.log_timestamp)
+        state = await self.leases.release(doc, success)
+        if state == 'failed':
+            self.num_failed += 1
+        return state
+
+
+async def publish_run(request_handler, db_store, **kwargs):
+    from ghstats.schema import ensure_indexes
+    await ensure_indexes(db_store)
+    all_repos = AllRepos(request_handler=request_handler, db_store=db_store)
+    async with request_handler:
+        await all_repos.get_repos()
+    log_timestamp = utils.now()
+    await all_repos.log_db_update(log_timestamp, 'repos', 0)
+    leases = WorkLeases(db_store=db_store, log_timestamp=log_timestamp, **kwargs)
+    repo_slugs = [repo.repo_slug for repo in all_repos.repos.values()]
+    num_published = await leases.publish(repo_slugs)
+    logger.info('Published {} repos for run {}'.format(num_published, log_timestamp))
+    return leases
+
+async def run_worker(request_handler, db_store, poll_interval=LeaseWorker.POLL_INTERVAL, **kwargs):
+    log_timestamp = await WorkLeases.find_open_run(db_store)
+    if log_timestamp is None:
+        logger.info('No open run to work on')
+        return None
+    leases = WorkLeases(db_store=db_store, log_timestamp=log_timestamp, **kwargs)
+    worker = LeaseWorker(
+        request_handler=request_handler,
+        db_store=db_store,
+        leases=leases,
+        poll_interval=poll_interval,
+    )
+    await worker.run()
+    return worker
+
+async def merge_run(db_store, poll_interval=10, timeout=None, **kwargs):
+    log_timestamp = await WorkLeases.find_last_run(db_store)
+    if log_timestamp is None:
+        logger.info('No run to merge')
+        return None
+    leases = WorkLeases(db_store=db_store, log_timestamp=log_timestamp, **kwargs)
+    if not await leases.wait_finished(poll_interval, timeout):
+        num_failed = await leases.fail_remaining()
+        logger.warning('Run {} did not finish within {}s, marked {} unfinished repos as failed'.format(
+            log_timestamp, timeout, num_failed,
+        ))
+    workers = await leases.get_worker_counts()
+    all_repos = AllRepos(db_store=db_store)
+    coll = db_store.get_collection(all_repos._log_collection_name)
+    await coll.update_one(
+        {'log_timestamp':log_timestamp},
+        {'$set':{'workers':workers}},
+    )
+    failed = sum([w.get('failed', 0) for w in workers])
+    for w in workers:
+        logger.info('Worker {}: {}'.format(w['worker_id'], w))
+    await all_repos.finish_db_update(log_timestamp, complete=not failed)
+    return {'log_timestamp':log_timestamp, 'workers':workers}
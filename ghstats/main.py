@@ -1,40 +1,345 @@
+import sys
 import asyncio
+import argparse
+import logging
 
-import jsonfactory
+from ghstats import metrics
+from ghstats import profiling
+from ghstats import utils
+from ghstats import defaults
 
-from ghstats.requests import RequestHandler
-from ghstats.traffic import ApiObject, AllRepos, Repo
-from ghstats.dbstore import DbStore
+logger = logging.getLogger(__name__)
 
-loop = asyncio.get_event_loop()
+DEADLINE_GRACE = 30
+
+def get_loop():
+    return asyncio.get_event_loop()
 
 async def get_data(**kwargs):
-    all_repos = AllRepos(**kwargs)
-    await all_repos.get_repos()
-    await all_repos.get_repo_data()
+    from ghstats.traffic import AllRepos
+    from ghstats.checkpoint import RunCheckpoint
+    from ghstats.schema import ensure_indexes
     db_store = kwargs.get('db_store')
     if db_store is not None:
-        await ApiObject.create_indexes(db_store)
+        with profiling.phase('indexes'):
+            await ensure_indexes(db_store)
+    if db_store is not None and kwargs.get('checkpoint') is None:
+        with profiling.phase('checkpoint'):
+            kwargs['checkpoint'] = await RunCheckpoint.create(
+                db_store, resume=kwargs.get('resume', False),
+            )
+    all_repos = AllRepos(**kwargs)
+    if all_repos.activity is not None:
+        with profiling.phase('activity'):
+            await all_repos.activity.load()
+    with profiling.phase('list_repos'):
+        await all_repos.get_repos()
+    with profiling.phase('collect'):
+        await all_repos.get_repo_data()
     return all_repos
 
 async def store_data(all_repos):
+    from ghstats.dbstore import DbStore
     db_store = DbStore()
     await all_repos.store_to_db(db_store)
 
 async def from_db(**kwargs):
+    from ghstats.traffic import AllRepos
+    from ghstats.dbstore import DbStore
     db_store = DbStore()
     all_repos = await AllRepos.from_db(db_store, **kwargs)
     return all_repos
 
 def from_db_sync(**kwargs):
-    return loop.run_until_complete(from_db(**kwargs))
+    return get_loop().run_until_complete(from_db(**kwargs))
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        '--daemon', dest='daemon', action='store_true',
+        help='Run continuously, polling repos on a schedule',
+    )
+    p.add_argument(
+        '--poll-interval', dest='poll_interval', type=float,
+        default=defaults.POLL_INTERVAL,
+        help='Seconds between polls of each repo in daemon mode, and between '
+             'polls of the most active repos with --adaptive (default: %(default)s)',
+    )
+    p.add_argument(
+        '--repo-list-interval', dest='repo_list_interval', type=float,
+        default=defaults.REPO_LIST_INTERVAL,
+        help='Seconds between refreshes of the repo list in daemon mode (default: %(default)s)',
+    )
+    p.add_argument(
+        '--adaptive', dest='adaptive', action='store_true',
+        help='Poll repos more or less often based on how often their data changes',
+    )
+    p.add_argument(
+        '--max-staleness', dest='max_staleness', type=float,
+        default=defaults.MAX_STALENESS,
+        help='Longest time in seconds a dormant repo may go unpolled with '
+             '--adaptive. Keep this well below the 14 days of history '
+             'the traffic API retains (default: %(default)s)',
+    )
+    p.add_argument(
+        '--resume', dest='resume', action='store_true',
+        help='Continue the most recent incomplete run, skipping repos it already collected',
+    )
+    p.add_argument(
+        '--queue', dest='queue', choices=['publish', 'work', 'merge'],
+        help='Sharded collection through the work_leases collection: "publish" '
+             'queues every repo for a new run, "work" collects leased repos '
+             'until the run is drained and "merge" waits for the run to '
+             'finish and records per-worker counts in db_update_log',
+    )
+    p.add_argument('--worker-id', dest='worker_id', default=None)
+    p.add_argument(
+        '--lease-timeout', dest='lease_timeout', type=float,
+        default=defaults.LEASE_TIMEOUT,
+        help='Seconds before a claimed repo can be taken over by another worker (default: %(default)s)',
+    )
+    p.add_argument(
+        '--lease-batch-size', dest='lease_batch_size', type=int,
+        default=defaults.LEASE_BATCH_SIZE,
+        help='Number of repos a worker claims at a time (default: %(default)s)',
+    )
+    p.add_argument(
+        '--merge-timeout', dest='merge_timeout', type=float, default=None,
+        help='Seconds "merge" waits for the run before marking unfinished repos as failed',
+    )
+    p.add_argument(
+        '--connect-timeout', dest='connect_timeout', type=float, default=None,
+        help='Seconds to wait for a connection to the API (default: {})'.format(
+            defaults.CONNECT_TIMEOUT,
+        ),
+    )
+    p.add_argument(
+        '--read-timeout', dest='read_timeout', type=float, default=None,
+        help='Seconds to wait between reads of an API response (default: {})'.format(
+            defaults.READ_TIMEOUT,
+        ),
+    )
+    p.add_argument(
+        '--max-retries', dest='max_retries', type=int, default=None,
+        help='Retries for failed, 5xx or secondary rate-limited requests (default: {})'.format(
+            defaults.MAX_RETRIES,
+        ),
+    )
+    p.add_argument(
+        '--hedge-delay', dest='hedge_delay', type=float, default=None,
+        help='Send a second copy of a GET request still pending after this many seconds',
+    )
+    p.add_argument(
+        '--deadline', dest='deadline', type=float, default=None,
+        help='Overall time limit in seconds for a collection run',
+    )
+    p.add_argument(
+        '--api-endpoint', dest='api_endpoint', default=None,
+        help='Base URL of the GitHub API, e.g. a local ghstats-fakeapi server',
+    )
+    p.add_argument(
+        '--record', dest='record_filename', default=None,
+        help='Record every API response into this archive file',
+    )
+    p.add_argument(
+        '--replay', dest='replay_filename', default=None,
+        help='Answer API requests from a recorded archive instead of the network',
+    )
+    p.add_argument(
+        '--profile', dest='profile', nargs='?', const='phases', default=None,
+        choices=profiling.MODES,
+        help='Time each collection phase and repo, log a report and store it with the '
+             'run\'s db_update_log entry. "cprofile" or "sample" also report the '
+             'hottest functions (default mode: %(const)s)',
+    )
+    p.add_argument(
+        '--profile-memory', dest='profile_memory', action='store_true',
+        help='Also record peak traced memory with tracemalloc (slows the run down)',
+    )
+    p.add_argument(
+        '--profile-output', dest='profile_output', default=None,
+        help='Write cProfile stats, or collapsed stacks for "sample", to this file',
+    )
+    p.add_argument(
+        '--dump-metrics', dest='dump_metrics', nargs='?', const='-', default=None,
+        metavar='FILENAME',
+        help='Write metrics in Prometheus text format to FILENAME (or stdout) at exit',
+    )
+    p.add_argument(
+        '--db-config', dest='db_config', default=defaults.DB_CONF_FILENAME,
+        help='YAML file of MongoDB connection settings. Values under a "collector" '
+             'section override the top level (default: %(default)s)',
+    )
+    p.add_argument('--log-level', dest='log_level', default='INFO')
+    return p.parse_args(argv)
 
-def main():
+def build_request_handler(args):
+    from ghstats.requests import RequestHandler
+    from ghstats.transport import RecordingTransport, ReplayTransport
     rh = RequestHandler.from_conf()
-    db_store = DbStore()
-    all_repos = loop.run_until_complete(
-        get_data(request_handler=rh, db_store=db_store)
+    for attr in ['connect_timeout', 'read_timeout', 'max_retries', 'hedge_delay']:
+        value = getattr(args, attr)
+        if value is not None:
+            setattr(rh, attr, value)
+    if args.api_endpoint is not None:
+        rh.api_endpoint = args.api_endpoint.rstrip('/')
+    if args.replay_filename is not None:
+        rh.transport = ReplayTransport(args.replay_filename)
+    if args.record_filename is not None:
+        rh.transport = RecordingTransport(args.record_filename, rh.transport)
+    return rh
+
+async def mark_deadline_exceeded(db_store, message):
+    from ghstats.checkpoint import RunCheckpoint
+    log_timestamp = await RunCheckpoint.find_incomplete_run(db_store)
+    if log_timestamp is None:
+        return None
+    coll = db_store.get_collection(RunCheckpoint._log_collection_name)
+    await coll.update_one({'log_timestamp':log_timestamp}, {'$set':{'message':message}})
+    return log_timestamp
+
+def run_until_deadline(args, coro, request_handler=None, db_store=None):
+    loop = get_loop()
+    if args.deadline is None:
+        return loop.run_until_complete(coro)
+    if request_handler is not None:
+        request_handler.set_deadline(args.deadline)
+    try:
+        return loop.run_until_complete(
+            asyncio.wait_for(coro, args.deadline + DEADLINE_GRACE)
+        )
+    except asyncio.TimeoutError:
+        message = 'Run cut off by the {}s deadline'.format(args.deadline)
+        if db_store is not None:
+            log_timestamp = loop.run_until_complete(mark_deadline_exceeded(db_store, message))
+            if log_timestamp is not None:
+                message = '{} ({}), continue it with --resume'.format(message, log_timestamp)
+        logger.error(message)
+        sys.exit(1)
+
+def build_activity_tracker(args, db_store):
+    from ghstats.activity import ActivityTracker
+    if not args.adaptive:
+        return None
+    return ActivityTracker(
+        db_store=db_store,
+        min_interval=args.poll_interval,
+        max_staleness=args.max_staleness,
+    )
+
+def run_daemon(args, request_handler, db_store):
+    from ghstats.daemon import CollectorDaemon
+    daemon = CollectorDaemon(
+        request_handler=request_handler,
+        db_store=db_store,
+        activity=build_activity_tracker(args, db_store),
+        poll_interval=args.poll_interval,
+        repo_list_interval=args.repo_list_interval,
+    )
+    try:
+        get_loop().run_until_complete(daemon.run())
+    except KeyboardInterrupt:
+        daemon.stop()
+    return daemon
+
+def run_queue(args, db_store):
+    from ghstats import leases
+    lkwargs = {
+        'worker_id':args.worker_id,
+        'lease_timeout':args.lease_timeout,
+        'batch_size':args.lease_batch_size,
+    }
+    if args.queue == 'merge':
+        return get_loop().run_until_complete(
+            leases.merge_run(db_store, timeout=args.merge_timeout, **lkwargs)
+        )
+    rh = build_request_handler(args)
+    if args.queue == 'publish':
+        coro = leases.publish_run(rh, db_store, **lkwargs)
+    else:
+        coro = leases.run_worker(rh, db_store, **lkwargs)
+    return run_until_deadline(args, coro, rh)
+
+def get_num_failed(args, result):
+    if result is None or args.daemon:
+        return 0
+    if args.queue == 'merge':
+        return sum([w.get('failed', 0) for w in result['workers']])
+    if args.queue == 'work':
+        return result.num_failed
+    if args.queue == 'publish':
+        return 0
+    return len(result.failed)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    try:
+        result = run(args)
+    finally:
+        if args.dump_metrics is not None:
+            metrics.dump(args.dump_metrics)
+    if get_num_failed(args, result):
+        sys.exit(1)
+
+def get_profile_target(args, result):
+    if result is None:
+        return None, None
+    if args.queue == 'merge':
+        return result['log_timestamp'], 'profiles.merge'
+    if args.queue == 'publish':
+        return result.log_timestamp, 'profiles.publish'
+    if args.queue == 'work':
+        key = 'profiles.{}'.format(result.leases.worker_id.replace('.', '_'))
+        return result.leases.log_timestamp, key
+    if args.daemon:
+        return result.log_timestamp, 'profile'
+    if result.checkpoint is None:
+        return None, None
+    return result.checkpoint.log_timestamp, 'profile'
+
+def finish_profile(profiler, db_store, log_timestamp=None, key='profile'):
+    summary = profiler.get_summary()
+    logger.info(profiling.format_summary(summary))
+    filename = profiler.save_output()
+    if filename is not None:
+        logger.info('profile written to {}'.format(filename))
+    if log_timestamp is not None:
+        get_loop().run_until_complete(
+            profiling.save_summary(db_store, log_timestamp, summary, key)
+        )
+    return summary
+
+def run(args):
+    from ghstats.dbstore import DbStore
+    db_store = DbStore.from_conf(args.db_config, section='collector')
+    if args.profile is None:
+        return run_collection(args, db_store)
+    profiler = profiling.start(
+        args.profile, trace_memory=args.profile_memory, output=args.profile_output,
+    )
+    result = None
+    try:
+        result = run_collection(args, db_store)
+    finally:
+        profiling.stop()
+        log_timestamp, key = get_profile_target(args, result)
+        finish_profile(profiler, db_store, log_timestamp, key)
+    return result
+
+def run_collection(args, db_store):
+    if args.queue is not None:
+        return run_queue(args, db_store)
+    rh = build_request_handler(args)
+    if args.daemon:
+        return run_daemon(args, rh, db_store)
+    coro = get_data(
+        request_handler=rh,
+        db_store=db_store,
+        activity=build_activity_tracker(args, db_store),
+        resume=args.resume,
     )
+    all_repos = run_until_deadline(args, coro, rh, db_store)
     return all_repos
 
 if __name__ == '__main__':
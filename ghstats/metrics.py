@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import glob
+import pickle
+import bisect
+import tempfile
+import threading
+import contextlib
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = [
+    .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.,
+]
+SNAPSHOT_EXT = '.metrics'
+
+
+def escape_label_value(value):
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not len(pairs):
+        return ''
+    return '{{{}}}'.format(','.join([
+        '{}="{}"'.format(k, escape_label_value(v)) for k, v in pairs
+    ]))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric(object):
+    metric_type = None
+    def __init__(self, name, help_text, label_names=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names or [])
+        self.values = {}
+        self.lock = threading.Lock()
+    def get_key(self, labels):
+        return tuple([labels.get(name, '') for name in self.label_names])
+    def get_snapshot(self):
+        with self.lock:
+            return dict(self.values)
+    def merge_value(self, a, b):
+        return a + b
+    def merge_snapshots(self, snapshots):
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                if key in values:
+                    value = self.merge_value(values[key], value)
+                values[key] = value
+        return values
+    def iter_samples(self, values=None):
+        raise NotImplementedError('Must be defined by subclasses')
+    def render(self, values=None):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+        for suffix, key, extra, value in self.iter_samples(values):
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, format_labels(self.label_names, key, extra),
+                format_value(value),
+            ))
+        return '\n'.join(lines)
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+    def iter_samples(self, values=None):
+        if values is None:
+            values = self.get_snapshot()
+        for key, value in sorted(values.items()):
+            yield '', key, None, value
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels))
+    def merge_value(self, a, b):
+        return b
+    def iter_samples(self, values=None):
+        if values is None:
+            values = self.get_snapshot()
+        for key, value in sorted(values.items()):
+            yield '', key, None, value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+    def __init__(self, name, help_text, label_names=None, buckets=None):
+        super().__init__(name, help_text, label_names)
+        if buckets is None:
+            buckets = DEFAULT_BUCKETS
+        self.buckets = sorted(buckets)
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = {
+                    'counts':[0] * (len(self.buckets) + 1), 'sum':0., 'count':0,
+                }
+            v['counts'][i] += 1
+            v['sum'] += value
+            v['count'] += 1
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start_ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_ts, **labels)
+    def get_count(self, **labels):
+        v = self.values.get(self.get_key(labels))
+        if v is None:
+            return 0
+        return v['count']
+    def get_snapshot(self):
+        with self.lock:
+            return {k:dict(v, counts=list(v['counts'])) for k, v in self.values.items()}
+    def merge_value(self, a, b):
+        return {
+            'counts':[x + y for x, y in zip(a['counts'], b['counts'])],
+            'sum':a['sum'] + b['sum'],
+            'count':a['count'] + b['count'],
+        }
+    def iter_samples(self, values=None):
+        if values is None:
+            values = self.get_snapshot()
+        bounds = self.buckets + [float('inf')]
+        for key, v in sorted(values.items()):
+            total = 0
+            for bound, count in zip(bounds, v['counts']):
+                total += count
+                yield '_bucket', key, ('le', format_value(float(bound))), total
+            yield '_sum', key, None, v['sum']
+            yield '_count', key, None, v['count']
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise KeyError('Metric {} already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+    def counter(self, name, help_text, label_names=None):
+        return self.add(Counter(name, help_text, label_names))
+    def gauge(self, name, help_text, label_names=None):
+        return self.add(Gauge(name, help_text, label_names))
+    def histogram(self, name, help_text, label_names=None, buckets=None):
+        return self.add(Histogram(name, help_text, label_names, buckets))
+    def render(self):
+        return '\n'.join([m.render() for m in self.metrics.values()]) + '\n'
+    def get_snapshot(self):
+        return {name:m.get_snapshot() for name, m in self.metrics.items()}
+    def render_snapshots(self, snapshots):
+        return '\n'.join([
+            m.render(m.merge_snapshots([s.get(name, {}) for s in snapshots]))
+            for name, m in self.metrics.items()
+        ]) + '\n'
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    'ghstats_http_request_duration_seconds',
+    'Latency of GitHub API requests',
+    ['endpoint'],
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    'ghstats_http_requests_total',
+    'GitHub API responses by status code',
+    ['endpoint', 'status'],
+)
+HTTP_CONDITIONAL_REQUESTS = REGISTRY.counter(
+    'ghstats_http_conditional_requests_total',
+    'GitHub API requests sent with an ETag, by whether they returned 304',
+    ['result'],
+)
+HTTP_NOT_MODIFIED_RATIO = REGISTRY.gauge(
+    'ghstats_http_not_modified_ratio',
+    'Fraction of conditional GitHub API requests answered with 304',
+)
+RATE_LIMIT_REMAINING = REGISTRY.gauge(
+    'ghstats_github_rate_limit_remaining',
+    'Requests remaining in the current GitHub rate limit window',
+)
+RATE_LIMIT_LIMIT = REGISTRY.gauge(
+    'ghstats_github_rate_limit_limit',
+    'Size of the GitHub rate limit window',
+)
+MONGO_OP_DURATION = REGISTRY.histogram(
+    'ghstats_mongo_op_duration_seconds',
+    'Latency of MongoDB commands',
+    ['collection', 'op'],
+)
+MONGO_OP_FAILURES = REGISTRY.counter(
+    'ghstats_mongo_op_failures_total',
+    'Failed MongoDB commands',
+    ['collection', 'op'],
+)
+CHART_BUILD_DURATION = REGISTRY.histogram(
+    'ghstats_chart_build_seconds',
+    'Time to build and stream chart data',
+    ['chart'],
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    'ghstats_cache_requests_total',
+    'Shared cache lookups by result',
+    ['cache', 'result'],
+)
+WEB_REQUEST_DURATION = REGISTRY.histogram(
+    'ghstats_web_request_duration_seconds',
+    'Latency of web app requests',
+    ['route', 'status'],
+)
+
+
+def get_api_endpoint_label(url, api_endpoint=''):
+    if url.startswith(api_endpoint):
+        url = url[len(api_endpoint):]
+    path = url.split('?', 1)[0].strip('/')
+    parts = path.split('/')
+    if len(parts) >= 3 and parts[0] == 'repos':
+        parts[1:3] = ['{owner}', '{repo}']
+    return '/'.join(parts)
+
+def observe_conditional_request(not_modified):
+    result = 'hit' if not_modified else 'miss'
+    HTTP_CONDITIONAL_REQUESTS.inc(result=result)
+    hits = HTTP_CONDITIONAL_REQUESTS.get(result='hit')
+    total = hits + HTTP_CONDITIONAL_REQUESTS.get(result='miss')
+    HTTP_NOT_MODIFIED_RATIO.set(hits / total)
+
+def observe_rate_limits(rate_data):
+    if rate_data.get('remaining') is not None:
+        RATE_LIMIT_REMAINING.set(rate_data['remaining'])
+    if rate_data.get('total_limit') is not None:
+        RATE_LIMIT_LIMIT.set(rate_data['total_limit'])
+
+
+def write_snapshot(dirname):
+    filename = os.path.join(dirname, '{}{}'.format(os.getpid(), SNAPSHOT_EXT))
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(REGISTRY.get_snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+    return filename
+
+def read_snapshots(dirname):
+    filenames = []
+    for filename in glob.glob(os.path.join(dirname, '*{}'.format(SNAPSHOT_EXT))):
+        try:
+            filenames.append((os.stat(filename).st_mtime, filename))
+        except FileNotFoundError:
+            pass
+    snapshots = []
+    for mtime, filename in sorted(filenames):
+        try:
+            with open(filename, 'rb') as f:
+                snapshots.append(pickle.load(f))
+        except FileNotFoundError:
+            pass
+    return snapshots
+
+def render_dir(dirname):
+    write_snapshot(dirname)
+    return REGISTRY.render_snapshots(read_snapshots(dirname))
+
+def dump(filename=None):
+    text = REGISTRY.render()
+    if filename is None or filename == '-':
+        sys.stdout.write(text)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text)
+    return text
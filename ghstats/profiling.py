@@ -0,0 +1,286 @@
+import os
+import time
+import signal
+import threading
+import contextlib
+import collections
+
+from ghstats.utils import format_table
+
+MODES = ['phases', 'cprofile', 'sample']
+ENV_VAR = 'GHSTATS_PROFILE'
+OUTPUT_ENV_VAR = 'GHSTATS_PROFILE_OUTPUT'
+MEMORY_ENV_VAR = 'GHSTATS_PROFILE_MEMORY'
+
+SAMPLE_INTERVAL = .005
+TOP_FUNCTIONS = 25
+TOP_REPOS = 50
+
+PHASE_FIELDS = [
+    ('phase', 'phase', '{}'),
+    ('count', 'count', '{:d}'),
+    ('wall', 'wall (s)', '{:.3f}'),
+    ('mean_ms', 'mean (ms)', '{:.2f}'),
+    ('cpu', 'cpu (s)', '{}'),
+]
+REPO_FIELDS = [
+    ('repo_slug', 'repo', '{}'),
+    ('fetch', 'fetch (s)', '{:.3f}'),
+    ('store', 'store (s)', '{:.3f}'),
+]
+FUNCTION_FIELDS = [
+    ('function', 'function', '{}'),
+    ('calls', 'calls', '{}'),
+    ('self', 'self (s)', '{:.3f}'),
+    ('cumulative', 'cumulative (s)', '{:.3f}'),
+]
+
+PROFILER = None
+
+
+class Profiler(object):
+    def __init__(self, mode='phases', **kwargs):
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode {!r}'.format(mode))
+        self.mode = mode
+        self.trace_memory = kwargs.get('trace_memory', False)
+        self.output = kwargs.get('output')
+        self.sample_interval = kwargs.get('sample_interval', SAMPLE_INTERVAL)
+        self.phases = {}
+        self.repos = {}
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self._cprofile = None
+        self.running = False
+        self.start_wall = None
+        self.start_cpu = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.memory_peak = None
+    def start(self):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.mode == 'cprofile':
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif self.mode == 'sample':
+            if not hasattr(signal, 'setitimer'):
+                raise Exception('Sampling profiles require signal.setitimer')
+            signal.signal(signal.SIGPROF, self._on_sample)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.running = True
+    def stop(self):
+        self.running = False
+        self.wall_time = time.perf_counter() - self.start_wall
+        self.cpu_time = time.process_time() - self.start_cpu
+        if self.mode == 'cprofile':
+            self._cprofile.disable()
+        elif self.mode == 'sample':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        if self.trace_memory:
+            import tracemalloc
+            _, self.memory_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    def _on_sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+    def add(self, name, wall, cpu=None, repo_slug=None):
+        with self.lock:
+            p = self.phases.get(name)
+            if p is None:
+                p = self.phases[name] = {'count':0, 'wall':0., 'cpu':None}
+            p['count'] += 1
+            p['wall'] += wall
+            if cpu is not None:
+                p['cpu'] = (p['cpu'] or 0.) + cpu
+            if repo_slug is not None:
+                r = self.repos.setdefault(repo_slug, {})
+                r[name] = r.get(name, 0.) + wall
+    @contextlib.contextmanager
+    def phase(self, name, repo_slug=None, cpu=False):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time() if cpu else None
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            if cpu:
+                cpu = time.process_time() - start_cpu
+            else:
+                cpu = None
+            self.add(name, wall, cpu, repo_slug)
+    def get_top_functions(self, count=TOP_FUNCTIONS):
+        if self.mode == 'cprofile':
+            import pstats
+            stats = pstats.Stats(self._cprofile).stats
+            if self.running:
+                self._cprofile.enable()
+            rows = []
+            for (filename, lineno, func), (cc, nc, tt, ct, callers) in stats.items():
+                rows.append({
+                    'function':'{}:{}({})'.format(os.path.basename(filename), lineno, func),
+                    'calls':nc,
+                    'self':tt,
+                    'cumulative':ct,
+                })
+        elif self.mode == 'sample':
+            self_counts = collections.Counter()
+            total_counts = collections.Counter()
+            for stack, n in self.samples.items():
+                funcs = stack.split(';')
+                self_counts[funcs[-1]] += n
+                for func in set(funcs):
+                    total_counts[func] += n
+            rows = [{
+                'function':func,
+                'calls':None,
+                'self':self_counts[func] * self.sample_interval,
+                'cumulative':n * self.sample_interval,
+            } for func, n in total_counts.items()]
+        else:
+            return []
+        rows.sort(key=lambda row: -row['self'])
+        return rows[:count]
+    def get_repo_rows(self, count=TOP_REPOS):
+        with self.lock:
+            rows = [{
+                'repo_slug':repo_slug,
+                'fetch':r.get('fetch', 0.),
+                'store':r.get('store', 0.),
+            } for repo_slug, r in self.repos.items()]
+        rows.sort(key=lambda row: -(row['fetch'] + row['store']))
+        return rows[:count]
+    def get_summary(self):
+        wall_time, cpu_time, memory_peak = self.wall_time, self.cpu_time, self.memory_peak
+        if self.running:
+            wall_time = time.perf_counter() - self.start_wall
+            cpu_time = time.process_time() - self.start_cpu
+            if self.trace_memory:
+                import tracemalloc
+                memory_peak = tracemalloc.get_traced_memory()[1]
+        with self.lock:
+            phases = {name:dict(p) for name, p in sorted(self.phases.items())}
+        return {
+            'mode':self.mode,
+            'wall_time':wall_time,
+            'cpu_time':cpu_time,
+            'memory_peak':memory_peak,
+            'phases':phases,
+            'num_repos':len(self.repos),
+            'slowest_repos':self.get_repo_rows(),
+            'functions':self.get_top_functions(),
+        }
+    def save_output(self, filename=None):
+        if filename is None:
+            filename = self.output
+        if filename is None:
+            return None
+        filename = filename.format(pid=os.getpid())
+        if self.mode == 'cprofile':
+            self._cprofile.dump_stats(filename)
+        elif self.mode == 'sample':
+            with open(filename, 'w') as f:
+                for stack, n in self.samples.most_common():
+                    f.write('{} {}\n'.format(stack, n))
+        else:
+            return None
+        return filename
+
+
+def get_profiler():
+    return PROFILER
+
+def start(mode='phases', **kwargs):
+    global PROFILER
+    PROFILER = Profiler(mode, **kwargs)
+    PROFILER.start()
+    return PROFILER
+
+def stop():
+    global PROFILER
+    p = PROFILER
+    PROFILER = None
+    if p is not None:
+        p.stop()
+    return p
+
+def add(name, wall, cpu=None, repo_slug=None):
+    p = PROFILER
+    if p is not None:
+        p.add(name, wall, cpu, repo_slug)
+
+@contextlib.contextmanager
+def phase(name, repo_slug=None, cpu=False):
+    p = PROFILER
+    if p is None:
+        yield
+        return
+    with p.phase(name, repo_slug, cpu):
+        yield
+
+def get_env_options(environ=None):
+    if environ is None:
+        environ = os.environ
+    mode = environ.get(ENV_VAR, '').strip().lower()
+    if mode in ['', '0', 'false', 'no']:
+        return None
+    if mode in ['1', 'true', 'yes']:
+        mode = 'phases'
+    return {
+        'mode':mode,
+        'output':environ.get(OUTPUT_ENV_VAR) or None,
+        'trace_memory':environ.get(MEMORY_ENV_VAR, '') not in ['', '0'],
+    }
+
+def format_summary(summary):
+    lines = ['profile ({}): {:.2f}s wall, {:.2f}s cpu'.format(
+        summary['mode'], summary['wall_time'], summary['cpu_time'],
+    )]
+    if summary['memory_peak'] is not None:
+        lines.append('peak traced memory: {:.1f} MB'.format(summary['memory_peak'] / 1024 / 1024))
+    rows = []
+    for name, p in sorted(summary['phases'].items(), key=lambda item: -item[1]['wall']):
+        rows.append({
+            'phase':name,
+            'count':p['count'],
+            'wall':p['wall'],
+            'mean_ms':p['wall'] / p['count'] * 1000,
+            'cpu':'-' if p['cpu'] is None else '{:.3f}'.format(p['cpu']),
+        })
+    if len(rows):
+        lines.append('{}\n(phase times are summed over concurrent tasks)'.format(
+            format_table(rows, PHASE_FIELDS),
+        ))
+    if len(summary['slowest_repos']):
+        lines.append(format_table(summary['slowest_repos'][:10], REPO_FIELDS))
+    if len(summary['functions']):
+        rows = [dict(row, calls='-' if row['calls'] is None else str(row['calls']))
+                for row in summary['functions']]
+        lines.append(format_table(rows, FUNCTION_FIELDS))
+    return '\n\n'.join(lines)
+
+async def save_summary(db_store, log_timestamp, summary, key='profile'):
+    from ghstats.traffic import ApiObject
+    coll = db_store.get_collection(ApiObject._log_collection_name)
+    await coll.update_one(
+        {'log_timestamp':log_timestamp},
+        {'$set':{key:summary}},
+        upsert=True,
+    )
+
+async def save_current(db_store, log_timestamp, key='profile'):
+    p = PROFILER
+    if p is None:
+        return None
+    summary = p.get_summary()
+    await save_summary(db_store, log_timestamp, summary, key)
+    return summary
@@ -1,44 +1,97 @@
 import os
-import aiohttp
-import yaml
+import time
+import random
+import asyncio
 import logging
-import jsonfactory
 from ghstats import utils
+from ghstats import defaults
+from ghstats import serialize
+from ghstats import metrics
+from ghstats import profiling
+from ghstats.transport import AiohttpTransport
 
 API_ENDPOINT = 'https://api.github.com'
 
 CONF_FILENAME = '~/.github-auth.yaml'
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-)
-
 logger = logging.getLogger(__name__)
 
 def log_request(verb, url, resp_data):
     d = {'verb':verb, 'url':url, 'response':resp_data}
-    txt_data = jsonfactory.dumps(d)
+    txt_data = serialize.dumps(d)
     filename = 'request_data.log'
     with open(filename, 'a') as f:
         f.write('{}\n\n'.format(txt_data))
 
+class RequestError(Exception):
+    def __init__(self, status_code, response):
+        self.status_code = status_code
+        self.response = response
+        super().__init__(status_code, response)
+    def __str__(self):
+        return 'status_code: {}, response: {}'.format(self.status_code, self.response)
+
+class DeadlineExceeded(Exception):
+    pass
+
 class RequestHandler(object):
+    CONNECT_TIMEOUT = defaults.CONNECT_TIMEOUT
+    READ_TIMEOUT = defaults.READ_TIMEOUT
+    MAX_RETRIES = defaults.MAX_RETRIES
+    BACKOFF_BASE = 1.
+    BACKOFF_MAX = 60.
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+    RATE_LIMIT_STATUS_CODES = [403, 429]
     def __init__(self, **kwargs):
         self.username = kwargs.get('username')
         self.password = kwargs.get('password')
         self.token = kwargs.get('token')
+        self.connect_timeout = kwargs.get('connect_timeout', self.CONNECT_TIMEOUT)
+        self.read_timeout = kwargs.get('read_timeout', self.READ_TIMEOUT)
+        self.max_retries = kwargs.get('max_retries', self.MAX_RETRIES)
+        self.backoff_base = kwargs.get('backoff_base', self.BACKOFF_BASE)
+        self.backoff_max = kwargs.get('backoff_max', self.BACKOFF_MAX)
+        self.hedge_delay = kwargs.get('hedge_delay')
+        self.api_endpoint = kwargs.get('api_endpoint', API_ENDPOINT)
+        self.transport = kwargs.get('transport')
+        if self.transport is None:
+            self.transport = AiohttpTransport()
+        self.deadline = None
         self._session = None
         self._acquire_count = 0
     @classmethod
     def from_conf(cls, filename=CONF_FILENAME):
+        import yaml
         filename = os.path.expanduser(filename)
         with open(filename, 'r') as f:
             s = f.read()
         data = yaml.load(s)
         return cls(**data)
     @property
+    def loop(self):
+        return asyncio.get_event_loop()
+    def set_deadline(self, seconds):
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = self.loop.time() + seconds
+    def get_time_remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - self.loop.time()
+    def get_request_timeout(self):
+        import aiohttp
+        total = self.get_time_remaining()
+        if total is not None and total <= 0:
+            raise DeadlineExceeded()
+        return aiohttp.ClientTimeout(
+            total=total,
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout,
+        )
+    @property
     def session(self):
+        import aiohttp
         s = self._session
         if s is not None and s.closed:
             s = None
@@ -89,29 +142,113 @@ class RequestHandler(object):
             'Conditional':parse_conditional_headers(),
         }
         return d
+    def is_retryable(self, status_code, headers, resp_data):
+        if status_code in self.RETRY_STATUS_CODES:
+            return True
+        if status_code in self.RATE_LIMIT_STATUS_CODES:
+            if headers.get('Retry-After') is not None:
+                return True
+            if 'secondary rate limit' in str(resp_data).lower():
+                return True
+        return False
+    def get_retry_delay(self, attempt, headers=None):
+        if headers is not None:
+            retry_after = headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, delay)
+    def can_retry(self, attempt, delay):
+        if attempt >= self.max_retries:
+            return False
+        remaining = self.get_time_remaining()
+        if remaining is not None and delay >= remaining:
+            return False
+        return True
+    async def _send_request(self, verb, url, req_kwargs):
+        req_kwargs = req_kwargs.copy()
+        req_kwargs['timeout'] = self.get_request_timeout()
+        endpoint = metrics.get_api_endpoint_label(url, self.api_endpoint)
+        start_ts = time.perf_counter()
+        try:
+            async with self as session:
+                result = await self.transport.send(session, verb, url, **req_kwargs)
+        except Exception:
+            metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status='error')
+            raise
+        finally:
+            duration = time.perf_counter() - start_ts
+            metrics.HTTP_REQUEST_DURATION.observe(duration, endpoint=endpoint)
+            profiling.add('api_request', duration)
+        metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status=result[0])
+        return result
+    async def _send_hedged_request(self, verb, url, req_kwargs):
+        if self.hedge_delay is None or verb != 'get':
+            return await self._send_request(verb, url, req_kwargs)
+        first = asyncio.ensure_future(self._send_request(verb, url, req_kwargs))
+        done, pending = await asyncio.wait([first], timeout=self.hedge_delay)
+        if len(done):
+            return first.result()
+        logger.debug('hedging request: verb={}, url={}'.format(verb, url))
+        second = asyncio.ensure_future(self._send_request(verb, url, req_kwargs))
+        tasks = [first, second]
+        error = None
+        try:
+            while len(tasks):
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED,
+                )
+                tasks = list(pending)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+    async def _send_request_with_retries(self, verb, url, req_kwargs):
+        import aiohttp
+        attempt = 0
+        while True:
+            try:
+                result = await self._send_hedged_request(verb, url, req_kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                delay = self.get_retry_delay(attempt)
+                if not self.can_retry(attempt, delay):
+                    raise
+                logger.warning('retrying after {!r}: verb={}, url={}'.format(exc, verb, url))
+            else:
+                status_code, headers, resp_data = result
+                if not self.is_retryable(status_code, headers, resp_data):
+                    return result
+                delay = self.get_retry_delay(attempt, headers)
+                if not self.can_retry(attempt, delay):
+                    return result
+                logger.warning('retrying after status {}: verb={}, url={}'.format(
+                    status_code, verb, url,
+                ))
+            await asyncio.sleep(delay)
+            attempt += 1
     async def _do_request(self, verb, url, data=None, request_headers=None):
         req_kwargs = {}
         if data:
             req_kwargs['data'] = data
         if request_headers is not None:
             req_kwargs['headers'] = request_headers
-        async with self as session:
-            verb_func = getattr(session, verb)
-            async with verb_func(url, **req_kwargs) as resp:
-                status_code = resp.status
-                headers = resp.headers
-                if status_code == 200:
-                    resp_data = await resp.json()
-                else:
-                    resp_data = await resp.text()
+        status_code, headers, resp_data = await self._send_request_with_retries(
+            verb, url, req_kwargs,
+        )
         header_data = self.parse_debug_headers(headers)
-        logger.debug('headers: {}'.format(header_data))
+        metrics.observe_rate_limits(header_data['ApiLimits'])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('headers: {}'.format(header_data))
         pagination_links = self.parse_link_headers(headers)
         if 'next' in pagination_links:
             status_code, _header_data, _resp_data = await self._do_request(verb, pagination_links['next'], data)
             resp_data.extend(_resp_data)
         return status_code, header_data, resp_data
-    async def make_request(self, verb, path, data=None, headers=None):
+    async def make_request(self, verb, path, data=None, headers=None, dt_keys=None):
         if data is None:
             data = {}
         # if self.token is not None:
@@ -121,17 +258,20 @@ class RequestHandler(object):
         # if len(data):
         #     req_kwargs['data'] = data
 
-        url = '/'.join([API_ENDPOINT, path])
+        url = '/'.join([self.api_endpoint, path])
 
         status_code, header_data, resp_data = await self._do_request(verb, url, data, headers)
+        if headers is not None and 'If-None-Match' in headers:
+            metrics.observe_conditional_request(status_code == 304)
 
         if status_code == 304:      # Not Modified
             logger.debug('request not modified: verb={}, url={}'.format(verb, url))
             resp_data = {}
         elif status_code != 200:
-            raise Exception('status_code: {}, response: {}'.format(status_code, resp_data))
+            raise RequestError(status_code, resp_data)
         else:
-            resp_data = utils.iter_parse_datetimes(resp_data)
+            with profiling.phase('parse_datetimes', cpu=True):
+                resp_data = utils.iter_parse_datetimes(resp_data, dt_keys)
 
         return status_code, header_data, resp_data
     async def get(self, path, data=None):
@@ -148,3 +288,4 @@ class RequestHandler(object):
             self._session = None
             if session is not None:
                 await session.close()
+            await self.transport.close()
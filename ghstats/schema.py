@@ -0,0 +1,377 @@
+import sys
+import asyncio
+import argparse
+import datetime
+import logging
+
+import pymongo
+from pymongo.errors import OperationFailure
+
+from ghstats import utils
+from ghstats import traffic
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+COLLECTION_NAME = 'schema_version'
+OBSOLETE_INDEXES = [
+    (traffic.TrafficTimelineEntry._collection_name, 'repo_slug_1_timestamp_1'),
+]
+
+EXAMINE_RATIO = 10
+MIN_EXAMINED = 100
+FLAG_MESSAGES = {
+    'collscan':'collection scan',
+    'sort':'in-memory sort',
+    'fetch':'not covered by an index',
+    'ratio':'examined {docs_examined} docs for {returned} results',
+}
+
+RESULT_FIELDS = [
+    ('name', 'query', '{}'),
+    ('collection', 'collection', '{}'),
+    ('plan', 'plan', '{}'),
+    ('keys_examined', 'keys', '{:d}'),
+    ('docs_examined', 'docs', '{:d}'),
+    ('returned', 'returned', '{:d}'),
+    ('problems', 'problems', '{}'),
+]
+
+
+async def get_index_version(db_store):
+    coll = db_store.get_collection(COLLECTION_NAME)
+    doc = await coll.find_one({'_id':'indexes'}, projection={'_id':False, 'version':True})
+    if doc is None:
+        return None
+    return doc['version']
+
+async def set_index_version(db_store, version=INDEX_VERSION):
+    coll = db_store.get_collection(COLLECTION_NAME)
+    await coll.update_one(
+        {'_id':'indexes'},
+        {'$set':{'version':version, 'updated':utils.now()}},
+        upsert=True,
+    )
+
+async def drop_obsolete_indexes(db_store):
+    for coll_name, index_name in OBSOLETE_INDEXES:
+        coll = db_store.get_collection(coll_name)
+        names = [doc['name'] async for doc in coll.list_indexes()]
+        if index_name not in names:
+            continue
+        logger.info('dropping index {} on {}'.format(index_name, coll_name))
+        try:
+            await coll.drop_index(index_name)
+        except OperationFailure as exc:
+            logger.warning('could not drop {} on {}: {}'.format(index_name, coll_name, exc))
+
+async def create_indexes(db_store):
+    from ghstats.checkpoint import RunCheckpoint
+    from ghstats.leases import WorkLeases
+    from ghstats.activity import ActivityTracker
+    tasks = [
+        asyncio.ensure_future(traffic.ApiObject.create_indexes(db_store)),
+        asyncio.ensure_future(RunCheckpoint.create_indexes(db_store)),
+        asyncio.ensure_future(WorkLeases.create_indexes(db_store)),
+        asyncio.ensure_future(ActivityTracker(db_store=db_store).create_indexes()),
+    ]
+    await traffic.wait_all(tasks)
+    await drop_obsolete_indexes(db_store)
+
+async def ensure_indexes(db_store, force=False):
+    version = await get_index_version(db_store)
+    if version == INDEX_VERSION and not force:
+        logger.debug('indexes are at version {}'.format(version))
+        return False
+    logger.info('upgrading indexes from version {} to {}'.format(version, INDEX_VERSION))
+    await create_indexes(db_store)
+    await set_index_version(db_store)
+    return True
+
+
+class QueryShape(object):
+    def __init__(self, name, collection, command, **kwargs):
+        self.name = name
+        self.collection = collection
+        self.command = command
+        self.allow = set(kwargs.get('allow', []))
+        self.covered = kwargs.get('covered', False)
+    @classmethod
+    def find(cls, name, collection, filt, sort=None, projection=None, limit=None, **kwargs):
+        command = {'find':collection, 'filter':filt}
+        if sort is not None:
+            command['sort'] = dict(sort)
+        if projection is not None:
+            command['projection'] = projection
+        if limit is not None:
+            command['limit'] = limit
+        return cls(name, collection, command, **kwargs)
+    @classmethod
+    def distinct(cls, name, collection, key, filt, **kwargs):
+        command = {'distinct':collection, 'key':key, 'query':filt}
+        return cls(name, collection, command, **kwargs)
+    @classmethod
+    def aggregate(cls, name, collection, pipeline, **kwargs):
+        command = {'aggregate':collection, 'pipeline':pipeline, 'cursor':{}}
+        return cls(name, collection, command, **kwargs)
+    async def explain(self, db_store):
+        return await db_store.db.command({'explain':self.command, 'verbosity':'executionStats'})
+    def check(self, explain_result):
+        stages = []
+        for plan in iter_key(explain_result, 'winningPlan'):
+            stages.extend(iter_stages(plan))
+        stats = list(iter_key(explain_result, 'executionStats'))
+        result = {
+            'name':self.name,
+            'collection':self.collection,
+            'plan':' > '.join(reversed(stages)),
+            'keys_examined':sum([s.get('totalKeysExamined', 0) for s in stats]),
+            'docs_examined':sum([s.get('totalDocsExamined', 0) for s in stats]),
+            'returned':sum([s.get('nReturned', 0) for s in stats]),
+        }
+        flags = set()
+        if 'COLLSCAN' in stages:
+            flags.add('collscan')
+        if 'SORT' in stages:
+            flags.add('sort')
+        if self.covered and 'FETCH' in stages:
+            flags.add('fetch')
+        docs_examined = result['docs_examined']
+        if docs_examined > max(result['returned'] * EXAMINE_RATIO, MIN_EXAMINED):
+            flags.add('ratio')
+        flags -= self.allow
+        result['flags'] = sorted(flags)
+        result['problems'] = ', '.join([
+            FLAG_MESSAGES[flag].format(**result) for flag in result['flags']
+        ]) or '-'
+        return result
+
+
+def iter_key(obj, key):
+    if isinstance(obj, dict):
+        for _key, value in obj.items():
+            if _key in ('rejectedPlans', 'allPlansExecution'):
+                continue
+            if _key == key:
+                yield value
+            else:
+                yield from iter_key(value, key)
+    elif isinstance(obj, list):
+        for item in obj:
+            yield from iter_key(item, key)
+
+def iter_stages(plan):
+    if isinstance(plan, dict):
+        stage = plan.get('stage')
+        if isinstance(stage, str):
+            yield stage
+        for value in plan.values():
+            yield from iter_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from iter_stages(item)
+
+def get_query_shapes(repo_slug, now=None):
+    from ghstats.app import chartdata
+    from ghstats.checkpoint import RunCheckpoint
+    from ghstats.leases import WorkLeases
+    from ghstats.activity import ActivityTracker
+    if now is None:
+        now = utils.now()
+    context = {
+        'start_datetime':now - datetime.timedelta(days=30),
+        'end_datetime':now,
+    }
+    owner, name = repo_slug.split('/', 1)
+    repo = traffic.Repo(owner=owner, name=name)
+    views = traffic.RepoTrafficViews(repo=repo, datetime=now)
+    paths = traffic.RepoTrafficPaths(repo=repo, datetime=now)
+    referrals = traffic.RepoTrafficReferrals
+    timeline = traffic.TrafficTimelineEntry
+    path_entry = traffic.TrafficPathEntry
+    log_coll = traffic.ApiObject._log_collection_name
+    newest_first = [('start_datetime', pymongo.DESCENDING)]
+    timeline_filt = traffic.build_datetime_filter('timestamp', **context)
+    timeline_filt['repo_slug'] = repo_slug
+    return [
+        QueryShape.find(
+            'etag lookup', 'request_etags', {'verb':'get', 'api_path':views.api_path},
+            projection={'_id':False, 'etag':True, 'response_data':True}, limit=1,
+        ),
+        QueryShape.find(
+            'update log entry', log_coll, {'log_timestamp':now},
+            projection={'_id':False, 'collection_updates':True, 'total_updates':True}, limit=1,
+        ),
+        QueryShape.find(
+            'update log watcher', log_coll,
+            {'completed':True, 'log_timestamp':{'$gt':context['start_datetime']}},
+            sort=[('log_timestamp', pymongo.ASCENDING)],
+        ),
+        QueryShape.find(
+            'repo list', traffic.Repo._collection_name, {},
+            projection=traffic.Repo.get_db_projection(), allow=['collscan'],
+        ),
+        QueryShape.find(
+            'repo lookup', traffic.Repo._collection_name, {'repo_slug':repo_slug}, limit=1,
+        ),
+        QueryShape.find(
+            'views by range', traffic.RepoTrafficViews._collection_name,
+            traffic.RepoTrafficViews.get_db_lookup_filter(repo=repo, **context),
+            projection=traffic.RepoTrafficViews.get_db_projection(),
+        ),
+        QueryShape.find(
+            'views lookup', traffic.RepoTrafficViews._collection_name,
+            views.get_db_filter(), limit=1,
+        ),
+        QueryShape.find(
+            'timeline by snapshot', timeline._collection_name,
+            {'repo_slug':repo_slug, 'datetime':now},
+            sort=[('timestamp', pymongo.ASCENDING)], projection=timeline.get_db_projection(),
+        ),
+        QueryShape.find(
+            'timeline by range', timeline._collection_name, timeline_filt,
+            sort=[('repo_slug', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+            projection={'_id':False, 'repo_slug':True, 'timestamp':True, 'count':True, 'uniques':True},
+            covered=True,
+        ),
+        QueryShape.distinct(
+            'path snapshots', paths._collection_name, 'datetime',
+            traffic.RepoTrafficPaths.get_db_lookup_filter(repo=repo, **context),
+        ),
+        QueryShape.find(
+            'paths by snapshot', path_entry._collection_name,
+            {'repo_slug':repo_slug, 'datetime':now}, projection=path_entry.get_db_projection(),
+        ),
+        QueryShape.find(
+            'paths lookup', paths._collection_name, paths.get_db_filter(), limit=1,
+        ),
+        QueryShape.find(
+            'last referrals', referrals._collection_name,
+            referrals.get_last_item_filter(repo_slug), sort=newest_first,
+            projection=referrals.get_db_projection(), limit=1,
+        ),
+        QueryShape.find(
+            'previous referrals', referrals._collection_name,
+            referrals.get_last_item_filter(repo_slug, now), sort=newest_first, limit=1,
+        ),
+        QueryShape.find(
+            'referrer lookup', traffic.TrafficReferrer._collection_name,
+            {'repo_slug':repo_slug, 'start_datetime':now, 'referrer':'github.com'}, limit=1,
+        ),
+        QueryShape.aggregate(
+            'chart repo ranking', timeline._collection_name,
+            chartdata.build_repos_by_rank_pipeline([repo_slug]), allow=['sort'],
+        ),
+        QueryShape.aggregate(
+            'chart timeline', timeline._collection_name,
+            chartdata.build_timeline_pipeline(context, repo_slug, 'count'), allow=['sort'],
+        ),
+        QueryShape.aggregate(
+            'chart paths', path_entry._collection_name,
+            chartdata.build_repo_traffic_paths_pipeline(context, repo_slug, 0, 25),
+            allow=['sort'],
+        ),
+        QueryShape.aggregate(
+            'chart referrers', traffic.TrafficReferrer._collection_name,
+            chartdata.build_repo_referrals_pipeline(context, repo_slug, 0, 25),
+            allow=['sort'],
+        ),
+        QueryShape.find(
+            'checkpoint run', RunCheckpoint._collection_name, {},
+            sort=[('log_timestamp', pymongo.DESCENDING)],
+            projection={'_id':False, 'log_timestamp':True}, limit=1,
+        ),
+        QueryShape.find(
+            'checkpoint repos', RunCheckpoint._collection_name,
+            {'log_timestamp':now, 'completed':True},
+            projection={'_id':False, 'repo_slug':True},
+        ),
+        QueryShape.find(
+            'open lease run', WorkLeases._collection_name,
+            {'state':{'$in':['pending', 'leased']}},
+            sort=[('log_timestamp', pymongo.DESCENDING)],
+            projection={'_id':False, 'log_timestamp':True}, limit=1,
+        ),
+        QueryShape.find(
+            'lease claim', WorkLeases._collection_name,
+            WorkLeases.get_claim_filter(now, now), limit=1,
+        ),
+        QueryShape.find(
+            'lease expiry', WorkLeases._collection_name,
+            WorkLeases.get_expired_filter(now, now), projection={'_id':True},
+        ),
+        QueryShape.find(
+            'activity', ActivityTracker._collection_name, {},
+            projection={'_id':False}, allow=['collscan'],
+        ),
+    ]
+
+async def get_sample_repo_slug(db_store):
+    coll = db_store.get_collection(traffic.Repo._collection_name)
+    doc = await coll.find_one({}, projection={'_id':False, 'repo_slug':True})
+    if doc is None:
+        return 'owner/name'
+    return doc['repo_slug']
+
+async def check_queries(db_store, repo_slug=None):
+    if repo_slug is None:
+        repo_slug = await get_sample_repo_slug(db_store)
+    results = []
+    for shape in get_query_shapes(repo_slug):
+        explain_result = await shape.explain(db_store)
+        results.append(shape.check(explain_result))
+    return results
+
+async def get_status(db_store):
+    version = await get_index_version(db_store)
+    indexes = {}
+    for coll_name in sorted(await db_store.db.list_collection_names()):
+        coll = db_store.get_collection(coll_name)
+        indexes[coll_name] = [doc['name'] async for doc in coll.list_indexes()]
+    return version, indexes
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Manage MongoDB indexes and check the query plans the app relies on',
+    )
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    up = sub.add_parser('upgrade', help='Build indexes if the stored version is out of date')
+    up.add_argument(
+        '--force', dest='force', action='store_true',
+        help='Rebuild indexes even if the stored version is current',
+    )
+    sub.add_parser('status', help='Show the stored index version and existing indexes')
+    cp = sub.add_parser(
+        'check', help='Run explain() on each query shape and flag scans and poor index use',
+    )
+    cp.add_argument(
+        '--repo', dest='repo_slug', default=None, metavar='OWNER/NAME',
+        help='Repo to build the sample queries for (default: the first stored repo)',
+    )
+    p.add_argument('--db-config', dest='db_config', default=DB_CONF_FILENAME)
+    p.add_argument('--log-level', dest='log_level', default='INFO')
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    db_store = DbStore.from_conf(args.db_config)
+    loop = asyncio.get_event_loop()
+    if args.command == 'upgrade':
+        loop.run_until_complete(ensure_indexes(db_store, args.force))
+        return
+    if args.command == 'status':
+        version, indexes = loop.run_until_complete(get_status(db_store))
+        print('index version: {} (current: {})'.format(version, INDEX_VERSION))
+        for coll_name, names in indexes.items():
+            print('{}: {}'.format(coll_name, ', '.join(names)))
+        return
+    results = loop.run_until_complete(check_queries(db_store, args.repo_slug))
+    print(utils.format_table(results, RESULT_FIELDS))
+    if any([len(r['flags']) for r in results]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import json
+import datetime
+import functools
+
+from jsonfactory.registry import Registry
+
+from ghstats import utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DT_CLASS = 'datetime.datetime'
+DT_STR_FMT = '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z'
+
+CLASS_FIELDS = {}
+
+
+def get_class_fields(cls):
+    if cls in CLASS_FIELDS:
+        return CLASS_FIELDS[cls]
+    from ghstats.traffic import ApiObject
+    fields = None
+    if issubclass(cls, ApiObject):
+        fields = (cls.__name__, tuple(cls._serialize_attrs))
+    CLASS_FIELDS[cls] = fields
+    return fields
+
+@functools.lru_cache(maxsize=utils.DT_CACHE_SIZE)
+def encode_dt_str(dt):
+    if dt.tzinfo is not utils.UTC:
+        dt = utils.UTC.normalize(dt)
+    return DT_STR_FMT.format(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+def encode_dict_keys(d):
+    for key in d:
+        if isinstance(key, datetime.datetime):
+            break
+    else:
+        return d
+    return {
+        encode_dt_str(k) if isinstance(k, datetime.datetime) else k:v
+        for k, v in d.items()
+    }
+
+def default(o):
+    if isinstance(o, datetime.datetime):
+        return {'__class__':DT_CLASS, 'value':encode_dt_str(o)}
+    fields = get_class_fields(type(o))
+    if fields is not None:
+        cls_name, attrs = fields
+        d = {'__class__':cls_name}
+        for attr in attrs:
+            value = getattr(o, attr)
+            if type(value) is dict:
+                value = encode_dict_keys(value)
+            d[attr] = value
+        return d
+    r = Registry.encode(o)
+    if r is None:
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+    return r
+
+def object_hook(d):
+    if d.get('__class__') == DT_CLASS:
+        return utils.parse_dt(d['value'])
+    keys = [key for key in d if len(key) == 20 and utils.is_iso_dt_str(key)]
+    for key in keys:
+        d[utils.parse_iso_dt(key)] = d.pop(key)
+    return d
+
+def dumps_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return dumps(obj).encode('utf-8')
+
+def dumps(obj):
+    if orjson is not None:
+        return dumps_bytes(obj).decode('utf-8')
+    return json.dumps(obj, default=default, separators=(',', ':'))
+
+def loads(s):
+    return json.loads(s, object_hook=object_hook)
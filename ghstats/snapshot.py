@@ -0,0 +1,273 @@
+import os
+import json
+import array
+import shutil
+import asyncio
+import argparse
+import datetime
+import logging
+
+import pymongo
+
+from ghstats import utils
+from ghstats import traffic
+from ghstats.dbstore import DbStore, CONF_FILENAME as DB_CONF_FILENAME
+from ghstats.export import parse_date_arg, build_filter
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+META_FILENAME = 'meta.json'
+COLUMNS = [
+    ('repo_index', 'i'),
+    ('day', 'i'),
+    ('count', 'q'),
+    ('uniques', 'q'),
+]
+
+
+def get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('Snapshot files require numpy')
+    return numpy
+
+def dt_to_day(dt):
+    return (dt - utils.EPOCH).days
+
+def day_to_dt(day):
+    return utils.EPOCH + datetime.timedelta(days=int(day))
+
+
+class SnapshotWriter(object):
+    BATCH_SIZE = 10000
+    def __init__(self, db_store, **kwargs):
+        self.db_store = db_store
+        self.start_datetime = kwargs.get('start_datetime')
+        self.end_datetime = kwargs.get('end_datetime')
+        self.repo_slugs = kwargs.get('repo_slugs')
+        self.batch_size = kwargs.get('batch_size', self.BATCH_SIZE)
+        self.columns = {name:array.array(typecode) for name, typecode in COLUMNS}
+        self.slugs = []
+        self.repo_offsets = array.array('q', [0])
+    async def iter_timeline(self):
+        filt = build_filter(
+            'timeline',
+            start_datetime=self.start_datetime,
+            end_datetime=self.end_datetime,
+            repo_slugs=self.repo_slugs,
+        )
+        cursor = self.db_store.find_docs(
+            traffic.TrafficTimelineEntry._collection_name, filt,
+            projection={'_id':False, 'repo_slug':True, 'timestamp':True, 'count':True, 'uniques':True},
+            sort=[('repo_slug', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+            batch_size=self.batch_size,
+        )
+        async for doc in cursor:
+            yield doc
+    def add_row(self, repo_slug, day, count, uniques):
+        if not len(self.slugs) or self.slugs[-1] != repo_slug:
+            if len(self.slugs):
+                self.repo_offsets.append(len(self.columns['day']))
+            self.slugs.append(repo_slug)
+        self.columns['repo_index'].append(len(self.slugs) - 1)
+        self.columns['day'].append(day)
+        self.columns['count'].append(count)
+        self.columns['uniques'].append(uniques)
+    async def build(self):
+        last = None
+        async for doc in self.iter_timeline():
+            key = (doc['repo_slug'], dt_to_day(doc['timestamp']))
+            count = doc.get('count') or 0
+            uniques = doc.get('uniques') or 0
+            if key == last:
+                cols = self.columns
+                cols['count'][-1] = max(cols['count'][-1], count)
+                cols['uniques'][-1] = max(cols['uniques'][-1], uniques)
+                continue
+            self.add_row(key[0], key[1], count, uniques)
+            last = key
+        self.repo_offsets.append(len(self.columns['day']))
+        return len(self.columns['day'])
+    def get_meta(self):
+        days = self.columns['day']
+        return {
+            'version':FORMAT_VERSION,
+            'created':utils.dt_to_str(utils.now()),
+            'num_rows':len(days),
+            'start_day':min(days) if len(days) else None,
+            'end_day':max(days) if len(days) else None,
+            'columns':[name for name, _ in COLUMNS],
+            'repo_slugs':self.slugs,
+        }
+    def get_arrays(self):
+        np = get_numpy()
+        arrays = dict(self.columns, repo_offsets=self.repo_offsets)
+        return {
+            name:np.frombuffer(arr, dtype=np.dtype(arr.typecode))
+            for name, arr in arrays.items()
+        }
+    def to_snapshot(self):
+        return Snapshot(self.get_meta(), self.get_arrays())
+    def save(self, path):
+        np = get_numpy()
+        tmp_path = '{}.tmp'.format(path.rstrip(os.sep))
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, data in self.get_arrays().items():
+            np.save(os.path.join(tmp_path, '{}.npy'.format(name)), data)
+        with open(os.path.join(tmp_path, META_FILENAME), 'w') as f:
+            json.dump(self.get_meta(), f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    async def write(self, path):
+        num_rows = await self.build()
+        self.save(path)
+        logger.info('{} rows for {} repos written to {}'.format(num_rows, len(self.slugs), path))
+        return num_rows
+
+
+class Snapshot(object):
+    def __init__(self, meta, columns, path=None):
+        self.np = get_numpy()
+        self.meta = meta
+        self.columns = columns
+        self.path = path
+        self.repo_slugs = self.meta['repo_slugs']
+        self.slug_index = {slug:i for i, slug in enumerate(self.repo_slugs)}
+        self.repo_index = self.columns['repo_index']
+        self.day = self.columns['day']
+        self.count = self.columns['count']
+        self.uniques = self.columns['uniques']
+        self.repo_offsets = self.columns['repo_offsets']
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        np = get_numpy()
+        with open(os.path.join(path, META_FILENAME), 'r') as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise Exception('Unsupported snapshot version {}'.format(meta['version']))
+        columns = {}
+        for name in meta['columns'] + ['repo_offsets']:
+            filename = os.path.join(path, '{}.npy'.format(name))
+            columns[name] = np.load(filename, mmap_mode=mmap_mode)
+        return cls(meta, columns, path)
+    @classmethod
+    async def from_db(cls, db_store, **kwargs):
+        writer = SnapshotWriter(db_store, **kwargs)
+        await writer.build()
+        return writer.to_snapshot()
+    @property
+    def num_rows(self):
+        return self.meta['num_rows']
+    @property
+    def num_repos(self):
+        return len(self.repo_slugs)
+    @property
+    def start_day(self):
+        return self.meta['start_day']
+    @property
+    def end_day(self):
+        return self.meta['end_day']
+    def get_repo_slice(self, repo_slug, start_datetime=None, end_datetime=None):
+        i = self.slug_index[repo_slug]
+        start, end = int(self.repo_offsets[i]), int(self.repo_offsets[i + 1])
+        days = self.day[start:end]
+        if start_datetime is not None:
+            start += int(self.np.searchsorted(days, dt_to_day(start_datetime), 'left'))
+        if end_datetime is not None:
+            end = int(self.repo_offsets[i]) + int(
+                self.np.searchsorted(days, dt_to_day(end_datetime), 'left')
+            )
+        return slice(start, max(start, end))
+    def get_repo(self, repo_slug, start_datetime=None, end_datetime=None):
+        s = self.get_repo_slice(repo_slug, start_datetime, end_datetime)
+        return {'day':self.day[s], 'count':self.count[s], 'uniques':self.uniques[s]}
+    def get_day_mask(self, start_datetime=None, end_datetime=None):
+        mask = self.np.ones(self.num_rows, dtype=bool)
+        if start_datetime is not None:
+            mask &= self.day >= dt_to_day(start_datetime)
+        if end_datetime is not None:
+            mask &= self.day < dt_to_day(end_datetime)
+        return mask
+    def to_matrix(self, column='count', start_datetime=None, end_datetime=None):
+        np = self.np
+        if start_datetime is not None:
+            start_day = dt_to_day(start_datetime)
+        elif self.start_day is not None:
+            start_day = self.start_day
+        else:
+            start_day = 0
+        if end_datetime is not None:
+            end_day = dt_to_day(end_datetime)
+        elif self.end_day is not None:
+            end_day = self.end_day + 1
+        else:
+            end_day = start_day
+        days = np.arange(start_day, max(start_day, end_day))
+        matrix = np.zeros((self.num_repos, len(days)), dtype=np.int64)
+        mask = (self.day >= start_day) & (self.day < end_day)
+        matrix[self.repo_index[mask], self.day[mask] - start_day] = self.columns[column][mask]
+        return matrix, days
+
+
+async def write_snapshot(db_store, path, **kwargs):
+    writer = SnapshotWriter(db_store, **kwargs)
+    return await writer.write(path)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description='Write or inspect memory-mappable snapshots of the daily traffic series',
+    )
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    wp = sub.add_parser('write', help='Dump the daily series from MongoDB into a snapshot directory')
+    wp.add_argument('path')
+    wp.add_argument('--start', dest='start_datetime', type=parse_date_arg, default=None)
+    wp.add_argument('--end', dest='end_datetime', type=parse_date_arg, default=None)
+    wp.add_argument(
+        '--repo', dest='repo_slugs', action='append', default=None, metavar='OWNER/NAME',
+    )
+    wp.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=SnapshotWriter.BATCH_SIZE,
+    )
+    wp.add_argument('--db-config', dest='db_config', default=DB_CONF_FILENAME)
+    ip = sub.add_parser('info', help='Summarize a snapshot directory')
+    ip.add_argument('path')
+    p.add_argument('--log-level', dest='log_level', default='INFO')
+    return p.parse_args(argv)
+
+def print_info(path):
+    snapshot = Snapshot.load(path)
+    print('repos: {}'.format(snapshot.num_repos))
+    print('rows: {}'.format(snapshot.num_rows))
+    if snapshot.num_rows:
+        print('days: {} - {}'.format(
+            utils.dt_to_str(day_to_dt(snapshot.start_day)),
+            utils.dt_to_str(day_to_dt(snapshot.end_day)),
+        ))
+        print('total views: {}'.format(int(snapshot.count.sum())))
+    print('created: {}'.format(snapshot.meta['created']))
+    return snapshot
+
+def main(argv=None):
+    args = parse_args(argv)
+    utils.setup_logging(args.log_level)
+    if args.command == 'info':
+        print_info(args.path)
+        return
+    db_store = DbStore.from_conf(args.db_config, section='export')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(write_snapshot(
+        db_store, args.path,
+        start_datetime=args.start_datetime,
+        end_datetime=args.end_datetime,
+        repo_slugs=args.repo_slugs,
+        batch_size=args.batch_size,
+    ))
+
+if __name__ == '__main__':
+    main()
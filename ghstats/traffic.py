@@ -4,6 +4,7 @@ import logging
 import jsonfactory
 import pymongo
 from ghstats import utils
+from ghstats import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +21,21 @@ def build_datetime_filter(filter_key, **kwargs):
         ]}
     return filt
 
+async def wait_all(tasks):
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
 class ApiObject(object):
     _serialize_attrs = []
+    _db_fields = []
+    _response_dt_keys = None
     _log_collection_name = 'db_update_log'
     def __init__(self, **kwargs):
         self._cached = True
+        self._pending_etag = None
         self._modified = kwargs.get('_modified', True)
         self.request_handler = kwargs.get('request_handler')
         self.db_store = kwargs.get('db_store')
@@ -33,36 +44,40 @@ class ApiObject(object):
         return self._get_api_path()
     def _get_api_path(self):
         raise NotImplementedError('Must be defined by subclasses')
+    @classmethod
+    def get_db_projection(cls, fields=None):
+        if fields is None:
+            fields = cls._db_fields
+        projection = {key:True for key in fields}
+        projection['_id'] = False
+        return projection
     async def log_db_update(self, log_timestamp, collection_name, update_count):
-        doc = await self.get_db_update_log(log_timestamp)
-        if doc is None:
-            created = True
-            doc = {
-                'log_timestamp':log_timestamp,
-                'total_updates':0,
-                'collection_updates':{},
-            }
-        else:
-            created = False
-            _id = doc['_id']
-        doc['total_updates'] += update_count
-        if collection_name not in doc['collection_updates']:
-            doc['collection_updates'][collection_name] = 0
-        doc['collection_updates'][collection_name] += update_count
-        if created:
-            await self.db_store.add_doc(self._log_collection_name, doc)
-        else:
-            coll = self.db_store.get_collection(self._log_collection_name)
-            await coll.replace_one({'_id':_id}, doc)
+        coll = self.db_store.get_collection(self._log_collection_name)
+        update = {'$inc':{
+            'total_updates':update_count,
+            'collection_updates.{}'.format(collection_name):update_count,
+        }}
+        repo_slug = getattr(self, 'repo_slug', None)
+        if update_count and repo_slug is not None:
+            update['$addToSet'] = {'repo_slugs':repo_slug}
+        await coll.update_one({'log_timestamp':log_timestamp}, update, upsert=True)
+    async def set_db_update_complete(self, log_timestamp):
+        coll = self.db_store.get_collection(self._log_collection_name)
+        await coll.update_one(
+            {'log_timestamp':log_timestamp},
+            {'$set':{'completed':True}},
+        )
     async def get_db_update_log(self, log_timestamp):
         doc = await self.db_store.get_doc(
-            self._log_collection_name, {'log_timestamp':log_timestamp}
+            self._log_collection_name, {'log_timestamp':log_timestamp},
+            projection=self.get_db_projection(['collection_updates', 'total_updates']),
         )
         return doc
-    async def make_request(self, verb, api_path=None, data=None):
+    async def make_request(self, verb, api_path=None, data=None, defer_etag=False):
         if api_path is None:
             api_path = self.api_path
-        cache = await self.get_etag_from_db(verb, api_path)
+        with profiling.phase('etag_lookup'):
+            cache = await self.get_etag_from_db(verb, api_path)
         if cache is not None:
             headers = {'If-None-Match':cache['etag']}
             self._etag = cache['etag']
@@ -70,39 +85,55 @@ class ApiObject(object):
             headers = None
         rh = self.request_handler
         status_code, header_data, resp_data = await rh.make_request(
-            verb, api_path, data, headers
+            verb, api_path, data, headers, dt_keys=self._response_dt_keys,
         )
         if status_code == 304:
             resp_data = cache['response_data']
             self._cached = True
             self._modified = False
         else:
-            doc = await self.update_etag_to_db(verb, api_path, resp_data, header_data)
-            self._etag = doc['etag']
+            doc = self.build_etag_doc(verb, api_path, resp_data, header_data)
+            self._etag = None if doc is None else doc['etag']
             self._cached = False
+            self._pending_etag = doc
+            if not defer_etag:
+                await self.commit_etag()
         return resp_data
     async def get_etag_from_db(self, verb, api_path):
         if self.db_store is None:
             return None
         coll_name = 'request_etags'
         filt = {'verb':verb, 'api_path':api_path}
-        return await self.db_store.get_doc(coll_name, filt)
-    async def update_etag_to_db(self, verb, api_path, resp_data, header_data):
-        if self.db_store is None:
-            return
-        coll_name = 'request_etags'
+        return await self.db_store.get_doc(
+            coll_name, filt, projection=self.get_db_projection(['etag', 'response_data']),
+        )
+    def build_etag_doc(self, verb, api_path, resp_data, header_data):
         etag = header_data.get('Conditional', {}).get('ETag')
         if etag is None:
-            return
-        filt = {'verb':verb, 'api_path':api_path}
-        doc = {'etag':etag}
-        doc.update(filt)
-        doc['response_data'] = resp_data
-        await self.db_store.update_doc(coll_name, filt, doc)
+            return None
+        return {'verb':verb, 'api_path':api_path, 'etag':etag, 'response_data':resp_data}
+    async def commit_etag(self):
+        doc = self._pending_etag
+        self._pending_etag = None
+        if doc is None or self.db_store is None:
+            return None
+        filt = {'verb':doc['verb'], 'api_path':doc['api_path']}
+        with profiling.phase('etag_update'):
+            await self.db_store.update_doc('request_etags', filt, doc)
         return doc
     @classmethod
     async def create_indexes(cls, db_store):
-        logger.info('creating indexes for {}...'.format(cls))
+        classes = [
+            Repo, RepoTrafficViews, TrafficTimelineEntry, TrafficPathEntry,
+            RepoTrafficReferrals, TrafficReferrer,
+        ]
+        tasks = [asyncio.ensure_future(cls.create_base_indexes(db_store))]
+        for _cls in classes:
+            tasks.append(asyncio.ensure_future(_cls.create_indexes(db_store)))
+        await wait_all(tasks)
+        logger.info('indexes created for {}'.format(', '.join([c.__name__ for c in classes])))
+    @classmethod
+    async def create_base_indexes(cls, db_store):
         coll = db_store.get_collection('request_etags')
         await coll.create_index(
             [
@@ -113,15 +144,10 @@ class ApiObject(object):
         )
         coll = db_store.get_collection(cls._log_collection_name)
         await coll.create_index('log_timestamp')
-        logger.info('{} indexes created'.format(cls))
-        classes = [
-            Repo, RepoTrafficViews, TrafficTimelineEntry, TrafficPathEntry,
-            RepoTrafficReferrals, TrafficReferrer,
-        ]
-        for _cls in classes:
-            logger.info('creating indexes for {}...'.format(_cls))
-            await _cls.create_indexes(db_store)
-            logger.info('{} indexes created'.format(_cls))
+        await coll.create_index([
+            ('completed', pymongo.ASCENDING),
+            ('log_timestamp', pymongo.ASCENDING),
+        ])
     def _serialize(self, attrs=None):
         if attrs is None:
             attrs = self._serialize_attrs
@@ -134,13 +160,31 @@ class ApiObject(object):
 class AllRepos(ApiObject):
     _serialize_attrs = ['repos']
     _collection_name = 'repos'
+    _response_dt_keys = frozenset(['created_at', 'updated_at', 'pushed_at'])
+    NUM_FETCHERS = 8
+    STORE_QUEUE_SIZE = 16
+    STORE_BATCH_SIZE = 4
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.repos = {}
+        self.failed = []
+        self.activity = kwargs.get('activity')
+        self.checkpoint = kwargs.get('checkpoint')
     def _get_api_path(self):
         return 'user/repos'
+    def get_due_repos(self, now=None):
+        repos = self.repos.values()
+        if self.checkpoint is not None:
+            repos = [
+                repo for repo in repos
+                if not self.checkpoint.is_complete(repo.repo_slug)
+            ]
+        if self.activity is None:
+            return list(repos)
+        return self.activity.filter_due(repos, now)
     async def get_repos(self):
         resp_data = await self.make_request('get')
+        repos = {}
         for repo_data in resp_data:
             repo = Repo(
                 owner=repo_data['owner']['login'],
@@ -148,17 +192,110 @@ class AllRepos(ApiObject):
                 request_handler=self.request_handler,
                 db_store=self.db_store,
             )
-            self.repos[repo.api_path] = repo
+            repos[repo.api_path] = repo
+        self.repos = repos
         return self.repos
-    async def get_repo_data(self, now=None):
+    async def get_repo_data(self, now=None, **kwargs):
         if now is None:
             now = utils.now()
+        if self.db_store is not None:
+            return await self.collect_repo_data(now=now, **kwargs)
         tasks = []
         for repo in self.repos.values():
             tasks.append(asyncio.ensure_future(repo.get_data(now=now)))
         await asyncio.wait(tasks)
-        if self.db_store is not None:
-            await self.store_to_db()
+    async def collect_repo_data(self, now=None, log_timestamp=None, **kwargs):
+        if now is None:
+            now = utils.now()
+        if log_timestamp is None:
+            if self.checkpoint is not None:
+                log_timestamp = self.checkpoint.log_timestamp
+            else:
+                log_timestamp = utils.now()
+        num_fetchers = kwargs.get('num_fetchers', self.NUM_FETCHERS)
+        queue_size = kwargs.get('queue_size', self.STORE_QUEUE_SIZE)
+        batch_size = kwargs.get('batch_size', self.STORE_BATCH_SIZE)
+        await self.log_db_update(log_timestamp, 'repos', 0)
+        repos = self.get_due_repos(now)
+        fetch_queue = asyncio.Queue()
+        for repo in repos:
+            fetch_queue.put_nowait(repo)
+        store_queue = asyncio.Queue(maxsize=queue_size)
+        failed = []
+
+        async def fetch_repos():
+            while not fetch_queue.empty():
+                repo = fetch_queue.get_nowait()
+                if not await self.fetch_repo(repo, now):
+                    failed.append(repo)
+                    continue
+                await store_queue.put(repo)
+
+        async def store_repos():
+            done = False
+            while not done:
+                batch = [await store_queue.get()]
+                while len(batch) < batch_size and not store_queue.empty():
+                    batch.append(store_queue.get_nowait())
+                if None in batch:
+                    batch.remove(None)
+                    done = True
+                if len(batch):
+                    results = await asyncio.gather(*[
+                        self.store_repo(repo, log_timestamp) for repo in batch
+                    ])
+                    for repo, result in zip(batch, results):
+                        if not result:
+                            failed.append(repo)
+
+        store_task = asyncio.ensure_future(store_repos())
+        num_fetchers = max(1, min(num_fetchers, len(repos)))
+        await asyncio.gather(*[fetch_repos() for _ in range(num_fetchers)])
+        await store_queue.put(None)
+        await store_task
+        if len(failed):
+            logger.warning('{} repos failed, resume this run with --resume: {}'.format(
+                len(failed), ', '.join([repo.repo_slug for repo in failed]),
+            ))
+        await self.finish_db_update(log_timestamp, complete=not len(failed))
+        self.failed = failed
+        return failed
+    async def collect_repo(self, repo, log_timestamp, now=None):
+        if not await self.fetch_repo(repo, now):
+            return False
+        return await self.store_repo(repo, log_timestamp)
+    async def fetch_repo(self, repo, now=None):
+        try:
+            with profiling.phase('fetch', repo.repo_slug):
+                await repo.get_data(now=now)
+        except Exception as exc:
+            logger.exception('Error fetching data for {}'.format(repo))
+            repo.release_data()
+            await self.set_repo_failed(repo, exc)
+            return False
+        return True
+    async def store_repo(self, repo, log_timestamp):
+        try:
+            with profiling.phase('store', repo.repo_slug):
+                await repo.store_to_db(log_timestamp)
+            if self.activity is not None:
+                await self.activity.record(repo)
+        except Exception as exc:
+            logger.exception('Error storing data for {}'.format(repo))
+            await self.set_repo_failed(repo, exc)
+            return False
+        finally:
+            repo.release_data()
+        if self.checkpoint is not None:
+            await self.checkpoint.set_repo_complete(repo.repo_slug)
+        return True
+    async def set_repo_failed(self, repo, exc):
+        if self.checkpoint is None:
+            return
+        try:
+            await self.checkpoint.set_repo_failed(repo.repo_slug, exc)
+        except Exception:
+            logger.exception('Error recording failure for {}'.format(repo))
     async def store_to_db(self, log_timestamp=None):
         if log_timestamp is None:
             log_timestamp = utils.now()
@@ -168,17 +305,21 @@ class AllRepos(ApiObject):
         for repo in self.repos.values():
             tasks.append(asyncio.ensure_future(repo.store_to_db(log_timestamp)))
         await asyncio.wait(tasks)
+        await self.finish_db_update(log_timestamp)
+    async def finish_db_update(self, log_timestamp, complete=True):
+        if complete:
+            await self.set_db_update_complete(log_timestamp)
         log_doc = await self.get_db_update_log(log_timestamp)
         for coll_name, update_count in log_doc['collection_updates'].items():
             logger.info('{} Updates: {}'.format(coll_name, update_count))
         logger.info('Total Updates: {}'.format(log_doc['total_updates']))
     @classmethod
     async def from_db(cls, db_store, **kwargs):
-        coll = db_store.get_collection(cls._collection_name)
         kwargs['db_store'] = db_store
         kwargs['_modified'] = False
         obj = cls(**kwargs)
-        async for doc in coll.find():
+        cursor = db_store.find_docs(cls._collection_name, projection=Repo.get_db_projection())
+        async for doc in cursor:
             rkwargs = {'request_handler':obj.request_handler}
             rkwargs.update(kwargs)
             rkwargs.update(doc)
@@ -189,6 +330,7 @@ class AllRepos(ApiObject):
 
 class Repo(ApiObject):
     _serialize_attrs = ['owner', 'name', 'traffic_views', 'traffic_paths']
+    _db_fields = ['owner', 'name']
     _collection_name = 'repos'
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -239,7 +381,7 @@ class Repo(ApiObject):
             asyncio.ensure_future(self.get_traffic_paths(now=now)),
             asyncio.ensure_future(self.get_traffic_referrals(now=now)),
         ]
-        await asyncio.wait(tasks)
+        await wait_all(tasks)
     async def get_traffic_views(self, per='day', now=None):
         if now is None:
             now = utils.now()
@@ -286,7 +428,15 @@ class Repo(ApiObject):
             asyncio.ensure_future(self.traffic_paths.store_to_db(log_timestamp)),
             asyncio.ensure_future(self.traffic_referrals.store_to_db(log_timestamp)),
         ]
-        await asyncio.wait(tasks)
+        await wait_all(tasks)
+        await self.commit_etags()
+    async def commit_etags(self):
+        objs = [self.traffic_views, self.traffic_paths, self.traffic_referrals]
+        await wait_all([obj.commit_etag() for obj in objs if obj is not None])
+    def release_data(self):
+        self.traffic_views = None
+        self.traffic_paths = None
+        self.traffic_referrals = None
     @classmethod
     async def from_db(cls, **kwargs):
         db_store = kwargs.get('db_store')
@@ -313,7 +463,9 @@ class Repo(ApiObject):
 
 class RepoTrafficViews(ApiObject):
     _serialize_attrs = ['total_views', 'total_uniques', 'timeline', 'datetime']
+    _db_fields = ['total_views', 'total_uniques', 'datetime']
     _collection_name = 'traffic_view_counts'
+    _response_dt_keys = frozenset(['timestamp'])
     def __init__(self, **kwargs):
         self._repo_slug = kwargs.get('repo_slug')
         self.repo = kwargs.get('repo')
@@ -361,12 +513,11 @@ class RepoTrafficViews(ApiObject):
     def __lt__(self, other):
         return self._cmp(other, 'lt')
     async def get_data(self):
-        resp_data = await self.make_request('get', data={'per':self.per})
+        resp_data = await self.make_request('get', data={'per':self.per}, defer_etag=True)
         self.total_views = resp_data['count']
         self.total_uniques = resp_data['uniques']
         for tldata in resp_data['views']:
-            tldata.update({'traffic_view':self, 'db_store':self.db_store})
-            entry = TrafficTimelineEntry(**tldata)
+            entry = TrafficTimelineEntry(traffic_view=self, db_store=self.db_store, **tldata)
             self.timeline.append(entry)
     def get_db_filter(self):
         td = datetime.timedelta(hours=1)
@@ -397,7 +548,7 @@ class RepoTrafficViews(ApiObject):
             task = asyncio.ensure_future(entry.store_to_db(log_timestamp))
             tasks.append(task)
         if len(tasks):
-            await asyncio.wait(tasks)
+            await wait_all(tasks)
     @classmethod
     async def create_indexes(cls, db_store):
         coll = db_store.get_collection(cls._collection_name)
@@ -420,13 +571,13 @@ class RepoTrafficViews(ApiObject):
     async def from_db(cls, **kwargs):
         db_store = kwargs.get('db_store')
         filt = cls.get_db_lookup_filter(**kwargs)
-        repo_slug = filt['repo_slug']
-        coll = db_store.get_collection(cls._collection_name)
         kwargs['_modified'] = False
-        async for doc in coll.find(filt):
+        cursor = db_store.find_docs(
+            cls._collection_name, filt, projection=cls.get_db_projection(),
+        )
+        async for doc in cursor:
             okwargs = kwargs.copy()
             okwargs.update(doc)
-            okwargs['datetime'] = utils.make_aware(okwargs['datetime'])
             obj = cls(**okwargs)
             await obj.get_timeline_from_db()
             yield obj.datetime, obj
@@ -449,6 +600,7 @@ class RepoTrafficViews(ApiObject):
 
 class TrafficTimelineEntry(ApiObject):
     _serialize_attrs = ['count', 'uniques', 'timestamp']
+    _db_fields = ['count', 'uniques', 'timestamp']
     _collection_name = 'traffic_view_timeline'
     def __init__(self, **kwargs):
         self.traffic_view = kwargs.get('traffic_view')
@@ -477,6 +629,8 @@ class TrafficTimelineEntry(ApiObject):
                 [
                     ('repo_slug', pymongo.ASCENDING),
                     ('timestamp', pymongo.ASCENDING),
+                    ('count', pymongo.ASCENDING),
+                    ('uniques', pymongo.ASCENDING),
                 ],
             ),
             pymongo.IndexModel(
@@ -507,9 +661,6 @@ class TrafficTimelineEntry(ApiObject):
     async def from_db(cls, **kwargs):
         db_store = kwargs.get('db_store')
         traffic_view = kwargs.get('traffic_view')
-        tl_coll_name = 'traffic_view_timeline'
-        tl_coll = db_store.get_collection(tl_coll_name)
-        tl_keys = ['count', 'timestamp', 'uniques']
         tl_filt = {'repo_slug':traffic_view.repo_slug}
 
         if traffic_view.datetime is not None:
@@ -517,8 +668,12 @@ class TrafficTimelineEntry(ApiObject):
         else:
             tl_filt.update(build_datetime_filter('timestamp', **kwargs))
 
-        async for tl_doc in tl_coll.find(tl_filt, sort=[('timestamp', pymongo.ASCENDING)]):
-            tl_doc['timestamp'] = utils.make_aware(tl_doc['timestamp'])
+        cursor = db_store.find_docs(
+            cls._collection_name, tl_filt,
+            projection=cls.get_db_projection(),
+            sort=[('timestamp', pymongo.ASCENDING)],
+        )
+        async for tl_doc in cursor:
             tlkwargs = {
                 'traffic_view':traffic_view,
                 'db_store':db_store,
@@ -532,6 +687,7 @@ class TrafficTimelineEntry(ApiObject):
 class RepoTrafficPaths(ApiObject):
     _serialize_attrs = ['data', 'datetime']
     _collection_name = 'traffic_view_paths'
+    _response_dt_keys = frozenset()
     def __init__(self, **kwargs):
         self._repo_slug = kwargs.get('repo_slug')
         self.repo = kwargs.get('repo')
@@ -552,10 +708,9 @@ class RepoTrafficPaths(ApiObject):
     def _get_api_path(self):
         return '{self.repo.api_path}/traffic/popular/paths'.format(self=self)
     async def get_data(self):
-        resp_data = await self.make_request('get')
+        resp_data = await self.make_request('get', defer_etag=True)
         for d in resp_data:
-            d.update({'traffic_path':self, 'db_store':self.db_store})
-            self.data.append(TrafficPathEntry(**d))
+            self.data.append(TrafficPathEntry(traffic_path=self, db_store=self.db_store, **d))
     def get_db_filter(self):
         td = datetime.timedelta(days=14)
         dt_range = [self.datetime - td, self.datetime]
@@ -574,7 +729,7 @@ class RepoTrafficPaths(ApiObject):
             task = asyncio.ensure_future(entry.store_to_db(log_timestamp))
             tasks.append(task)
         if len(tasks):
-            await asyncio.wait(tasks)
+            await wait_all(tasks)
     @classmethod
     def get_db_lookup_filter(cls, **kwargs):
         repo = kwargs.get('repo')
@@ -593,7 +748,6 @@ class RepoTrafficPaths(ApiObject):
         coll = db_store.get_collection(cls._collection_name)
         keys = await coll.distinct('datetime', filt)
         for key in keys:
-            key = utils.make_aware(key)
             okwargs = kwargs.copy()
             okwargs['datetime'] = key
             obj = cls(**okwargs)
@@ -613,6 +767,7 @@ class RepoTrafficPaths(ApiObject):
 
 class TrafficPathEntry(ApiObject):
     _serialize_attrs = ['path', 'count', 'uniques', 'title']
+    _db_fields = ['path', 'count', 'uniques', 'title']
     _collection_name = 'traffic_view_paths'
     def __init__(self, **kwargs):
         self.traffic_path = kwargs.get('traffic_path')
@@ -661,13 +816,15 @@ class TrafficPathEntry(ApiObject):
     async def from_db(cls, **kwargs):
         db_store = kwargs.get('db_store')
         traffic_path = kwargs.get('traffic_path')
-        coll = db_store.get_collection(cls._collection_name)
         obj_filt = {'repo_slug':traffic_path.repo_slug}
         if traffic_path.datetime is not None:
             obj_filt['datetime'] = traffic_path.datetime
         else:
             obj_filt.update(build_datetime_filter('datetime', **kwargs))
-        async for doc in coll.find(obj_filt):
+        cursor = db_store.find_docs(
+            cls._collection_name, obj_filt, projection=cls.get_db_projection(),
+        )
+        async for doc in cursor:
             ekwargs = {
                 'traffic_path':traffic_path,
                 'db_store':db_store,
@@ -681,6 +838,8 @@ class TrafficPathEntry(ApiObject):
 class RepoTrafficReferrals(ApiObject):
     _collection_name = 'traffic_referrals'
     _serialize_attrs = ['start_datetime', 'end_datetime', 'is_complete', 'referrers']
+    _db_fields = ['start_datetime', 'end_datetime', 'is_complete']
+    _response_dt_keys = frozenset()
     def __init__(self, **kwargs):
         self._repo_slug = kwargs.get('repo_slug')
         self.repo = kwargs.get('repo')
@@ -740,28 +899,30 @@ class RepoTrafficReferrals(ApiObject):
         if repo_slug is None:
             repo = kwargs.get('repo')
             repo_slug = repo.repo_slug
-        filt = {'repo_slug':repo_slug}
-        dts = await coll.distinct('start_datetime', filt)
-        if not len(dts):
+        doc = await coll.find_one(
+            cls.get_last_item_filter(repo_slug),
+            projection=cls.get_db_projection(),
+            sort=[('start_datetime', pymongo.DESCENDING)],
+        )
+        if doc is None:
             return cls(**kwargs)
-        filt['start_datetime'] = max(dts)
-        doc = await coll.find_one(filt)
         kwargs.update(doc)
         return cls(**kwargs)
+    @classmethod
+    def get_last_item_filter(cls, repo_slug, before=None):
+        filt = {'repo_slug':repo_slug}
+        if before is not None:
+            filt['end_datetime'] = {'$lte':before}
+        return filt
     async def find_previous(self):
         coll = self.db_store.get_collection(self._collection_name)
-        filt = {
-            'repo_slug':self.repo_slug,
-            'end_datetime':{'$lte':self.start_datetime},
-        }
-        dts = await coll.distinct('start_datetime', filt)
-        if not len(dts):
-            return None
-        filt['start_datetime'] = max(dts)
-        return await coll.find_one(filt)
+        return await coll.find_one(
+            self.get_last_item_filter(self.repo_slug, self.start_datetime),
+            sort=[('start_datetime', pymongo.DESCENDING)],
+        )
     async def get_data(self):
         coll_name = self._collection_name
-        resp_data = await self.make_request('get')
+        resp_data = await self.make_request('get', defer_etag=True)
         if self._cached:
             self.end_datetime = utils.now()
         else:
@@ -803,7 +964,7 @@ class RepoTrafficReferrals(ApiObject):
         for r in self.referrers.values():
             tasks.append(asyncio.ensure_future(r.store_to_db(log_timestamp)))
         if len(tasks):
-            await asyncio.wait(tasks)
+            await wait_all(tasks)
 
 class TrafficReferrer(ApiObject):
     _collection_name = 'traffic_referrers'
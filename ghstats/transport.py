@@ -0,0 +1,140 @@
+import gzip
+import json
+import logging
+import urllib.parse
+
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from ghstats import utils
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADERS = set([
+    'content-type', 'etag', 'last-modified', 'link', 'retry-after',
+    'x-ratelimit-limit', 'x-ratelimit-remaining', 'x-ratelimit-reset',
+])
+
+
+def build_headers(pairs):
+    return CIMultiDictProxy(CIMultiDict(pairs))
+
+def get_request_etag(req_kwargs):
+    headers = req_kwargs.get('headers')
+    if not headers:
+        return None
+    return headers.get('If-None-Match')
+
+
+class AiohttpTransport(object):
+    async def send(self, session, verb, url, **req_kwargs):
+        verb_func = getattr(session, verb)
+        async with verb_func(url, **req_kwargs) as resp:
+            status_code = resp.status
+            headers = resp.headers
+            if status_code == 200:
+                resp_data = await resp.json()
+            else:
+                resp_data = await resp.text()
+        return status_code, headers, resp_data
+    async def close(self):
+        pass
+
+
+class RequestArchive(object):
+    FLUSH_SIZE = 100
+    def __init__(self, filename):
+        self.filename = filename
+        self.buffer = []
+    @staticmethod
+    def build_record(verb, url, request_etag, status_code, headers, resp_data):
+        pairs = [[k, v] for k, v in headers.items() if k.lower() in RECORD_HEADERS]
+        return {
+            'time':utils.dt_to_str(utils.now()),
+            'verb':verb,
+            'url':url,
+            'request_etag':request_etag,
+            'status':status_code,
+            'headers':pairs,
+            'body':resp_data,
+        }
+    def add(self, record):
+        self.buffer.append(json.dumps(record, separators=(',', ':')))
+        if len(self.buffer) >= self.FLUSH_SIZE:
+            self.flush()
+    def flush(self):
+        if not len(self.buffer):
+            return
+        with gzip.open(self.filename, 'at') as f:
+            f.write('\n'.join(self.buffer))
+            f.write('\n')
+        self.buffer = []
+    @classmethod
+    def iter_records(cls, filename):
+        with gzip.open(filename, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                yield json.loads(line)
+
+
+class RecordingTransport(AiohttpTransport):
+    def __init__(self, filename, transport=None):
+        if transport is None:
+            transport = AiohttpTransport()
+        self.transport = transport
+        self.archive = RequestArchive(filename)
+    async def send(self, session, verb, url, **req_kwargs):
+        status_code, headers, resp_data = await self.transport.send(
+            session, verb, url, **req_kwargs
+        )
+        record = self.archive.build_record(
+            verb, url, get_request_etag(req_kwargs), status_code, headers, resp_data,
+        )
+        self.archive.add(record)
+        return status_code, headers, resp_data
+    async def close(self):
+        self.archive.flush()
+        await self.transport.close()
+
+
+class ReplayIndex(object):
+    def __init__(self, filename=None):
+        self.responses = {}
+        self.origins = set()
+        if filename is not None:
+            self.load(filename)
+    def load(self, filename):
+        count = 0
+        for record in RequestArchive.iter_records(filename):
+            self.add(record)
+            count += 1
+        logger.info('Loaded {} recorded responses from {}'.format(count, filename))
+    def add(self, record):
+        if record['status'] == 304:
+            return
+        key = (record['verb'], record['url'])
+        u = urllib.parse.urlsplit(record['url'])
+        self.origins.add('{}://{}'.format(u.scheme, u.netloc))
+        self.responses[key] = (
+            record['status'], record['headers'], json.dumps(record['body']),
+        )
+    def get(self, verb, url, request_etag=None):
+        r = self.responses.get((verb, url))
+        if r is None:
+            return None
+        status_code, pairs, body = r
+        headers = build_headers(pairs)
+        if request_etag is not None and headers.get('ETag') == request_etag:
+            return 304, headers, ''
+        return status_code, headers, json.loads(body)
+
+
+class ReplayTransport(AiohttpTransport):
+    def __init__(self, filename):
+        self.index = ReplayIndex(filename)
+    async def send(self, session, verb, url, **req_kwargs):
+        r = self.index.get(verb, url, get_request_etag(req_kwargs))
+        if r is None:
+            return 404, build_headers([]), 'No recorded response for {} {}'.format(verb, url)
+        return r
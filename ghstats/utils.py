@@ -1,4 +1,6 @@
 import datetime
+import functools
+import logging
 import pytz
 import jsonfactory
 
@@ -6,6 +8,15 @@ UTC = pytz.UTC
 
 DT_FMT = '%Y-%m-%dT%H:%M:%SZ'
 EPOCH = UTC.localize(datetime.datetime(1970, 1, 1))
+DT_CACHE_SIZE = 8192
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def setup_logging(level=logging.INFO):
+    if isinstance(level, str):
+        level = getattr(logging, level.upper())
+    logging.basicConfig(format=LOG_FORMAT, level=level)
+    logging.getLogger().setLevel(level)
 
 def now():
     dt = datetime.datetime.utcnow()
@@ -25,10 +36,20 @@ def make_aware(dt, tz=UTC):
     return tz.localize(dt)
 
 def parse_dt(s, dt_fmt=DT_FMT):
+    if dt_fmt == DT_FMT and is_iso_dt_str(s):
+        return parse_iso_dt(s)
     dt = datetime.datetime.strptime(s, dt_fmt)
     dt = UTC.localize(dt)
     return dt
 
+@functools.lru_cache(maxsize=DT_CACHE_SIZE)
+def parse_iso_dt(s):
+    return datetime.datetime(
+        int(s[0:4]), int(s[5:7]), int(s[8:10]),
+        int(s[11:13]), int(s[14:16]), int(s[17:19]),
+        tzinfo=UTC,
+    )
+
 def dt_to_str(dt):
     return dt.strftime(DT_FMT)
 
@@ -43,7 +64,16 @@ def is_dt_str(o):
         return False
     return True
 
-def iter_parse_datetimes(o):
+def is_iso_dt_str(o):
+    return (
+        type(o) is str and len(o) == 20 and o[19] == 'Z' and o[10] == 'T' and
+        o[4] == '-' and o[7] == '-' and o[13] == ':' and o[16] == ':' and
+        o[:4].isdigit()
+    )
+
+def iter_parse_datetimes(o, dt_keys=None):
+    if dt_keys is not None and not len(dt_keys):
+        return o
     if isinstance(o, dict):
         o_iter = o.items()
     elif isinstance(o, list):
@@ -51,15 +81,27 @@ def iter_parse_datetimes(o):
     else:
         return o
     for key, val in o_iter:
-        if type(val) in (list, dict):
-            o[key] = iter_parse_datetimes(val)
+        t = type(val)
+        if t is list or t is dict:
+            iter_parse_datetimes(val, dt_keys)
+            continue
+        if dt_keys is not None and key not in dt_keys:
             continue
-        if not is_dt_str(val):
+        if not is_iso_dt_str(val):
             continue
-        dt = parse_dt(val)
-        o[key] = dt
+        o[key] = parse_iso_dt(val)
     return o
 
+def format_table(rows, fields):
+    lines = [[title for _, title, _ in fields]]
+    for row in rows:
+        lines.append([fmt.format(row[key]) for key, _, fmt in fields])
+    widths = [max([len(line[i]) for line in lines]) for i in range(len(fields))]
+    result = []
+    for line in lines:
+        result.append('  '.join([s.rjust(w) for s, w in zip(line, widths)]))
+    return '\n'.join(result)
+
 def clean_dict_dt_keys(d):
     keys = [key for key in d.keys() if isinstance(key, datetime.datetime)]
     for key in keys:
@@ -79,7 +121,7 @@ class JsonHandler:
             return d
         return None
     def decode(self, d):
-        keys = [key for key in d.keys() if is_dt_str(key)]
+        keys = [key for key in d.keys() if is_iso_dt_str(key)]
         for key in keys:
             newkey = parse_dt(key)
             d[newkey] = d[key]
@@ -46,11 +46,22 @@ setup(
     packages=find_packages(exclude=['tests*']),
     include_package_data=True,
     install_requires=INSTALL_REQUIRES,
+    extras_require={
+        'fast':['orjson'],
+        'parquet':['pyarrow'],
+        'analysis':['numpy'],
+    },
     python_requires='>=3.6',
     entry_points={
         'console_scripts':[
             'ghstats-collect = ghstats.main:main',
             'ghstats-web = ghstats.app.main:main',
+            'ghstats-fakeapi = ghstats.fakeapi:main',
+            'ghstats-export = ghstats.export:main',
+            'ghstats-snapshot = ghstats.snapshot:main',
+            'ghstats-analytics = ghstats.analytics:main',
+            'ghstats-schema = ghstats.schema:main',
+            'ghstats-backfill = ghstats.backfill:main',
         ],
     },
     platforms=['any'],